@@ -0,0 +1,180 @@
+import io
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import requests
+from sonarr_client import sonarr
+from metrics import metrics
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; without it images are cached at full size
+    Image = None
+
+CONFIG_DIR = os.path.dirname(os.getenv('CONFIG_PATH', '/app/config/config.json'))
+ARTWORK_CACHE_DIR = os.getenv('ARTWORK_CACHE_DIR', os.path.join(CONFIG_DIR, 'artwork'))
+ARTWORK_CACHE_MAX_BYTES = int(os.getenv('ARTWORK_CACHE_MAX_MB', '200')) * 1024 * 1024
+ARTWORK_REVALIDATE_SECONDS = int(os.getenv('ARTWORK_REVALIDATE_SECONDS', '86400'))
+
+# Widest each kind is shown on the dashboard; larger images are scaled down to this
+ARTWORK_WIDTHS = {
+    'poster': 400,
+    'banner': 758,
+    'fanart': 1280,
+}
+
+logger = logging.getLogger(__name__)
+
+def make_thumbnail(data, kind):
+    """Scale an image down to the width the dashboard needs, as JPEG."""
+    if Image is None:
+        return data
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            width = ARTWORK_WIDTHS[kind]
+            if image.width <= width and image.format == 'JPEG':
+                return data
+            image = image.convert('RGB')
+            image.thumbnail((width, width * 10))
+            output = io.BytesIO()
+            image.save(output, 'JPEG', quality=85, optimize=True)
+            return output.getvalue()
+    except Exception as e:
+        logger.warning(f"Could not resize {kind} artwork, caching it as is: {str(e)}")
+        return data
+
+class ArtworkCache:
+    """Series artwork fetched from Sonarr once and kept on disk as thumbnails.
+
+    Each image has a JSON sidecar with its content hash (the ETag served to
+    browsers), Sonarr's validators and the artwork version it was fetched
+    for. A request for a different version refetches the image, and an
+    unversioned copy is revalidated with a conditional GET once it is older
+    than `revalidate_after`. Files are touched on every hit, and the least
+    recently used ones are evicted when the directory exceeds `max_bytes`.
+    """
+
+    def __init__(self, client, directory=ARTWORK_CACHE_DIR, max_bytes=ARTWORK_CACHE_MAX_BYTES,
+                 revalidate_after=ARTWORK_REVALIDATE_SECONDS):
+        self.client = client
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.revalidate_after = revalidate_after
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _paths(self, series_id, kind):
+        base = os.path.join(self.directory, f"{series_id}-{kind}")
+        return f"{base}.jpg", f"{base}.json"
+
+    def _lock_for(self, key):
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _read_meta(self, meta_path):
+        try:
+            with open(meta_path, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, path, data, mode='wb'):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, mode) as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+
+    def _is_fresh(self, meta, version):
+        if version:
+            return meta.get('version') == version
+        return time.time() - meta.get('checked_at', 0) < self.revalidate_after
+
+    def get(self, series_id, kind, version=None):
+        """Return (path, etag) of the cached thumbnail, fetching it if needed, or None."""
+        image_path, meta_path = self._paths(series_id, kind)
+        meta = self._read_meta(meta_path)
+        if meta and os.path.exists(image_path) and self._is_fresh(meta, version):
+            metrics.cache('artwork', True)
+            self._touch(image_path)
+            return image_path, meta['etag']
+
+        metrics.cache('artwork', False)
+        with self._lock_for((series_id, kind)):
+            # Another request may have fetched it while we waited
+            meta = self._read_meta(meta_path)
+            if meta and os.path.exists(image_path) and self._is_fresh(meta, version):
+                return image_path, meta['etag']
+            try:
+                meta = self._fetch(series_id, kind, version, meta if os.path.exists(image_path) else None)
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Could not fetch {kind} for series {series_id}: {str(e)}")
+            if meta and os.path.exists(image_path):
+                return image_path, meta['etag']
+        return None
+
+    def _fetch(self, series_id, kind, version, meta):
+        headers = {}
+        if meta and (not version or meta.get('version') == version):
+            if meta.get('source_etag'):
+                headers['If-None-Match'] = meta['source_etag']
+            if meta.get('source_last_modified'):
+                headers['If-Modified-Since'] = meta['source_last_modified']
+        image_path, meta_path = self._paths(series_id, kind)
+        response = self.client.get(f"mediacover/{series_id}/{kind}.jpg", headers=headers)
+
+        if response.status_code == 304 and meta:
+            meta['checked_at'] = time.time()
+            self._write(meta_path, json.dumps(meta), 'w')
+            return meta
+        if not response.ok:
+            logger.warning(f"Sonarr returned {response.status_code} for {kind} of series {series_id}")
+            return meta
+
+        data = make_thumbnail(response.content, kind)
+        os.makedirs(self.directory, exist_ok=True)
+        self._write(image_path, data)
+        meta = {
+            'etag': hashlib.sha1(data).hexdigest()[:20],
+            'version': version,
+            'source_etag': response.headers.get('ETag'),
+            'source_last_modified': response.headers.get('Last-Modified'),
+            'checked_at': time.time(),
+            'size': len(data),
+        }
+        self._write(meta_path, json.dumps(meta), 'w')
+        logger.debug(f"Cached {kind} for series {series_id}: {len(response.content)} -> {len(data)} bytes")
+        self._evict()
+        return meta
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        try:
+            entries = [(entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                       for entry in os.scandir(self.directory) if entry.name.endswith('.jpg')]
+        except OSError:
+            return
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return
+        # Drop the least recently served images until comfortably under the cap
+        target = self.max_bytes * 0.9
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            for stale_path in (path, path[:-len('.jpg')] + '.json'):
+                try:
+                    os.remove(stale_path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+        logger.info(f"Evicted artwork down to {total / 1024 / 1024:.1f} MB")
+
+artwork_cache = ArtworkCache(sonarr)
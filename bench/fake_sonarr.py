@@ -0,0 +1,349 @@
+"""In-process fake of the Sonarr v3 API endpoints OCDarr uses, for benchmarks.
+
+Libraries are synthetic and deterministic. Episodes are generated per series
+on first access, so a 5k-series library only materializes the shows a
+scenario touches. Every request is counted per endpoint along with the
+response bytes sent.
+"""
+import re
+import json
+import base64
+import threading
+import collections
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+EPISODES_PER_SEASON = 10
+# How long commands take to run
+COMMAND_SECONDS = 1
+# 1x1 JPEG served for every media cover
+COVER_JPEG = base64.b64decode(
+    '/9j/4AAQSkZJRgABAQEASABIAAD/2wBDAP//////////////////////////////////////////////////////////////////////////////////////'
+    'wgALCAABAAEBAREA/8QAFBABAAAAAAAAAAAAAAAAAAAAAP/aAAgBAQABPxA='
+)
+
+def iso(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+class Library:
+    """A synthetic Sonarr library of `size` series with 1-3 seasons each.
+
+    Season 1 is downloaded and monitored; every tenth show has a season
+    premiering within the next few weeks.
+    """
+
+    def __init__(self, size, now=None):
+        self.size = size
+        self.now = now or datetime.now(timezone.utc).replace(microsecond=0)
+        self.lock = threading.Lock()
+        self.series = [self._make_series(series_id) for series_id in range(1, size + 1)]
+        self._episodes = {}
+        self.queue = []
+        self.commands = {}
+        self.tags = []
+
+    def _seasons(self, series_id):
+        return 1 + series_id % 3
+
+    def _premiere(self, series_id):
+        if series_id % 10:
+            return None
+        return self.now + timedelta(days=series_id % 28 + 1, hours=20)
+
+    def _make_series(self, series_id):
+        seasons = self._seasons(series_id)
+        series = {
+            'id': series_id,
+            'title': f"The Show {series_id}" if series_id % 4 == 0 else f"Show {series_id} ({2000 + series_id % 24})",
+            'titleSlug': f"show-{series_id}",
+            'tvdbId': 100000 + series_id,
+            'tmdbId': 200000 + series_id,
+            'imdbId': f"tt{series_id:07d}",
+            'year': 2000 + series_id % 24,
+            'monitored': True,
+            'tags': [],
+            'alternateTitles': [{'title': f"Show Number {series_id}", 'seasonNumber': -1}],
+            'seasons': [{'seasonNumber': n, 'monitored': n == 1} for n in range(1, seasons + 1)],
+            'images': [{'coverType': kind, 'url': f"/MediaCover/{series_id}/{kind}.jpg?lastWrite=63800000000{series_id % 100:02d}"}
+                       for kind in ('poster', 'banner', 'fanart')],
+            'statistics': {'seasonCount': seasons, 'episodeFileCount': EPISODES_PER_SEASON,
+                           'episodeCount': EPISODES_PER_SEASON * seasons, 'sizeOnDisk': EPISODES_PER_SEASON * 1500000000},
+            'added': iso(self.now - timedelta(days=series_id)),
+            'path': f"/tv/Show {series_id}",
+        }
+        premiere = self._premiere(series_id)
+        if premiere:
+            series['nextAiring'] = iso(premiere)
+        return series
+
+    def episodes(self, series_id):
+        """Episodes of a series keyed by ID, generated on first access."""
+        with self.lock:
+            episodes = self._episodes.get(series_id)
+            if episodes is None:
+                episodes = self._episodes[series_id] = self._make_episodes(series_id)
+            return episodes
+
+    def _make_episodes(self, series_id):
+        episodes = {}
+        premiere = self._premiere(series_id)
+        seasons = self._seasons(series_id)
+        for season in range(1, seasons + 1):
+            for number in range(1, EPISODES_PER_SEASON + 1):
+                episode_id = series_id * 1000 + season * 100 + number
+                has_file = season == 1
+                if premiere and season == seasons and season > 1:
+                    air_date = premiere + timedelta(days=7 * (number - 1))
+                else:
+                    air_date = self.now - timedelta(days=400 * (seasons - season + 1) - 7 * number)
+                episodes[episode_id] = {
+                    'id': episode_id,
+                    'seriesId': series_id,
+                    'seasonNumber': season,
+                    'episodeNumber': number,
+                    'title': f"Episode {number}",
+                    'airDateUtc': iso(air_date),
+                    'monitored': season == 1,
+                    'hasFile': has_file,
+                    'episodeFileId': episode_id if has_file else 0,
+                }
+        return episodes
+
+    def command(self, command_id):
+        """A command as Sonarr reports it: queued, then started, then completed a moment later."""
+        command = self.commands.get(command_id)
+        if command is None:
+            return None
+        queued = datetime.fromisoformat(command['queued'].replace('Z', '+00:00'))
+        age = (datetime.now(timezone.utc) - queued).total_seconds()
+        if age >= COMMAND_SECONDS:
+            return dict(command, status='completed', started=iso(queued), ended=iso(queued + timedelta(seconds=COMMAND_SECONDS)))
+        if age >= COMMAND_SECONDS / 2:
+            return dict(command, status='started', started=iso(queued))
+        return command
+
+    def series_by_id(self, series_id):
+        if 1 <= series_id <= self.size:
+            return self.series[series_id - 1]
+        return None
+
+    def file_date(self, file_id):
+        # Newer series have newer imports, so the dashboard always has a clear ordering
+        series_id, rest = divmod(file_id, 1000)
+        return self.now - timedelta(days=self.size - series_id, minutes=100 - rest % 100)
+
+    def files(self, series_id):
+        return [{'id': episode['episodeFileId'], 'seriesId': series_id, 'seasonNumber': episode['seasonNumber'],
+                 'dateAdded': iso(self.file_date(episode['episodeFileId'])), 'size': 1500000000}
+                for episode in self.episodes(series_id).values() if episode['hasFile']]
+
+    def find_episode(self, episode_id):
+        return self.episodes(episode_id // 1000).get(episode_id)
+
+    def delete_file(self, file_id):
+        episode = self.find_episode(file_id)
+        if episode is None or not episode['hasFile']:
+            return False
+        episode['hasFile'] = False
+        episode['episodeFileId'] = 0
+        return True
+
+    def history(self, page, page_size):
+        # Newest imports first: one per series, from the highest series ID down
+        start = (page - 1) * page_size
+        records = []
+        for series_id in range(self.size - start, max(0, self.size - start - page_size), -1):
+            series = self.series_by_id(series_id)
+            episodes = [e for e in self.episodes(series_id).values() if e['hasFile']]
+            if not episodes:
+                continue
+            episode = episodes[-1]
+            records.append({'date': iso(self.file_date(episode['episodeFileId'])), 'eventType': 'downloadFolderImported',
+                            'seriesId': series_id, 'episodeId': episode['id'], 'series': series, 'episode': episode})
+        return {'page': page, 'pageSize': page_size, 'totalRecords': self.size, 'records': records}
+
+    def calendar(self, start, end):
+        records = []
+        for series in self.series:
+            premiere = self._premiere(series['id'])
+            if premiere is None or premiere > end:
+                continue
+            for episode in self.episodes(series['id']).values():
+                air_date = datetime.fromisoformat(episode['airDateUtc'].replace('Z', '+00:00'))
+                if start <= air_date <= end:
+                    records.append(dict(episode, series=series))
+        return records
+
+class FakeSonarr:
+    """Threaded HTTP server answering the Sonarr API from a Library."""
+
+    def __init__(self, library, port=0):
+        self.library = library
+        self.calls = collections.Counter()
+        self.bytes_sent = 0
+        self._stats_lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='fake-sonarr', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.calls.clear()
+            self.bytes_sent = 0
+
+    def stats(self):
+        with self._stats_lock:
+            return {'calls': sum(self.calls.values()), 'bytes': self.bytes_sent,
+                    'by_endpoint': {f"{method} {path}": n for (method, path), n in sorted(self.calls.items())}}
+
+    def _record(self, method, path, size):
+        with self._stats_lock:
+            self.calls[(method, re.sub(r'/\d+', '/{id}', path))] += 1
+            self.bytes_sent += size
+
+    def _handler(self):
+        fake = self
+        library = self.library
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, body, status=200, content_type='application/json', headers=None):
+                if content_type == 'application/json':
+                    body = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                # Counted before writing so a caller that just got its response always sees the call
+                fake._record(self.command, self.path_only, len(body))
+                self.wfile.write(body)
+
+            def _parse(self):
+                parsed = urlparse(self.path)
+                self.path_only = parsed.path.rstrip('/').lower()
+                self.query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                self.body = json.loads(self.rfile.read(length)) if length else None
+                return self.path_only
+
+            def do_GET(self):
+                path = self._parse()
+                query = self.query
+                if path == '/api/v3/series':
+                    return self._send(library.series)
+                match = re.match(r'/api/v3/series/(\d+)$', path)
+                if match:
+                    series = library.series_by_id(int(match[1]))
+                    return self._send(series) if series else self._send({'message': 'NotFound'}, 404)
+                if path == '/api/v3/episode':
+                    series_id = int(query.get('seriesId', 0))
+                    episodes = list(library.episodes(series_id).values()) if library.series_by_id(series_id) else []
+                    if 'seasonNumber' in query:
+                        episodes = [e for e in episodes if e['seasonNumber'] == int(query['seasonNumber'])]
+                    return self._send(episodes)
+                if path == '/api/v3/episodefile':
+                    return self._send(library.files(int(query.get('seriesId', 0))))
+                match = re.match(r'/api/v3/episodefile/(\d+)$', path)
+                if match:
+                    episode = library.find_episode(int(match[1]))
+                    if episode and episode['hasFile']:
+                        return self._send(library.files(episode['seriesId'])[0])
+                    return self._send({'message': 'NotFound'}, 404)
+                if path == '/api/v3/history':
+                    return self._send(library.history(int(query.get('page', 1)), int(query.get('pageSize', 10))))
+                if path == '/api/v3/calendar':
+                    start = datetime.fromisoformat(query['start'].replace('Z', '+00:00')) if 'start' in query else library.now
+                    end = datetime.fromisoformat(query['end'].replace('Z', '+00:00')) if 'end' in query else start + timedelta(days=1)
+                    if start.tzinfo is None:
+                        start = start.replace(tzinfo=timezone.utc)
+                    if end.tzinfo is None:
+                        end = end.replace(tzinfo=timezone.utc)
+                    return self._send(library.calendar(start, end))
+                if path == '/api/v3/queue':
+                    page, page_size = int(query.get('page', 1)), int(query.get('pageSize', 10))
+                    records = library.queue
+                    if 'seriesids' in {k.lower() for k in query}:
+                        series_id = int(query.get('seriesIds') or query.get('seriesids'))
+                        records = [r for r in records if r['seriesId'] == series_id]
+                    return self._send({'page': page, 'pageSize': page_size, 'totalRecords': len(records),
+                                       'records': records[(page - 1) * page_size:page * page_size]})
+                if path == '/api/v3/tag':
+                    return self._send(library.tags)
+                if path == '/api/v3/command':
+                    return self._send([library.command(command_id) for command_id in list(library.commands)])
+                match = re.match(r'/api/v3/command/(\d+)$', path)
+                if match:
+                    command = library.command(int(match[1]))
+                    return self._send(command) if command else self._send({'message': 'NotFound'}, 404)
+                match = re.match(r'/api/v3/mediacover/(\d+)/(\w+)\.jpg$', path)
+                if match:
+                    etag = f'"cover-{match[1]}-{match[2]}"'
+                    if self.headers.get('If-None-Match') == etag:
+                        return self._send(b'', 304, content_type='image/jpeg', headers={'ETag': etag})
+                    return self._send(COVER_JPEG, content_type='image/jpeg', headers={'ETag': etag})
+                self._send({'message': 'NotFound'}, 404)
+
+            def do_PUT(self):
+                path = self._parse()
+                if path == '/api/v3/episode/monitor':
+                    changed = []
+                    for episode_id in self.body['episodeIds']:
+                        episode = library.find_episode(episode_id)
+                        if episode:
+                            episode['monitored'] = self.body['monitored']
+                            changed.append(episode)
+                    return self._send(changed, 202)
+                self._send({'message': 'NotFound'}, 404)
+
+            def do_POST(self):
+                path = self._parse()
+                if path == '/api/v3/command':
+                    with library.lock:
+                        command_id = len(library.commands) + 1
+                        library.commands[command_id] = dict(self.body, id=command_id, status='queued',
+                                                            queued=iso(datetime.now(timezone.utc)), body=self.body)
+                    return self._send(library.commands[command_id], 201)
+                if path == '/api/v3/tag':
+                    with library.lock:
+                        tag = {'id': len(library.tags) + 1, 'label': self.body['label']}
+                        library.tags.append(tag)
+                    return self._send(tag, 201)
+                self._send({'message': 'NotFound'}, 404)
+
+            def do_DELETE(self):
+                path = self._parse()
+                match = re.match(r'/api/v3/episodefile/(\d+)$', path)
+                if match:
+                    return self._send({}) if library.delete_file(int(match[1])) else self._send({'message': 'NotFound'}, 404)
+                if path == '/api/v3/episodefile/bulk':
+                    for file_id in self.body['episodeFileIds']:
+                        library.delete_file(file_id)
+                    return self._send({})
+                match = re.match(r'/api/v3/queue/(\d+)$', path)
+                if match:
+                    library.queue = [r for r in library.queue if r['id'] != int(match[1])]
+                    return self._send({})
+                if path == '/api/v3/queue/bulk':
+                    ids = set(self.body['ids'])
+                    library.queue = [r for r in library.queue if r['id'] not in ids]
+                    return self._send({})
+                self._send({'message': 'NotFound'}, 404)
+
+        return Handler
@@ -0,0 +1,218 @@
+"""Benchmark OCDarr's hot paths against a fake Sonarr with synthetic libraries.
+
+Each library size runs in a fresh subprocess (the app reads its settings at
+import time). Scenarios drive the real Flask app through its test client:
+
+    dashboard_build   build the home page snapshot from Sonarr
+    home              load / and the panel endpoints it fetches
+    webhook           Tautulli watch events through /webhook until the job queue drains
+    jellyfin_webhook  Jellyfin progress events through /jellyfin-webhook
+    sonarr_webhook    SeriesAdd events through /sonarr-webhook
+
+For each scenario the wall time, Sonarr calls, bytes Sonarr sent and peak
+Python memory (tracemalloc) are reported and written to a JSON file.
+
+    python bench/run_benchmarks.py --sizes 100,1000,5000 --output bench_results.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+DEFAULT_SIZES = '100,1000,5000'
+DRAIN_TIMEOUT = 300
+PAGE_URLS = ('/', '/api/current', '/api/upcoming', '/api/series', '/api/missing?page_size=20')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='comma-separated library sizes (series count)')
+    parser.add_argument('--events', type=int, default=20, help='webhook events per webhook scenario')
+    parser.add_argument('--renders', type=int, default=20, help='home page renders')
+    parser.add_argument('--output', default='bench_results.json', help='where to write the JSON results')
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc (faster, no peak memory)')
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Runner:
+    """Runs scenarios against one fake library inside the current process."""
+
+    def __init__(self, size, args):
+        sys.path.insert(0, REPO_DIR)
+        sys.path.insert(0, BENCH_DIR)
+        from fake_sonarr import Library, FakeSonarr
+
+        self.size = size
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix=f"ocdarr-bench-{size}-")
+        self.library = Library(size)
+        self.sonarr = FakeSonarr(self.library).start()
+        os.environ.update({
+            'SONARR_URL': self.sonarr.url,
+            'SONARR_API_KEY': 'bench',
+            'CONFIG_PATH': os.path.join(self.workdir, 'config.json'),
+            'LOG_PATH': os.path.join(self.workdir, 'app.log'),
+            'MISSING_LOG_PATH': os.path.join(self.workdir, 'missing.log'),
+            'METRICS_DIR': os.path.join(self.workdir, 'metrics'),
+            'LOG_TO_STDOUT': 'false',
+            'CLIENT_ONLY': 'false',
+            'SESSION_COALESCE_SECONDS': '0',
+            'JOB_POLL_INTERVAL': '0.05',
+            'DASHBOARD_REFRESH_INTERVAL': '86400',
+            'DASHBOARD_MAX_AGE': '86400',
+            'RECONCILE_INTERVAL': '0',
+        })
+        import webhook_listener
+        import tag_sync
+        self.app = webhook_listener
+        self.client = webhook_listener.app.test_client()
+        # Let the startup tag sync finish so it is not billed to the first scenario
+        tag_sync.elected_sync(wait=True)
+
+    def wait_for_idle(self):
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while time.monotonic() < deadline:
+            # Coalescing triggers are queued jobs, so the job depth covers them
+            if self.app.jobs.stats()['depth'] == 0 and not self.app.dashboard.status()['refreshing']:
+                return
+            time.sleep(0.02)
+        raise TimeoutError('Job queue did not drain')
+
+    def finished_jobs(self):
+        stats = self.app.jobs.stats()
+        return stats['done'] + stats['failed']
+
+    def wait_for_jobs(self, finished_before, count):
+        """Wait until `count` more jobs have finished, then for the app to go idle."""
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while self.finished_jobs() < finished_before + count:
+            if time.monotonic() > deadline:
+                raise TimeoutError('Jobs did not finish')
+            time.sleep(0.02)
+        self.wait_for_idle()
+
+    def measure(self, name, scenario, operations=1):
+        self.wait_for_idle()
+        self.sonarr.reset_stats()
+        if not self.args.no_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        scenario()
+        elapsed = time.perf_counter() - started
+        peak = None
+        if not self.args.no_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        sonarr = self.sonarr.stats()
+        result = {
+            'wall_seconds': round(elapsed, 4),
+            'operations': operations,
+            'seconds_per_operation': round(elapsed / operations, 5),
+            'sonarr_calls': sonarr['calls'],
+            'sonarr_calls_per_operation': round(sonarr['calls'] / operations, 2),
+            'sonarr_bytes': sonarr['bytes'],
+            'peak_memory_bytes': peak,
+            'sonarr_calls_by_endpoint': sonarr['by_endpoint'],
+        }
+        print(f"  {name:<18} {elapsed:8.3f}s  {sonarr['calls']:6d} calls  {sonarr['bytes'] / 1e6:8.2f} MB"
+              + (f"  peak {peak / 1e6:7.1f} MB" if peak is not None else ''), file=sys.stderr)
+        return result
+
+    def event_series(self):
+        step = max(1, self.size // self.args.events)
+        return [self.library.series_by_id(series_id) for series_id in range(1, self.size + 1, step)][:self.args.events]
+
+    def dashboard_build(self):
+        self.app.dashboard.refresh()
+
+    def home(self):
+        # A full page load: the shell plus every panel it fetches
+        for _ in range(self.args.renders):
+            for url in PAGE_URLS:
+                response = self.client.get(url)
+                assert response.status_code == 200, (url, response.status_code)
+
+    def webhook(self):
+        finished = self.finished_jobs()
+        events = self.event_series()
+        for series in events:
+            response = self.client.post('/webhook', json={
+                'plex_title': series['title'], 'plex_season_num': '1', 'plex_ep_num': '3', 'plex_user': 'bench'})
+            assert response.status_code == 202, response.status_code
+        self.wait_for_jobs(finished, len(events))
+
+    def jellyfin_webhook(self):
+        finished = self.finished_jobs()
+        events = self.event_series()
+        for series in events:
+            response = self.client.post('/jellyfin-webhook', json={
+                'NotificationType': 'PlaybackProgress', 'SeriesName': series['title'],
+                'SeasonNumber': 1, 'EpisodeNumber': 5, 'NotificationUsername': 'bench',
+                'PlaybackPositionTicks': 50, 'RunTimeTicks': 100})
+            assert response.status_code == 202, response.status_code
+        self.wait_for_jobs(finished, len(events))
+
+    def sonarr_webhook(self):
+        finished = self.finished_jobs()
+        events = self.event_series()
+        for series in events:
+            response = self.client.post('/sonarr-webhook', json={'eventType': 'SeriesAdd', 'series': series})
+            assert response.status_code == 202, response.status_code
+        self.wait_for_jobs(finished, len(events))
+
+    def run(self):
+        print(f"Library of {self.size} series", file=sys.stderr)
+        events = len(self.event_series())
+        return {
+            'dashboard_build': self.measure('dashboard_build', self.dashboard_build),
+            'home': self.measure('home', self.home, self.args.renders),
+            'webhook': self.measure('webhook', self.webhook, events),
+            'jellyfin_webhook': self.measure('jellyfin_webhook', self.jellyfin_webhook, events),
+            'sonarr_webhook': self.measure('sonarr_webhook', self.sonarr_webhook, events),
+        }
+
+def run_size(size, args):
+    """Benchmark one library size in a subprocess and return its results."""
+    command = [sys.executable, os.path.abspath(__file__), '--size', str(size),
+               '--events', str(args.events), '--renders', str(args.renders)]
+    if args.no_memory:
+        command.append('--no-memory')
+    completed = subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True)
+    return json.loads(completed.stdout)
+
+def main():
+    args = parse_args()
+    if args.size:
+        # Child process: run one library size and report on stdout
+        json.dump(Runner(args.size, args).run(), sys.stdout)
+        return
+
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    results = {
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'events': args.events,
+        'renders': args.renders,
+        'results': {str(size): run_size(size, args) for size in sizes},
+    }
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"Wrote {args.output}", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
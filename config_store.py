@@ -0,0 +1,271 @@
+import os
+import copy
+import json
+import time
+import logging
+import threading
+import db
+from metrics import metrics
+
+CONFIG_PATH = os.getenv('CONFIG_PATH', '/app/config/config.json')
+CONFIG_VERSION_PATH = os.path.join(os.path.dirname(CONFIG_PATH), '.config.version')
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS series_rules (
+    series_id TEXT PRIMARY KEY,
+    rule_name TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS series_rules_rule_name ON series_rules (rule_name);
+CREATE TABLE IF NOT EXISTS config_meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+'''
+
+DEFAULT_CONFIG = {
+    'rules': {
+        '1n1': {
+            'get_option': '1',
+            'action_option': 'search',
+            'keep_watched': '1',
+            'monitor_watched': False,
+            'series': []
+        }
+    },
+    'default_rule': '1n1'
+}
+
+class ConfigConflict(Exception):
+    """Raised when saving a config copy that was loaded before someone else's change."""
+
+class SettingsStore:
+    """Transactional storage behind the config: rules in config.json, assignments in SQLite.
+
+    Every change runs inside one SQLite write transaction, which serializes
+    writers across gunicorn workers, and bumps a single version counter.
+    Rules are written to config.json with an atomic replace, so readers
+    never see a half-written file, and a save is refused with
+    ConfigConflict when the version it was loaded at is no longer current.
+    Series assignments are one row per series, so assigning a rule only
+    touches the series submitted. After each commit the new version is
+    written to a small file whose stat() is all other workers poll.
+    """
+
+    def __init__(self, path=CONFIG_PATH, version_path=CONFIG_VERSION_PATH, db_path=None):
+        self.path = path
+        self.version_path = version_path
+        self.store = db.Store(SCHEMA, db_path, migrate=self._migrate)
+
+    def _migrate(self, conn):
+        # Older versions kept assignments as per-rule 'series' lists in config.json
+        if conn.execute("SELECT 1 FROM config_meta WHERE key = 'assignments_migrated'").fetchone():
+            return
+        config = read_config_file(self.path)
+        now = time.time()
+        rows = [(str(series_id), rule_name, now)
+                for rule_name, details in config['rules'].items() for series_id in details.get('series', [])]
+        conn.executemany('INSERT OR IGNORE INTO series_rules (series_id, rule_name, updated_at) VALUES (?, ?, ?)', rows)
+        conn.execute("INSERT INTO config_meta (key, value) VALUES ('assignments_migrated', 1)")
+        conn.execute("INSERT OR IGNORE INTO config_meta (key, value) VALUES ('version', ?)", (config.get('version', 0),))
+        if rows:
+            logger.info(f"Moved {len(rows)} series rule assignments from config.json into the database")
+
+    def _version(self, conn):
+        row = conn.execute("SELECT value FROM config_meta WHERE key = 'version'").fetchone()
+        return row['value'] if row else 0
+
+    def _bump(self, conn):
+        version = self._version(conn) + 1
+        conn.execute("INSERT OR REPLACE INTO config_meta (key, value) VALUES ('version', ?)", (version,))
+        return version
+
+    def _publish(self, version):
+        write_atomic(self.version_path, str(version))
+
+    def read(self):
+        """(version, {series_id: rule_name}) as of one consistent snapshot."""
+        conn = self.store.connect()
+        try:
+            conn.execute('BEGIN')
+            version = self._version(conn)
+            assignments = {row['series_id']: row['rule_name']
+                           for row in conn.execute('SELECT series_id, rule_name FROM series_rules')}
+            conn.execute('COMMIT')
+            return version, assignments
+        finally:
+            conn.close()
+
+    def save(self, config, delete_rules=()):
+        """Write rules and settings, failing with ConfigConflict if the config moved on.
+
+        Assignments are not saved from the config; those of rules in
+        `delete_rules` are dropped in the same transaction.
+        """
+        with self.store.transaction() as conn:
+            current = self._version(conn)
+            if config.get('version', current) != current:
+                raise ConfigConflict(f"Config is at version {current}, this copy was loaded at {config.get('version')}")
+            version = self._bump(conn)
+            document = {key: value for key, value in config.items() if key != 'rules'}
+            document['rules'] = {rule_name: {key: value for key, value in details.items() if key != 'series'}
+                                 for rule_name, details in config['rules'].items()}
+            document['version'] = version
+            write_atomic(self.path, json.dumps(document, indent=4))
+            for rule_name in delete_rules:
+                conn.execute('DELETE FROM series_rules WHERE rule_name = ?', (rule_name,))
+        self._publish(version)
+        return version
+
+    def assign(self, series_ids, rule_name=None):
+        """Assign series to a rule, or unassign them when rule_name is None."""
+        now = time.time()
+        series_ids = [str(series_id) for series_id in series_ids]
+        with self.store.transaction() as conn:
+            if rule_name:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO series_rules (series_id, rule_name, updated_at) VALUES (?, ?, ?)',
+                    [(series_id, rule_name, now) for series_id in series_ids])
+            else:
+                conn.executemany('DELETE FROM series_rules WHERE series_id = ?', [(series_id,) for series_id in series_ids])
+            version = self._bump(conn)
+        self._publish(version)
+        return version
+
+def write_atomic(path, text):
+    """Replace a file's contents so readers see either the old or the new version."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as file:
+        file.write(text)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+def read_config_file(path):
+    try:
+        with open(path, 'r') as file:
+            config = json.load(file)
+    except FileNotFoundError:
+        config = copy.deepcopy(DEFAULT_CONFIG)
+    if 'rules' not in config:
+        config['rules'] = {}
+    if 'default_rule' not in config:
+        config['default_rule'] = '1n1'
+    return config
+
+class ConfigCache:
+    """Parsed config plus lookup indexes, reloaded only when something changes.
+
+    Every access costs two stat() calls: config.json and the version file
+    the settings store rewrites after each change. When either changes
+    (an edit by another gunicorn worker or by hand) the file is re-parsed,
+    the rules' series lists are filled in from the assignments table and
+    the indexes are rebuilt.
+    """
+
+    def __init__(self, path=CONFIG_PATH, store=None):
+        self.path = path
+        self.store = store or SettingsStore(path)
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._config = None
+        self._series_rules = {}
+        self._tag_rules = {}
+
+    def _file_stamp(self):
+        stamp = []
+        for path in (self.path, self.store.version_path):
+            try:
+                st = os.stat(path)
+                stamp.append((st.st_mtime_ns, st.st_size, st.st_ino))
+            except FileNotFoundError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def _read(self):
+        config = read_config_file(self.path)
+        version, assignments = self.store.read()
+        config['version'] = version
+        for details in config['rules'].values():
+            details['series'] = []
+        for series_id, rule_name in assignments.items():
+            if rule_name in config['rules']:
+                config['rules'][rule_name]['series'].append(series_id)
+        return config
+
+    def _build_indexes(self, config):
+        series_rules = {}
+        for rule_name, details in config['rules'].items():
+            for series_id in details.get('series', []):
+                series_rules[str(series_id)] = rule_name
+        tag_rules = {rule_name.lower(): rule_name for rule_name in config['rules']}
+        return series_rules, tag_rules
+
+    def _current(self):
+        stamp = self._file_stamp()
+        if self._config is not None and stamp == self._stamp:
+            metrics.cache('config', True)
+            return self._config
+        metrics.cache('config', False)
+        with self._lock:
+            if self._config is None or stamp != self._stamp:
+                config = self._read()
+                self._series_rules, self._tag_rules = self._build_indexes(config)
+                self._config = config
+                self._stamp = stamp
+                logger.debug(f"Loaded config version {config.get('version', 0)}")
+            return self._config
+
+    def get(self):
+        """Shared parsed config. Treat as read-only; use load_config() to edit."""
+        return self._current()
+
+    def invalidate(self):
+        with self._lock:
+            self._stamp = None
+            self._config = None
+
+    def series_rule_index(self):
+        """Mapping of str(series_id) to assigned rule name."""
+        self._current()
+        return self._series_rules
+
+    def rule_name_for_series(self, series_id):
+        config = self._current()
+        return self._series_rules.get(str(series_id), config.get('default_rule', '1n1'))
+
+    def rule_for_series(self, series_id):
+        """(rule_name, rule) assigned to a series, falling back to the default rule."""
+        config = self._current()
+        rule_name = self.rule_name_for_series(series_id)
+        return rule_name, config['rules'].get(rule_name)
+
+    def rule_for_tags(self, tags):
+        """(rule_name, rule) for the first tag that names a rule, else the default rule."""
+        config = self._current()
+        for tag in tags:
+            rule_name = self._tag_rules.get(str(tag).lower())
+            if rule_name:
+                return rule_name, config['rules'][rule_name]
+        default_rule = config.get('default_rule', '1n1')
+        return default_rule, config['rules'].get(default_rule)
+
+settings_store = SettingsStore()
+config_cache = ConfigCache(store=settings_store)
+
+def load_config():
+    """Return a private copy of the config that callers may modify and save."""
+    return copy.deepcopy(config_cache.get())
+
+def save_config(config, delete_rules=()):
+    """Save rules and settings from a load_config() copy; raises ConfigConflict if it is stale."""
+    config['version'] = settings_store.save(config, delete_rules)
+    config_cache.invalidate()
+
+def assign_series(series_ids, rule_name=None):
+    """Assign series to a rule (or unassign them), touching only their rows."""
+    settings_store.assign(series_ids, rule_name)
+    config_cache.invalidate()
@@ -0,0 +1,116 @@
+import os
+import time
+import logging
+import threading
+from metrics import metrics
+
+DASHBOARD_REFRESH_INTERVAL = int(os.getenv('DASHBOARD_REFRESH_INTERVAL', '0'))
+DASHBOARD_MAX_AGE = int(os.getenv('DASHBOARD_MAX_AGE', '60'))
+
+logger = logging.getLogger(__name__)
+
+class SnapshotStore:
+    """Holds the last computed dashboard data and rebuilds it off the request path.
+
+    Readers always get the latest snapshot immediately. A rebuild is started
+    in a background thread when the snapshot is older than `max_age` or when
+    requested after a relevant Sonarr event, and also every
+    `refresh_interval` seconds if that is set. Every gunicorn worker keeps
+    its own snapshot, so with no interval an idle dashboard costs Sonarr
+    nothing. Only one rebuild runs at a time; requests made during a
+    rebuild schedule one more.
+    """
+
+    def __init__(self, builder, max_age=DASHBOARD_MAX_AGE, refresh_interval=DASHBOARD_REFRESH_INTERVAL):
+        self.builder = builder
+        self.max_age = max_age
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._data = None
+        self._refreshed_at = None
+        self._refresh_duration = None
+        self._last_error = None
+        self._refreshing = False
+        self._pending = False
+        self._thread = None
+
+    def age(self):
+        if self._refreshed_at is None:
+            return None
+        return time.time() - self._refreshed_at
+
+    def is_stale(self):
+        age = self.age()
+        return age is None or age > self.max_age
+
+    def status(self):
+        age = self.age()
+        return {
+            'ready': self._data is not None,
+            'age_seconds': round(age, 1) if age is not None else None,
+            'refreshed_at': self._refreshed_at,
+            'refresh_duration_seconds': round(self._refresh_duration, 3) if self._refresh_duration is not None else None,
+            'refreshing': self._refreshing,
+            'last_error': self._last_error
+        }
+
+    def get(self):
+        """Return the last snapshot (None before the first build), revalidating if stale."""
+        self._start()
+        stale = self.is_stale()
+        metrics.cache('dashboard_snapshot', not stale)
+        if stale and not self._refreshing:
+            self.refresh_async('stale')
+        return self._data
+
+    def refresh_async(self, reason='requested'):
+        """Ask the background thread to rebuild the snapshot soon."""
+        self._start()
+        with self._lock:
+            if self._refreshing:
+                self._pending = True
+                return
+        logger.debug(f"Dashboard snapshot refresh requested: {reason}")
+        self._wakeup.set()
+
+    def refresh(self):
+        """Rebuild the snapshot in the calling thread."""
+        with self._lock:
+            if self._refreshing:
+                self._pending = True
+                return
+            self._refreshing = True
+        started = time.monotonic()
+        try:
+            data = self.builder()
+            with self._lock:
+                self._data = data
+                self._refreshed_at = time.time()
+                self._last_error = None
+        except Exception as e:
+            logger.error(f"Failed to refresh dashboard snapshot: {str(e)}")
+            self._last_error = str(e)
+        finally:
+            self._refresh_duration = time.monotonic() - started
+            with self._lock:
+                self._refreshing = False
+                if self._pending:
+                    self._pending = False
+                    self._wakeup.set()
+        logger.info(f"Dashboard snapshot refreshed in {self._refresh_duration:.2f}s")
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='dashboard-snapshot', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.refresh_interval or None)
+            self._wakeup.clear()
+            self.refresh()
@@ -0,0 +1,68 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+CONFIG_PATH = os.getenv('CONFIG_PATH', '/app/config/config.json')
+DB_PATH = os.getenv('OCDARR_DB_PATH', os.path.join(os.path.dirname(CONFIG_PATH), 'ocdarr.db'))
+
+def connect(path=None):
+    """Open the shared OCDarr SQLite database (WAL, so workers can read while one writes)."""
+    conn = sqlite3.connect(path or DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA busy_timeout=30000')
+    return conn
+
+@contextmanager
+def transaction(path=None, immediate=True):
+    """Yield a connection inside a transaction that commits on success and rolls back on error."""
+    conn = connect(path)
+    try:
+        conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+        yield conn
+        conn.execute('COMMIT')
+    except Exception:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+class Store:
+    """The tables one component keeps in the shared database, created on first use.
+
+    `migrate(conn)`, when given, runs in the same transaction as `schema`
+    to bring tables created by older versions up to date.
+    """
+
+    def __init__(self, schema, path=None, migrate=None):
+        self.schema = schema
+        self.path = path
+        self.migrate = migrate
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def _initialize(self):
+        with self._lock:
+            if self._initialized:
+                return
+            with transaction(self.path) as conn:
+                # executescript() would commit, and the migration must share the transaction
+                for statement in self.schema.split(';'):
+                    if statement.strip():
+                        conn.execute(statement)
+                if self.migrate:
+                    self.migrate(conn)
+            self._initialized = True
+
+    def connect(self):
+        if not self._initialized:
+            self._initialize()
+        return connect(self.path)
+
+    def transaction(self, immediate=True):
+        if not self._initialized:
+            self._initialize()
+        return transaction(self.path, immediate)
@@ -0,0 +1,264 @@
+import os
+import json
+import time
+import random
+import socket
+import logging
+import threading
+import db
+from metrics import metrics
+from logging_config import correlation_id, log_context
+
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '8'))
+JOB_RETRY_BACKOFF = float(os.getenv('JOB_RETRY_BACKOFF', '30'))
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', '600'))
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '2'))
+JOB_RETENTION_DAYS = int(os.getenv('JOB_RETENTION_DAYS', '7'))
+
+# Background work such as reconciliation waits behind webhook jobs
+PRIORITY_WEBHOOK = 0
+PRIORITY_BACKGROUND = 1
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    series_key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_at REAL NOT NULL,
+    lease_until REAL,
+    worker TEXT,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    finished_at REAL,
+    priority INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_status_run_at ON jobs (status, run_at);
+CREATE INDEX IF NOT EXISTS jobs_series_key ON jobs (series_key, status);
+'''
+
+# A job is runnable when it is due (or its lease expired) and no earlier job
+# for the same series is still waiting or running. Lower priorities go first.
+CLAIM_SQL = '''
+SELECT j.* FROM jobs j
+WHERE ((j.status = 'pending' AND j.run_at <= :now)
+       OR (j.status = 'running' AND j.lease_until < :now))
+  AND NOT EXISTS (
+      SELECT 1 FROM jobs e
+      WHERE e.series_key = j.series_key AND e.id < j.id AND e.status IN ('pending', 'running'))
+  AND NOT EXISTS (
+      SELECT 1 FROM jobs r
+      WHERE r.series_key = j.series_key AND r.id != j.id
+        AND r.status = 'running' AND r.lease_until >= :now)
+ORDER BY j.priority, j.run_at, j.id
+LIMIT 1
+'''
+
+class RetryLater(Exception):
+    """Raised by a job handler to retry no sooner than `delay` seconds from now."""
+
+    def __init__(self, message, delay=0):
+        super().__init__(message)
+        self.delay = delay
+
+class JobQueue:
+    """SQLite-backed job journal drained by worker threads in every gunicorn worker.
+
+    Jobs are delivered at least once: a job stays in the journal until its
+    handler returns, failed jobs are retried with exponential backoff, and
+    jobs whose worker died are picked up again when their lease runs out.
+    Jobs sharing a series_key run one at a time in the order they were
+    queued; different series run in parallel.
+    """
+
+    def __init__(self, handlers, workers=2, db_path=None):
+        self.handlers = handlers
+        self.workers = workers
+        self.store = db.Store(SCHEMA, db_path, migrate=self._migrate)
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _migrate(self, conn):
+        # Journals created before jobs had priorities
+        if 'priority' not in {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}:
+            conn.execute('ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0')
+
+    def enqueue(self, kind, payload, series_key, delay=0, merge=None, priority=PRIORITY_WEBHOOK):
+        """Append a job to the journal and wake a local worker.
+
+        The job runs no sooner than `delay` seconds from now. With `merge`,
+        jobs of the same kind and series_key that have not been tried yet
+        are offered the new payload first: merge(queued_payload, payload)
+        returns the payload the queued job should carry, or None to leave
+        it alone. A job that takes a new payload starts its delay over.
+        Due jobs with a lower `priority` are claimed first.
+        Returns the ID of the job that will carry the payload.
+        """
+        now = time.time()
+        if isinstance(payload, dict) and correlation_id.get() and 'correlation_id' not in payload:
+            # Lets the job's log lines be matched to the webhook that queued it
+            payload = dict(payload, correlation_id=correlation_id.get())
+        job_id = None
+        with self.store.transaction() as conn:
+            if merge is not None:
+                queued = conn.execute(
+                    "SELECT id, payload FROM jobs WHERE kind = ? AND series_key = ? AND status = 'pending' AND attempts = 0 "
+                    "ORDER BY id", (kind, series_key)).fetchall()
+                for row in queued:
+                    queued_payload = json.loads(row['payload'])
+                    merged = merge(queued_payload, payload)
+                    if merged is None:
+                        continue
+                    if merged != queued_payload:
+                        conn.execute('UPDATE jobs SET payload = ?, run_at = ? WHERE id = ?',
+                                     (json.dumps(merged), now + delay, row['id']))
+                    job_id = row['id']
+                    break
+            if job_id is None:
+                cursor = conn.execute(
+                    'INSERT INTO jobs (kind, series_key, payload, run_at, created_at, priority) VALUES (?, ?, ?, ?, ?, ?)',
+                    (kind, series_key, json.dumps(payload), now + delay, now, priority)
+                )
+                job_id = cursor.lastrowid
+                logger.info(f"Queued {kind} job {job_id} for {series_key}")
+        self._wakeup.set()
+        return job_id
+
+    def claim(self, worker_id):
+        """Lease the next runnable job to `worker_id`, or return None."""
+        now = time.time()
+        conn = self.store.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(CLAIM_SQL, {'now': now}).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?, worker = ? WHERE id = ?",
+                (now + JOB_LEASE_SECONDS, worker_id, row['id'])
+            )
+            conn.execute('COMMIT')
+            job = dict(row)
+            job['attempts'] += 1
+            job['payload'] = json.loads(job['payload'])
+            return job
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def complete(self, job_id):
+        conn = self.store.connect()
+        try:
+            conn.execute("UPDATE jobs SET status = 'done', finished_at = ?, lease_until = NULL WHERE id = ?",
+                         (time.time(), job_id))
+        finally:
+            conn.close()
+
+    def fail(self, job, error, delay=0):
+        """Schedule a retry with jittered exponential backoff, or give up after JOB_MAX_ATTEMPTS."""
+        now = time.time()
+        conn = self.store.connect()
+        try:
+            if job['attempts'] >= JOB_MAX_ATTEMPTS:
+                conn.execute("UPDATE jobs SET status = 'failed', last_error = ?, finished_at = ?, lease_until = NULL WHERE id = ?",
+                             (error, now, job['id']))
+                logger.error(f"Job {job['id']} ({job['kind']}) failed permanently after {job['attempts']} attempts: {error}")
+                return
+            backoff = JOB_RETRY_BACKOFF * (2 ** (job['attempts'] - 1))
+            run_at = now + max(delay, random.uniform(backoff / 2, backoff))
+            conn.execute("UPDATE jobs SET status = 'pending', last_error = ?, run_at = ?, lease_until = NULL WHERE id = ?",
+                         (error, run_at, job['id']))
+            logger.warning(f"Job {job['id']} ({job['kind']}) failed, retrying in {run_at - now:.0f}s: {error}")
+        finally:
+            conn.close()
+
+    def run_job(self, job):
+        handler = self.handlers.get(job['kind'])
+        if handler is None:
+            self.fail(dict(job, attempts=JOB_MAX_ATTEMPTS), f"No handler for job kind {job['kind']}")
+            return
+        payload = job['payload']
+        cid = payload.get('correlation_id') if isinstance(payload, dict) else None
+        try:
+            with log_context(cid or f"job-{job['id']}"), metrics.count_sonarr_calls(job['kind']), \
+                    metrics.timer('ocdarr_stage_duration_seconds', stage=f"job_{job['kind']}"):
+                handler(job['payload'])
+        except RetryLater as e:
+            self.fail(job, str(e), e.delay)
+        except Exception as e:
+            self.fail(job, str(e))
+        else:
+            self.complete(job['id'])
+
+    def _work(self, worker_id):
+        while True:
+            try:
+                job = self.claim(worker_id)
+            except Exception as e:
+                logger.error(f"Job queue claim failed: {str(e)}")
+                job = None
+            if job is None:
+                self._wakeup.wait(JOB_POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+            self.run_job(job)
+
+    def start(self):
+        """Start the worker threads for this process (idempotent)."""
+        with self._lock:
+            if self._threads:
+                return
+            self.purge()
+            prefix = f"{socket.gethostname()}:{os.getpid()}"
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, args=(f"{prefix}:{i}",), name=f'job-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def purge(self):
+        """Drop finished jobs older than JOB_RETENTION_DAYS."""
+        cutoff = time.time() - JOB_RETENTION_DAYS * 86400
+        conn = self.store.connect()
+        try:
+            conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?", (cutoff,))
+        finally:
+            conn.close()
+
+    def stats(self):
+        """Queue depth, lag and recent failures for the admin endpoint."""
+        now = time.time()
+        conn = self.store.connect()
+        try:
+            counts = {row['status']: row['n'] for row in
+                      conn.execute('SELECT status, COUNT(*) AS n FROM jobs GROUP BY status')}
+            oldest = conn.execute(
+                "SELECT MIN(created_at) AS oldest, MIN(run_at) AS next_run FROM jobs WHERE status IN ('pending', 'running')"
+            ).fetchone()
+            series = conn.execute(
+                "SELECT COUNT(DISTINCT series_key) AS n FROM jobs WHERE status IN ('pending', 'running')"
+            ).fetchone()['n']
+            failures = [dict(row) for row in conn.execute(
+                "SELECT id, kind, series_key, attempts, last_error, created_at FROM jobs "
+                "WHERE last_error IS NOT NULL AND status != 'done' ORDER BY id DESC LIMIT 20")]
+        finally:
+            conn.close()
+        return {
+            'depth': counts.get('pending', 0) + counts.get('running', 0),
+            'pending': counts.get('pending', 0),
+            'running': counts.get('running', 0),
+            'done': counts.get('done', 0),
+            'failed': counts.get('failed', 0),
+            'series_with_work': series,
+            'lag_seconds': round(now - oldest['oldest'], 1) if oldest['oldest'] else 0,
+            'next_run_in_seconds': round(max(0, oldest['next_run'] - now), 1) if oldest['next_run'] else None,
+            'recent_failures': failures
+        }
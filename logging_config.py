@@ -0,0 +1,175 @@
+import os
+import re
+import json
+import time
+import uuid
+import queue
+import fcntl
+import atexit
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+LOG_PATH = os.getenv('LOG_PATH', '/app/logs/app.log')
+MISSING_LOG_PATH = os.getenv('MISSING_LOG_PATH', '/app/logs/missing.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN', 'midnight')
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '7'))
+LOG_TO_STDOUT = os.getenv('LOG_TO_STDOUT', 'true').lower() == 'true'
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+correlation_id = contextvars.ContextVar('correlation_id', default=None)
+
+_lock = threading.Lock()
+_listener = None
+
+def new_correlation_id():
+    return uuid.uuid4().hex[:12]
+
+@contextmanager
+def log_context(cid=None):
+    """Tag every log record made in the enclosed block with a correlation ID."""
+    token = correlation_id.set(cid or new_correlation_id())
+    try:
+        yield correlation_id.get()
+    finally:
+        correlation_id.reset(token)
+
+class CorrelationFilter(logging.Filter):
+    """Stamps records with the current correlation ID in the thread that logged them."""
+
+    def filter(self, record):
+        if not hasattr(record, 'correlation_id'):
+            record.correlation_id = correlation_id.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'pid': record.process,
+        }
+        if getattr(record, 'correlation_id', None):
+            entry['correlation_id'] = record.correlation_id
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        message = super().format(record)
+        cid = getattr(record, 'correlation_id', None)
+        return f"{message} [{cid}]" if cid else message
+
+class RotatingLogHandler(TimedRotatingFileHandler):
+    """Rotates on a schedule or when the file passes max_bytes, whichever comes first.
+
+    Every gunicorn worker writes to the same file, so rollover is taken
+    under a lock file and a worker that finds the file already rotated by
+    another one just reopens it.
+    """
+
+    def __init__(self, filename, max_bytes=LOG_MAX_BYTES, when=LOG_ROTATE_WHEN, backup_count=LOG_BACKUP_COUNT):
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        super().__init__(filename, when=when, backupCount=backup_count, delay=True)
+        self.max_bytes = max_bytes
+        # Size-based rollovers can happen several times per period, so backups are named to the second
+        self.suffix = '%Y-%m-%d_%H-%M-%S'
+        self.extMatch = re.compile(r'^\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}(\.\d+)?$', re.ASCII)
+        self.lock_path = os.path.join(os.path.dirname(self.baseFilename), f".{os.path.basename(self.baseFilename)}.lock")
+
+    def _rotated_elsewhere(self):
+        if self.stream is None:
+            return False
+        try:
+            return os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def _reopen(self):
+        self.stream.close()
+        self.stream = self._open()
+        self.rolloverAt = self.computeRollover(int(time.time()))
+
+    def shouldRollover(self, record):
+        if self._rotated_elsewhere():
+            self._reopen()
+            return False
+        if self.max_bytes and self.stream is not None and self.stream.tell() >= self.max_bytes:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        with open(self.lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if self._rotated_elsewhere():
+                    self._reopen()
+                    return
+                if self.stream is not None:
+                    self.stream.close()
+                    self.stream = None
+                destination = self.rotation_filename(f"{self.baseFilename}.{time.strftime(self.suffix)}")
+                candidate, n = destination, 0
+                while os.path.exists(candidate):
+                    n += 1
+                    candidate = f"{destination}.{n}"
+                if os.path.exists(self.baseFilename):
+                    self.rotate(self.baseFilename, candidate)
+                if self.backupCount > 0:
+                    for old_file in self.getFilesToDelete():
+                        os.remove(old_file)
+                self.stream = self._open()
+                self.rolloverAt = self.computeRollover(int(time.time()))
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def make_formatter():
+    return JsonFormatter() if LOG_FORMAT == 'json' else TextFormatter(TEXT_FORMAT)
+
+def configure_logging():
+    """Route all logging through one queue drained by a background listener (idempotent).
+
+    Callers only enqueue records; the listener thread does the formatting,
+    file writes and rotation, so request threads never wait on disk.
+    """
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return
+        formatter = make_formatter()
+        handlers = [RotatingLogHandler(LOG_PATH)]
+        if LOG_TO_STDOUT:
+            handlers.append(logging.StreamHandler())
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        missing_handler = RotatingLogHandler(MISSING_LOG_PATH)
+        missing_handler.setFormatter(formatter)
+        # Only records from the 'missing' logger go to missing.log
+        missing_handler.addFilter(logging.Filter('missing'))
+        handlers.append(missing_handler)
+
+        log_queue = queue.SimpleQueue()
+        queue_handler = QueueHandler(log_queue)
+        queue_handler.addFilter(CorrelationFilter())
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(queue_handler)
+        root.setLevel(LOG_LEVEL)
+
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
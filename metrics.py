@@ -0,0 +1,222 @@
+import os
+import re
+import glob
+import json
+import time
+import logging
+import threading
+import tempfile
+from contextlib import contextmanager
+
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'ocdarr-metrics'))
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '10'))
+METRICS_RETENTION = int(os.getenv('METRICS_RETENTION', '86400'))
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+# name: (type, help, buckets)
+METRICS = {
+    'ocdarr_http_requests_total': ('counter', 'HTTP requests handled, by route, method and status.', None),
+    'ocdarr_http_request_duration_seconds': ('histogram', 'HTTP request latency by route.', LATENCY_BUCKETS),
+    'ocdarr_sonarr_requests_total': ('counter', 'Sonarr API calls by endpoint, method and status (error for connection failures).', None),
+    'ocdarr_sonarr_request_duration_seconds': ('histogram', 'Sonarr API call latency by endpoint and method.', LATENCY_BUCKETS),
+    'ocdarr_stage_duration_seconds': ('histogram', 'Time spent in each stage of rule processing and dashboard builds.', LATENCY_BUCKETS),
+    'ocdarr_event_sonarr_calls': ('histogram', 'Sonarr API calls made while processing one job, by job kind.', COUNT_BUCKETS),
+    'ocdarr_cache_requests_total': ('counter', 'Cache lookups by cache and result (hit or miss).', None),
+    'ocdarr_reconcile_series_total': ('counter', 'Series checked by library reconciliation, by outcome.', None),
+    'ocdarr_search_requests_total': ('counter', 'Episode searches requested, by outcome (queued or duplicate).', None),
+    'ocdarr_search_commands_total': ('counter', 'Search commands sent to Sonarr and how they ended, by status.', None),
+    'ocdarr_search_queries_total': ('counter', 'Indexer queries spent on sent search commands, by command name.', None),
+    'ocdarr_search_command_duration_seconds': ('histogram', 'How long Sonarr took to run a search command.', LATENCY_BUCKETS),
+}
+
+_ENDPOINT_ID = re.compile(r'/\d+(?=/|$)')
+
+def sonarr_endpoint(path):
+    """Low-cardinality label for a Sonarr API path, e.g. 'episode/12' -> 'episode/{id}'."""
+    return _ENDPOINT_ID.sub('/{id}', '/' + path.split('?')[0].strip('/').lower())[1:]
+
+class Registry:
+    """Metrics recorded by this process, flushed to a per-process file in METRICS_DIR.
+
+    Every gunicorn worker writes its own file and /metrics merges all of
+    them, so the scrape reports totals for the deployment whichever worker
+    serves it. Files of exited workers are kept (counters must not go
+    backwards) until they are older than METRICS_RETENTION.
+    """
+
+    def __init__(self, directory=METRICS_DIR, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._dirty = False
+        self._thread = None
+        self._pid = None
+        self._local = threading.local()
+
+    def _key(self, name, labels):
+        return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+            self._dirty = True
+        self._start()
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+            self._dirty = True
+        self._start()
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def cache(self, cache, hit):
+        self.inc('ocdarr_cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+
+    def sonarr_call(self, endpoint, method, status, duration):
+        self.inc('ocdarr_sonarr_requests_total', endpoint=endpoint, method=method, status=status)
+        self.observe('ocdarr_sonarr_request_duration_seconds', duration, endpoint=endpoint, method=method)
+        calls = getattr(self._local, 'calls', None)
+        if calls is not None:
+            self._local.calls = calls + 1
+
+    @contextmanager
+    def count_sonarr_calls(self, kind):
+        """Record how many Sonarr calls the enclosed block makes in this thread."""
+        self._local.calls = 0
+        try:
+            yield
+        finally:
+            self.observe('ocdarr_event_sonarr_calls', self._local.calls, kind=kind)
+            self._local.calls = None
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f"metrics_{pid}.json")
+
+    def _start(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            # A forked child starts from an empty registry of its own
+            if self._pid is not None and self._pid != os.getpid():
+                self._counters, self._histograms = {}, {}
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Failed to write metrics: {str(e)}")
+
+    def flush(self):
+        """Write this process's metrics to its file if anything changed."""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {
+                'counters': [[name, dict(labels), value] for (name, labels), value in self._counters.items()],
+                'histograms': [[name, dict(labels), h['buckets'], h['sum'], h['count']]
+                               for (name, labels), h in self._histograms.items()]
+            }
+            self._dirty = False
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(os.getpid())
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(data, file)
+        os.replace(tmp_path, path)
+
+    def collect(self):
+        """Merge the metric files of every worker into (counters, histograms)."""
+        counters, histograms = {}, {}
+        now = time.time()
+        for path in glob.glob(os.path.join(self.directory, 'metrics_*.json')):
+            try:
+                if now - os.path.getmtime(path) > METRICS_RETENTION:
+                    os.remove(path)
+                    continue
+                with open(path, 'r') as file:
+                    data = json.load(file)
+            except (OSError, ValueError):
+                continue
+            for name, labels, value in data.get('counters', []):
+                key = self._key(name, labels)
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, buckets, total, count in data.get('histograms', []):
+                key = self._key(name, labels)
+                merged = histograms.setdefault(key, {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0})
+                merged['buckets'] = [a + b for a, b in zip(merged['buckets'], buckets)]
+                merged['sum'] += total
+                merged['count'] += count
+        return counters, histograms
+
+    def render(self, gauges=()):
+        """Prometheus text exposition of the merged metrics plus live `gauges`.
+
+        `gauges` is a list of (name, help, [(labels, value), ...]) read at
+        scrape time from shared state such as the job queue.
+        """
+        self.flush()
+        counters, histograms = self.collect()
+        lines = []
+        for name, (kind, help_text, buckets) in METRICS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'counter':
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{format_labels(labels)} {value}")
+            else:
+                for (metric, labels), histogram in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(buckets, histogram['buckets']):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']}")
+                    lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+        for name, help_text, samples in gauges:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{format_labels(tuple(sorted(labels.items())))} {value}")
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+metrics = Registry()
@@ -0,0 +1,102 @@
+import os
+import time
+import logging
+import db
+from series_resolver import series_key
+
+MISSING_LOG_PATH = os.getenv('MISSING_LOG_PATH', '/app/logs/missing.log')
+MISSING_MAX_ENTRIES = int(os.getenv('MISSING_MAX_ENTRIES', '500'))
+MISSING_LOG_TAIL_BYTES = int(os.getenv('MISSING_LOG_TAIL_BYTES', '8192'))
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS missing_series (
+    key TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    count INTEGER NOT NULL DEFAULT 1,
+    source TEXT
+);
+CREATE INDEX IF NOT EXISTS missing_series_last_seen ON missing_series (last_seen);
+'''
+
+def payload_source(data):
+    """Name of the media server a normalized webhook payload came from."""
+    if not data:
+        return None
+    return data.get('server_source') or ('plex' if 'plex_title' in data else 'tautulli')
+
+class MissingSeriesStore:
+    """Titles seen in webhooks that did not match a Sonarr series, one row per show.
+
+    Each sighting updates a single row keyed like the series resolver keys
+    titles. When a new title would push the table past `max_entries`, the
+    titles seen least recently are evicted.
+    """
+
+    def __init__(self, max_entries=MISSING_MAX_ENTRIES, db_path=None):
+        self.max_entries = max_entries
+        self.store = db.Store(SCHEMA, db_path)
+
+    def record(self, title, source=None):
+        """Count a sighting of an unmatched title. Returns True the first time it is seen."""
+        now = time.time()
+        key = series_key(title)
+        with self.store.transaction() as conn:
+            updated = conn.execute(
+                'UPDATE missing_series SET count = count + 1, last_seen = ?, title = ?, source = COALESCE(?, source) WHERE key = ?',
+                (now, title, source, key)
+            ).rowcount
+            if updated:
+                return False
+            conn.execute(
+                'INSERT INTO missing_series (key, title, first_seen, last_seen, source) VALUES (?, ?, ?, ?, ?)',
+                (key, title, now, now, source)
+            )
+            conn.execute(
+                'DELETE FROM missing_series WHERE key IN ('
+                'SELECT key FROM missing_series ORDER BY last_seen LIMIT MAX(0, (SELECT COUNT(*) FROM missing_series) - ?))',
+                (self.max_entries,)
+            )
+            return True
+
+    def remove(self, title):
+        """Forget a title, e.g. once the series has been added to Sonarr."""
+        conn = self.store.connect()
+        try:
+            conn.execute('DELETE FROM missing_series WHERE key = ?', (series_key(title),))
+        finally:
+            conn.close()
+
+    def page(self, page=1, page_size=50):
+        """One page of missing titles, most recently seen first."""
+        page = max(1, page)
+        page_size = max(1, min(page_size, 500))
+        conn = self.store.connect()
+        try:
+            total = conn.execute('SELECT COUNT(*) AS n FROM missing_series').fetchone()['n']
+            records = [dict(row) for row in conn.execute(
+                'SELECT title, first_seen, last_seen, count, source FROM missing_series '
+                'ORDER BY last_seen DESC LIMIT ? OFFSET ?', (page_size, (page - 1) * page_size))]
+        finally:
+            conn.close()
+        return {'page': page, 'pageSize': page_size, 'totalRecords': total, 'records': records}
+
+def tail_log(path=MISSING_LOG_PATH, max_bytes=MISSING_LOG_TAIL_BYTES):
+    """Last lines of the legacy missing.log, reading at most `max_bytes` from its end."""
+    try:
+        with open(path, 'rb') as file:
+            file.seek(0, os.SEEK_END)
+            size = file.tell()
+            file.seek(max(0, size - max_bytes))
+            data = file.read()
+    except FileNotFoundError:
+        return ''
+    if size > max_bytes:
+        # Drop the partial first line
+        data = data.split(b'\n', 1)[-1]
+    return data.decode('utf-8', errors='replace')
+
+missing_store = MissingSeriesStore()
@@ -0,0 +1,366 @@
+import os
+import json
+import time
+import fcntl
+import random
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import db
+from sonarr_client import sonarr, RateLimiter, SonarrUnavailableError
+from config_store import config_cache
+from tag_sync import tag_labels
+from rule_planner import EpisodeIndex, build_plan, plan_new_series
+from watch_history import watch_history
+from metrics import metrics
+from logging_config import log_context
+
+CONFIG_DIR = os.path.dirname(os.getenv('CONFIG_PATH', '/app/config/config.json'))
+RECONCILE_LOCK_PATH = os.path.join(CONFIG_DIR, '.reconcile.lock')
+RECONCILE_INTERVAL = int(os.getenv('RECONCILE_INTERVAL', '21600'))
+RECONCILE_FULL_INTERVAL = int(os.getenv('RECONCILE_FULL_INTERVAL', '604800'))
+RECONCILE_WORKERS = int(os.getenv('RECONCILE_WORKERS', '4'))
+RECONCILE_REQUESTS_PER_MINUTE = int(os.getenv('RECONCILE_REQUESTS_PER_MINUTE', '600'))
+RECONCILE_CHECK_SECONDS = 60
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS reconcile_state (
+    series_id INTEGER PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    reconciled_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reconcile_runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    full INTEGER NOT NULL,
+    dry_run INTEGER NOT NULL,
+    series INTEGER NOT NULL DEFAULT 0,
+    skipped INTEGER NOT NULL DEFAULT 0,
+    changed INTEGER NOT NULL DEFAULT 0,
+    unchanged INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    requests INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+'''
+
+def series_fingerprint(series, rule_name, rule, position):
+    """Hash of everything reconciliation looks at for a series, to spot unchanged ones."""
+    statistics = series.get('statistics') or {}
+    # The rule's assignment list would make every assignment change touch every series on the rule
+    settings = {key: value for key, value in rule.items() if key != 'series'}
+    return hashlib.sha1(json.dumps([
+        rule_name, settings, position, series.get('monitored'),
+        [statistics.get(key) for key in ('episodeCount', 'episodeFileCount', 'totalEpisodeCount', 'sizeOnDisk')],
+        [(season.get('seasonNumber'), season.get('monitored')) for season in series.get('seasons', [])],
+    ], sort_keys=True, default=str).encode()).hexdigest()
+
+def plan_requests(plan):
+    """Sonarr requests applying a plan from a job is expected to take.
+
+    Two reads to replan, one call per monitoring change (unmonitoring also
+    reads the queue to cancel downloads) and one per file deleted.
+    Searches go through the search dispatcher's own budget.
+    """
+    return 2 + bool(plan['monitor']) + 2 * bool(plan['unmonitor']) + len(plan['delete'])
+
+def rule_for(series, has_position):
+    """(rule_name, rule) the reactive paths would use for a series.
+
+    An assigned rule always wins. Otherwise watch events use the default
+    rule, and a series nobody has watched yet gets its rule from its tags
+    the way SeriesAdd does.
+    """
+    if str(series['id']) in config_cache.series_rule_index() or has_position:
+        return config_cache.rule_for_series(series['id'])
+    return config_cache.rule_for_tags(tag_labels(series.get('tags', [])))
+
+class Reconciler:
+    """Brings every series in line with its rule, applying only what differs.
+
+    For a series with a recorded watch position the desired state is the
+    plan a watch event at that position would produce, except that only
+    episodes it newly monitors are searched. A series nobody has watched
+    and without any files gets the monitoring a new series would get;
+    other series without a position are left alone. Each run reads /series
+    once and then one episode list per series, with at most `workers`
+    series in flight and every Sonarr request drawn from a per-minute
+    budget. Incremental runs skip series whose fingerprint matches the one
+    stored when they were last found already in line.
+
+    A pass only plans. Series that need changes are handed to `submit`,
+    which queues them behind any watch event for the same show, and
+    apply() replans and applies each one from there. The pass draws what
+    that will cost from its budget before queueing, so passes stay within
+    `requests_per_minute` however many workers run the jobs, and each
+    worker also paces its reconcile jobs to the same rate. Without
+    `submit` changes are applied by the pass itself.
+    """
+
+    def __init__(self, client, submit=None, workers=RECONCILE_WORKERS, requests_per_minute=RECONCILE_REQUESTS_PER_MINUTE,
+                 interval=RECONCILE_INTERVAL, full_interval=RECONCILE_FULL_INTERVAL, db_path=None):
+        self.client = client
+        self.submit = submit
+        self.job_limiter = RateLimiter(requests_per_minute)
+        self.workers = workers
+        self.requests_per_minute = requests_per_minute
+        self.interval = interval
+        self.full_interval = full_interval
+        self.store = db.Store(SCHEMA, db_path)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _fingerprints(self):
+        conn = self.store.connect()
+        try:
+            return {row['series_id']: row['fingerprint']
+                    for row in conn.execute('SELECT series_id, fingerprint FROM reconcile_state')}
+        finally:
+            conn.close()
+
+    def _save_fingerprints(self, converged, unsettled):
+        now = time.time()
+        conn = self.store.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.executemany(
+                'INSERT OR REPLACE INTO reconcile_state (series_id, fingerprint, reconciled_at) VALUES (?, ?, ?)',
+                [(series_id, fingerprint, now) for series_id, fingerprint in converged.items()])
+            # Series changed this run are checked again next time, against the state they were left in
+            conn.executemany('DELETE FROM reconcile_state WHERE series_id = ?', [(series_id,) for series_id in unsettled])
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+    def _start_run(self, full, dry_run):
+        conn = self.store.connect()
+        try:
+            return conn.execute('INSERT INTO reconcile_runs (started_at, full, dry_run) VALUES (?, ?, ?)',
+                                (time.time(), int(full), int(dry_run))).lastrowid
+        finally:
+            conn.close()
+
+    def _finish_run(self, run_id, summary, error=None):
+        conn = self.store.connect()
+        try:
+            conn.execute(
+                'UPDATE reconcile_runs SET finished_at = ?, series = ?, skipped = ?, changed = ?, unchanged = ?, '
+                'failed = ?, requests = ?, error = ? WHERE id = ?',
+                (time.time(), summary['series'], summary['skipped'], summary['changed'], summary['unchanged'],
+                 summary['failed'], summary['requests'], error, run_id))
+            # Keep a bounded run history
+            conn.execute('DELETE FROM reconcile_runs WHERE id <= ?', (run_id - 100,))
+        finally:
+            conn.close()
+
+    def runs(self, limit=10):
+        """Most recent runs first."""
+        conn = self.store.connect()
+        try:
+            return [dict(row) for row in conn.execute('SELECT * FROM reconcile_runs ORDER BY id DESC LIMIT ?', (limit,))]
+        finally:
+            conn.close()
+
+    def _last_finished(self, full_only=False):
+        conn = self.store.connect()
+        try:
+            row = conn.execute(
+                'SELECT MAX(finished_at) AS at FROM reconcile_runs WHERE error IS NULL AND dry_run = 0'
+                + (' AND full = 1' if full_only else '')).fetchone()
+            return row['at'] or 0
+        finally:
+            conn.close()
+
+    def reconcile_series(self, series, rule, position, dry_run=False):
+        """Plan (and unless dry_run, apply) the changes one series needs.
+
+        Returns the plan, or None when the series is left alone.
+        """
+        import servertosonarr
+        series_id = series['id']
+        episodes = servertosonarr.fetch_all_episodes(series_id)
+        if not episodes:
+            return None
+        rule, _ = servertosonarr.resolve_lookahead(series_id, rule)
+        if position:
+            index = EpisodeIndex(episodes)
+            if index.find(*position) is None:
+                logger.info(f"Last watched S{position[0]}E{position[1]} no longer exists in series {series_id}")
+                return None
+            plan = build_plan(series_id, index, position[0], position[1], rule)
+            # Searches already went out when the episodes were monitored
+            newly_monitored = set(plan['monitor'])
+            plan['search'] = [episode_id for episode_id in plan['search'] if episode_id in newly_monitored]
+        elif any(ep.get('hasFile') for ep in episodes):
+            return None
+        else:
+            plan = plan_new_series(series_id, episodes, rule)
+
+        if (plan['monitor'] or plan['unmonitor'] or plan['search'] or plan['delete']) and not dry_run:
+            logger.info(f"Reconciling series {series_id}: monitor {len(plan['monitor'])}, "
+                        f"unmonitor {len(plan['unmonitor'])}, search {len(plan['search'])}, delete {len(plan['delete'])}")
+            plan['delete_results'] = servertosonarr.execute_plan(plan)
+            if plan['unmonitor']:
+                # Episodes that dropped out of the rule's window may still be downloading
+                plan['cancelled'] = servertosonarr.cancel_downloads_for_episodes(series_id, plan['unmonitor'])
+        return plan
+
+    def apply(self, series_id):
+        """Replan one series at its current watch position and apply the result.
+
+        Runs as a job, so it never overlaps rule processing for the same
+        show. Returns the plan, or None when the series is left alone.
+        """
+        with self.client.throttled(self.job_limiter):
+            response = self.client.get(f"series/{series_id}")
+            if response.status_code == 404:
+                logger.info(f"Series {series_id} was deleted before it could be reconciled")
+                return None
+            response.raise_for_status()
+            series = response.json()
+            position = watch_history.position(series_id)
+            _, rule = rule_for(series, position is not None)
+            if not rule:
+                return None
+            return self.reconcile_series(series, rule, position)
+
+    def _reconcile_one(self, limiter, series, rule, position, dry_run):
+        with self.client.throttled(limiter), log_context(f"reconcile-{series['id']}"):
+            try:
+                plan = self.reconcile_series(series, rule, position, dry_run or self.submit is not None)
+                changed = plan is not None and bool(plan['monitor'] or plan['unmonitor'] or plan['search'] or plan['delete'])
+                if changed and not dry_run and self.submit is not None:
+                    for _ in range(plan_requests(plan)):
+                        limiter.acquire()
+                    self.submit(series)
+            except SonarrUnavailableError:
+                raise
+            except Exception as e:
+                logger.error(f"Failed to reconcile series {series['id']}: {str(e)}")
+                return 'failed'
+        if plan is None:
+            return 'skipped'
+        return 'changed' if changed else 'unchanged'
+
+    def run(self, full=False, dry_run=False):
+        """Reconcile the library in the calling thread and return a summary."""
+        limiter = RateLimiter(self.requests_per_minute)
+        summary = {'series': 0, 'skipped': 0, 'changed': 0, 'unchanged': 0, 'failed': 0, 'requests': 0}
+        run_id = self._start_run(full, dry_run)
+        started = time.monotonic()
+        error = None
+        try:
+            with self.client.throttled(limiter):
+                response = self.client.get('series')
+            if not response.ok:
+                raise RuntimeError(f"Sonarr returned {response.status_code} for the series list")
+            series_list = response.json()
+            positions = watch_history.positions()
+            known = {} if full else self._fingerprints()
+            summary['series'] = len(series_list)
+
+            work = []
+            for series in series_list:
+                position = positions.get(series['id'])
+                rule_name, rule = rule_for(series, position is not None)
+                if not rule:
+                    summary['skipped'] += 1
+                    continue
+                fingerprint = series_fingerprint(series, rule_name, rule, position)
+                if known.get(series['id']) == fingerprint:
+                    summary['skipped'] += 1
+                    continue
+                work.append((series, rule, position, fingerprint))
+
+            converged, unsettled = {}, []
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                futures = [(series, fingerprint, pool.submit(self._reconcile_one, limiter, series, rule, position, dry_run))
+                           for series, rule, position, fingerprint in work]
+                for series, fingerprint, future in futures:
+                    outcome = future.result()
+                    summary[outcome] += 1
+                    metrics.inc('ocdarr_reconcile_series_total', outcome=outcome)
+                    if outcome in ('unchanged', 'skipped'):
+                        converged[series['id']] = fingerprint
+                    elif outcome == 'changed':
+                        unsettled.append(series['id'])
+            if not dry_run:
+                self._save_fingerprints(converged, unsettled)
+        except Exception as e:
+            error = str(e)
+            logger.error(f"Reconciliation stopped: {error}")
+        finally:
+            summary['requests'] = limiter.acquired
+            self._finish_run(run_id, summary, error)
+        elapsed = time.monotonic() - started
+        metrics.observe('ocdarr_stage_duration_seconds', elapsed, stage='reconcile')
+        logger.info(f"{'Full' if full else 'Incremental'} reconciliation{' (dry run)' if dry_run else ''} "
+                    f"of {summary['series']} series in {elapsed:.1f}s: {summary['changed']} changed, "
+                    f"{summary['unchanged']} already in line, {summary['skipped']} skipped, "
+                    f"{summary['failed']} failed, {summary['requests']} Sonarr requests")
+        return dict(summary, error=error)
+
+    def elected_run(self, full=None, dry_run=False, force=False):
+        """Run in at most one worker at a time, and only when due unless `force`.
+
+        With full None, a full pass is made when the last one is older than
+        `full_interval` and an incremental one otherwise. Returns the
+        summary, or None when nothing ran.
+        """
+        os.makedirs(os.path.dirname(RECONCILE_LOCK_PATH) or '.', exist_ok=True)
+        with open(RECONCILE_LOCK_PATH, 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.debug("Reconciliation already running in another worker")
+                return None
+            try:
+                if not force and time.time() - self._last_finished() < self.interval:
+                    return None
+                if full is None:
+                    full = time.time() - self._last_finished(full_only=True) >= self.full_interval
+                return self.run(full=full, dry_run=dry_run)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def is_running(self):
+        os.makedirs(os.path.dirname(RECONCILE_LOCK_PATH) or '.', exist_ok=True)
+        with open(RECONCILE_LOCK_PATH, 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return False
+
+    def run_async(self, full=None, dry_run=False):
+        """Start an elected, forced run in the background."""
+        thread = threading.Thread(target=self.elected_run, kwargs={'full': full, 'dry_run': dry_run, 'force': True},
+                                  name='reconcile-manual', daemon=True)
+        thread.start()
+        return thread
+
+    def start(self):
+        """Start the schedule for this process (idempotent); a zero interval disables it."""
+        if self.interval <= 0:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._schedule, name='reconcile', daemon=True)
+            self._thread.start()
+
+    def _schedule(self):
+        while True:
+            # Jitter keeps the workers from checking in lockstep
+            time.sleep(RECONCILE_CHECK_SECONDS + random.uniform(0, RECONCILE_CHECK_SECONDS))
+            try:
+                self.elected_run()
+            except Exception as e:
+                logger.error(f"Scheduled reconciliation failed: {str(e)}")
+
+reconciler = Reconciler(sonarr)
@@ -0,0 +1,171 @@
+import math
+import logging
+from bisect import bisect_left, bisect_right
+
+logger = logging.getLogger(__name__)
+
+class EpisodeIndex:
+    """A series' episodes in (season, episode) order with bisect lookups."""
+
+    def __init__(self, episodes):
+        self.episodes = sorted(episodes, key=lambda ep: (ep['seasonNumber'], ep['episodeNumber']))
+        self.keys = [(ep['seasonNumber'], ep['episodeNumber']) for ep in self.episodes]
+
+    def find(self, season_number, episode_number):
+        """Return the episode at (season, episode), or None."""
+        i = bisect_left(self.keys, (season_number, episode_number))
+        if i < len(self.keys) and self.keys[i] == (season_number, episode_number):
+            return self.episodes[i]
+        return None
+
+    def after(self, season_number, episode_number, count=None):
+        """Episodes following (season, episode), optionally only the next `count`."""
+        i = bisect_right(self.keys, (season_number, episode_number))
+        return self.episodes[i:] if count is None else self.episodes[i:i + count]
+
+    def rest_of_season(self, season_number, episode_number):
+        """Episodes after (season, episode) in the same season."""
+        start = bisect_right(self.keys, (season_number, episode_number))
+        end = bisect_left(self.keys, (season_number + 1, -1))
+        return self.episodes[start:end]
+
+    def up_to(self, season_number, episode_number, count):
+        """The `count` episodes ending with (season, episode)."""
+        end = bisect_right(self.keys, (season_number, episode_number))
+        return self.episodes[max(0, end - count):end]
+
+    def before_season(self, season_number):
+        """Episodes of every season earlier than `season_number`."""
+        return self.episodes[:bisect_left(self.keys, (season_number, -1))]
+
+def parse_adaptive(get_option, default_min, default_max):
+    """(min, max) episode bounds of an 'adaptive' or 'adaptive:MIN-MAX' get_option, else None."""
+    if not isinstance(get_option, str) or not get_option.startswith('adaptive'):
+        return None
+    bounds = get_option[len('adaptive'):].lstrip(':').strip()
+    if not bounds:
+        return default_min, default_max
+    try:
+        low, high = (int(part) for part in bounds.split('-'))
+    except ValueError:
+        raise ValueError(f"Invalid get_option value: {get_option}")
+    return max(1, min(low, high)), max(1, low, high)
+
+def adaptive_count(episodes_per_day, latency_days, bounds, headroom=1.0):
+    """Episodes to keep ready so the viewer never catches up with downloads.
+
+    That is what they get through while a download completes, with
+    headroom, plus the episode they are about to start, kept within bounds.
+    """
+    count = math.ceil(episodes_per_day * latency_days * headroom) + 1
+    return max(bounds[0], min(bounds[1], count))
+
+def lookahead(index, season_number, episode_number, get_option):
+    """Episodes a rule's get_option wants ready after the watched episode."""
+    if get_option == 'all':
+        return index.after(season_number, episode_number)
+    if get_option == 'season':
+        return index.rest_of_season(season_number, episode_number)
+    try:
+        return index.after(season_number, episode_number, int(get_option))
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid get_option value: {get_option}")
+
+def parse_keep_watched(keep_watched):
+    """Normalize keep_watched from config, where counts are stored as text."""
+    if isinstance(keep_watched, str) and keep_watched.isdigit():
+        return int(keep_watched)
+    return keep_watched
+
+def find_episodes_to_delete(all_episodes, keep_watched, last_watched_id, keep_episode_ids=()):
+    """Build the single, deduplicated list of episode files a rule wants deleted.
+
+    Files of the last watched episode, the episodes kept by keep_watched and
+    any episodes in keep_episode_ids (the upcoming episodes) are never deleted.
+    """
+    index = all_episodes if isinstance(all_episodes, EpisodeIndex) else EpisodeIndex(all_episodes)
+    keep_watched = parse_keep_watched(keep_watched)
+    keep_ids = set(keep_episode_ids) | {last_watched_id}
+    last_watched = next(ep for ep in index.episodes if ep['id'] == last_watched_id)
+    if keep_watched == "all":
+        return []  # Skip deletion logic entirely if "all" is specified.
+    elif keep_watched == "season":
+        episodes_to_delete = index.before_season(last_watched['seasonNumber'])
+    elif isinstance(keep_watched, int):
+        # Keep the specified count of episodes, ending with the last watched one.
+        keep_range = index.up_to(last_watched['seasonNumber'], last_watched['episodeNumber'], max(keep_watched, 1))
+        keep_ids.update(ep['id'] for ep in keep_range)
+        episodes_to_delete = index.episodes
+    else:
+        logger.error(f"Invalid keep_watched value: {keep_watched}")
+        return []
+
+    file_ids = []
+    for ep in episodes_to_delete:
+        if ep['hasFile'] and ep['id'] not in keep_ids and ep.get('episodeFileId'):
+            file_ids.append(ep['episodeFileId'])
+    # Multi-episode files are shared by several episodes
+    return list(dict.fromkeys(file_ids))
+
+def build_plan(series_id, index, season_number, episode_number, rule):
+    """Work out everything a watch event should change, without touching Sonarr.
+
+    The plan lists episode IDs to monitor, unmonitor and search, and episode
+    file IDs to delete. Episodes already in the desired state are left out.
+    """
+    watched = index.find(season_number, episode_number)
+    if watched is None:
+        raise ValueError(f"S{season_number}E{episode_number} not found for series {series_id}")
+
+    upcoming = lookahead(index, season_number, episode_number, rule['get_option'])
+    unmonitor = [watched['id']] if not rule['monitor_watched'] and watched['monitored'] else []
+    monitor = [ep['id'] for ep in upcoming if not ep['monitored']]
+    search = [ep['id'] for ep in upcoming if not ep['hasFile']] if rule['action_option'] == 'search' else []
+    delete = find_episodes_to_delete(index, rule['keep_watched'], watched['id'], [ep['id'] for ep in upcoming])
+
+    return {
+        'series_id': series_id,
+        'watched': {'season': season_number, 'episode': episode_number, 'episode_id': watched['id']},
+        'upcoming': [ep['id'] for ep in upcoming],
+        'monitor': monitor,
+        'unmonitor': unmonitor,
+        'search': search,
+        'delete': delete
+    }
+
+def plan_new_series(series_id, episodes, rule):
+    """Monitoring changes that set a series up for a rule before anything is watched.
+
+    Within each monitored season (specials excluded) only the episodes the
+    rule's get_option wants from the start stay monitored. Episodes already
+    in the desired state are left out.
+    """
+    monitored_seasons = {}
+    for ep in episodes:
+        if ep['monitored'] and ep['seasonNumber'] != 0:
+            monitored_seasons.setdefault(ep['seasonNumber'], []).append(ep)
+
+    desired = {}
+    for season_episodes in monitored_seasons.values():
+        season_episodes.sort(key=lambda ep: ep['episodeNumber'])
+        if rule['get_option'] == '1':
+            # Only the first episode
+            for ep in season_episodes:
+                desired[ep['id']] = ep['episodeNumber'] == 1
+        elif rule['get_option'] == 'season':
+            for ep in season_episodes:
+                desired[ep['id']] = True
+        elif rule['get_option'].isdigit():
+            for i, ep in enumerate(season_episodes):
+                desired[ep['id']] = i < int(rule['get_option'])
+
+    current = {ep['id']: ep['monitored'] for ep in episodes}
+    return {
+        'series_id': series_id,
+        'seasons': sorted(monitored_seasons),
+        'monitor': [ep_id for ep_id, monitor in desired.items() if monitor and not current[ep_id]],
+        'unmonitor': [ep_id for ep_id, monitor in desired.items() if not monitor and current[ep_id]],
+        'unchanged': sum(1 for ep_id, monitor in desired.items() if monitor == current[ep_id]),
+        'search': [],
+        'delete': []
+    }
@@ -0,0 +1,416 @@
+import os
+import time
+import random
+import fcntl
+import logging
+import threading
+import requests
+from datetime import datetime, timezone
+import db
+from sonarr_client import sonarr, RateLimiter
+from sonarr_utils import parse_sonarr_date
+from metrics import metrics
+
+CONFIG_DIR = os.path.dirname(os.getenv('CONFIG_PATH', '/app/config/config.json'))
+SEARCH_LOCK_PATH = os.path.join(CONFIG_DIR, '.search_dispatch.lock')
+SEARCH_BATCH_WINDOW = float(os.getenv('SEARCH_BATCH_WINDOW', '5'))
+SEARCH_MAX_BATCH = int(os.getenv('SEARCH_MAX_BATCH', '20'))
+SEARCH_QUERIES_PER_MINUTE = int(os.getenv('SEARCH_QUERIES_PER_MINUTE', '30'))
+# Share of a season's aired episodes that makes one season search cheaper than searching each
+SEARCH_SEASON_PACK_SHARE = float(os.getenv('SEARCH_SEASON_PACK_SHARE', '0.75'))
+# Commands Sonarr no longer reports after this long are given up on
+SEARCH_COMMAND_TIMEOUT = int(os.getenv('SEARCH_COMMAND_TIMEOUT', '3600'))
+SEARCH_MAX_ATTEMPTS = int(os.getenv('SEARCH_MAX_ATTEMPTS', '5'))
+SEARCH_RETRY_BACKOFF = float(os.getenv('SEARCH_RETRY_BACKOFF', '60'))
+SEARCH_HISTORY_SIZE = 200
+
+ACTIVE_STATUSES = ('queued', 'started')
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS search_requests (
+    episode_id INTEGER PRIMARY KEY,
+    series_id INTEGER,
+    requested_at REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    command_id INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    retry_at REAL NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS search_requests_status ON search_requests (status, requested_at);
+CREATE TABLE IF NOT EXISTS search_commands (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    episodes INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    queued_at REAL NOT NULL,
+    started_at REAL,
+    ended_at REAL,
+    duration REAL,
+    message TEXT
+);
+CREATE INDEX IF NOT EXISTS search_commands_status ON search_commands (status);
+'''
+
+def command_time(command, field):
+    value = command.get(field)
+    return parse_sonarr_date(value).timestamp() if value else None
+
+class SearchDispatcher:
+    """Buffers episode searches from every worker and sends them to Sonarr in batches.
+
+    Requests are journaled in SQLite, one row per episode, so an episode
+    that is already waiting, queued or running in Sonarr is not requested
+    twice. One elected worker sends what has accumulated every `window`
+    seconds, and skips episodes Sonarr is already searching for on its own.
+    Episodes are grouped by season: when they cover at least
+    `season_pack_share` of a season's aired episodes the season goes out as
+    one SeasonSearch, a single query per indexer, and the rest go out as
+    EpisodeSearch commands of up to `max_batch` episodes, one query each.
+    Queries spend tokens from a bucket sized to the indexers' budget. Sent
+    commands are polled through /command/{id} until they finish, recording
+    their status and duration.
+    """
+
+    def __init__(self, client, window=SEARCH_BATCH_WINDOW, max_batch=SEARCH_MAX_BATCH,
+                 queries_per_minute=SEARCH_QUERIES_PER_MINUTE, season_pack_share=SEARCH_SEASON_PACK_SHARE,
+                 db_path=None):
+        self.client = client
+        self.window = window
+        self.max_batch = max_batch
+        self.season_pack_share = season_pack_share
+        self.limiter = RateLimiter(queries_per_minute, burst=max_batch)
+        self.store = db.Store(SCHEMA, db_path, migrate=self._migrate)
+        self._lock = threading.Lock()
+        self._tick_lock = threading.Lock()
+        self._thread = None
+        self._lock_file = None
+
+    def _migrate(self, conn):
+        # Journals created before sends were retried lack the retry columns
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(search_requests)')}
+        for column, definition in (('attempts', 'INTEGER NOT NULL DEFAULT 0'), ('retry_at', 'REAL NOT NULL DEFAULT 0'),
+                                   ('last_error', 'TEXT')):
+            if column not in columns:
+                conn.execute(f'ALTER TABLE search_requests ADD COLUMN {column} {definition}')
+
+    def request(self, episode_ids, series_id=None):
+        """Queue episodes for searching. Returns the IDs that were not already waiting or running.
+
+        Episodes whose search was given up on are queued afresh.
+        """
+        now = time.time()
+        conn = self.store.connect()
+        try:
+            added = [episode_id for episode_id in dict.fromkeys(episode_ids) if conn.execute(
+                'INSERT INTO search_requests (episode_id, series_id, requested_at) VALUES (?, ?, ?) '
+                "ON CONFLICT (episode_id) DO UPDATE SET series_id = excluded.series_id, requested_at = excluded.requested_at, "
+                "status = 'pending', command_id = NULL, attempts = 0, retry_at = 0, last_error = NULL "
+                "WHERE status = 'failed'",
+                (episode_id, series_id, now)).rowcount]
+        finally:
+            conn.close()
+        skipped = len(set(episode_ids)) - len(added)
+        if skipped:
+            logger.info(f"Skipped {skipped} episode search(es) already queued or running")
+            metrics.inc('ocdarr_search_requests_total', outcome='duplicate', value=skipped)
+        if added:
+            metrics.inc('ocdarr_search_requests_total', outcome='queued', value=len(added))
+        return added
+
+    def _active_in_sonarr(self):
+        """Episode IDs and (series ID, season) pairs Sonarr is searching for, ours or not."""
+        response = self.client.get('command')
+        if not response.ok:
+            return set(), set()
+        episodes, seasons = set(), set()
+        for command in response.json():
+            if command.get('status') not in ACTIVE_STATUSES:
+                continue
+            body = command.get('body') or {}
+            if command.get('name') == 'EpisodeSearch':
+                episodes.update(body.get('episodeIds') or [])
+            elif command.get('name') == 'SeasonSearch':
+                seasons.add((body.get('seriesId'), body.get('seasonNumber')))
+        return episodes, seasons
+
+    def _pending(self, conn):
+        return [dict(row) for row in conn.execute(
+            "SELECT episode_id, series_id FROM search_requests WHERE status = 'pending' AND retry_at <= ? "
+            "ORDER BY requested_at, episode_id", (time.time(),))]
+
+    def _seasons(self, series_id, episode_ids):
+        """{season: (requested aired IDs, requested unaired IDs, aired count)} for a series' requested episodes."""
+        response = self.client.get('episode', params={'seriesId': series_id})
+        if not response.ok:
+            return {}
+        now = datetime.now(timezone.utc)
+        requested = set(episode_ids)
+        seasons = {}
+        for ep in response.json():
+            wanted, unaired, aired = seasons.setdefault(ep['seasonNumber'], ([], [], [0]))
+            has_aired = bool(ep.get('airDateUtc')) and parse_sonarr_date(ep['airDateUtc']) <= now
+            if has_aired:
+                aired[0] += 1
+            if ep['id'] in requested:
+                (wanted if has_aired else unaired).append(ep['id'])
+        return {season: (wanted, unaired, aired[0]) for season, (wanted, unaired, aired) in seasons.items()
+                if wanted or unaired}
+
+    def _commands(self, pending, active_seasons):
+        """Turn pending rows into (body, episode IDs, indexer queries) commands, season searches first.
+
+        Returns the commands and the episodes Sonarr already covers with a season search.
+        """
+        by_series = {}
+        for row in pending:
+            by_series.setdefault(row['series_id'], []).append(row['episode_id'])
+
+        commands, covered, loose = [], [], []
+        for series_id, episode_ids in by_series.items():
+            searching = {season for searched_series, season in active_seasons if searched_series == series_id}
+            if series_id is None or (len(episode_ids) < 2 and not searching):
+                loose.extend(episode_ids)
+                continue
+            seasons = self._seasons(series_id, episode_ids)
+            grouped = set()
+            for season, (wanted, unaired, aired) in sorted(seasons.items()):
+                grouped.update(wanted + unaired)
+                if season in searching:
+                    covered.extend(wanted + unaired)
+                # Coverage counts aired episodes only; specials are not released as season packs
+                elif season != 0 and len(wanted) > 1 and len(wanted) >= self.season_pack_share * aired:
+                    commands.append(({'name': 'SeasonSearch', 'seriesId': series_id, 'seasonNumber': season}, wanted, 1))
+                    loose.extend(unaired)
+                else:
+                    loose.extend(wanted + unaired)
+            # Episodes Sonarr no longer lists still get searched one by one
+            loose.extend(episode_id for episode_id in episode_ids if episode_id not in grouped)
+
+        for start in range(0, len(loose), self.max_batch):
+            batch = loose[start:start + self.max_batch]
+            # Each episode is one query against every indexer
+            commands.append(({'name': 'EpisodeSearch', 'episodeIds': batch}, batch, len(batch)))
+        return commands, covered
+
+    def _send(self, body, episode_ids):
+        response = self.client.post('command', json=body)
+        if not response.ok:
+            logger.error(f"Failed to send {body['name']} command. Response: {response.text}")
+            self._retry_later(episode_ids, f"{response.status_code}: {response.text[:200]}")
+            return None
+        command = response.json()
+        logger.info(f"{body['name']} command {command.get('id')} sent to Sonarr for {len(episode_ids)} episode(s)")
+        return command
+
+    def dispatch(self):
+        """Send pending searches as far as the token bucket allows. Returns the number of commands sent."""
+        conn = self.store.connect()
+        try:
+            pending = self._pending(conn)
+        finally:
+            conn.close()
+        if not pending:
+            return 0
+
+        running_episodes, running_seasons = self._active_in_sonarr()
+        duplicates = [row['episode_id'] for row in pending if row['episode_id'] in running_episodes]
+        pending = [row for row in pending if row['episode_id'] not in running_episodes]
+        commands, covered = self._commands(pending, running_seasons)
+        duplicates += covered
+        if duplicates:
+            logger.info(f"Sonarr is already searching for {len(duplicates)} requested episode(s)")
+            self._forget(duplicates)
+
+        sent = 0
+        for i, (body, episode_ids, queries) in enumerate(commands):
+            if not self.limiter.try_acquire(queries):
+                waiting = sum(len(ids) for _, ids, _ in commands[i:])
+                logger.debug(f"Search budget spent, {waiting} episode(s) wait for the next window")
+                break
+            command = self._send(body, episode_ids)
+            if command is None:
+                # Backed off, so the next commands are not held up behind it
+                continue
+            self._record_command(command, episode_ids)
+            metrics.inc('ocdarr_search_queries_total', command=body['name'], value=queries)
+            sent += 1
+        return sent
+
+    def _record_command(self, command, episode_ids):
+        now = time.time()
+        conn = self.store.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                'INSERT OR REPLACE INTO search_commands (id, name, episodes, status, queued_at) VALUES (?, ?, ?, ?, ?)',
+                (command['id'], command.get('name', 'EpisodeSearch'), len(episode_ids), command.get('status', 'queued'), now))
+            conn.executemany("UPDATE search_requests SET status = 'queued', command_id = ? WHERE episode_id = ?",
+                             [(command['id'], episode_id) for episode_id in episode_ids])
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        metrics.inc('ocdarr_search_commands_total', status='sent')
+
+    def _retry_later(self, episode_ids, error):
+        """Back off a refused send, giving up on episodes after SEARCH_MAX_ATTEMPTS."""
+        now = time.time()
+        given_up = 0
+        conn = self.store.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for episode_id in episode_ids:
+                row = conn.execute('SELECT attempts FROM search_requests WHERE episode_id = ?', (episode_id,)).fetchone()
+                if row is None:
+                    continue
+                attempts = row['attempts'] + 1
+                given_up += attempts >= SEARCH_MAX_ATTEMPTS
+                backoff = SEARCH_RETRY_BACKOFF * (2 ** (attempts - 1))
+                conn.execute(
+                    'UPDATE search_requests SET attempts = ?, retry_at = ?, last_error = ?, status = ? WHERE episode_id = ?',
+                    (attempts, now + random.uniform(backoff / 2, backoff), error,
+                     'failed' if attempts >= SEARCH_MAX_ATTEMPTS else 'pending', episode_id))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        metrics.inc('ocdarr_search_commands_total', status='refused')
+        if given_up:
+            logger.error(f"Gave up searching for {given_up} episode(s) after {SEARCH_MAX_ATTEMPTS} refused attempts: {error}")
+
+    def _forget(self, episode_ids):
+        conn = self.store.connect()
+        try:
+            conn.executemany('DELETE FROM search_requests WHERE episode_id = ?', [(episode_id,) for episode_id in episode_ids])
+        finally:
+            conn.close()
+
+    def poll(self):
+        """Check on unfinished commands and record the ones that have ended."""
+        conn = self.store.connect()
+        try:
+            active = [dict(row) for row in conn.execute(
+                "SELECT id, queued_at FROM search_commands WHERE status IN ('queued', 'started')")]
+        finally:
+            conn.close()
+        for row in active:
+            response = self.client.get(f"command/{row['id']}")
+            if response.status_code == 404 or (not response.ok and time.time() - row['queued_at'] > SEARCH_COMMAND_TIMEOUT):
+                # Sonarr restarted or pruned it; the episodes can be searched again
+                self._finish(row['id'], {'status': 'orphaned'})
+            elif response.ok:
+                command = response.json()
+                if command.get('status') in ACTIVE_STATUSES:
+                    self._update_status(row['id'], command)
+                else:
+                    self._finish(row['id'], command)
+
+    def _update_status(self, command_id, command):
+        conn = self.store.connect()
+        try:
+            conn.execute('UPDATE search_commands SET status = ?, started_at = ? WHERE id = ?',
+                         (command['status'], command_time(command, 'started'), command_id))
+            conn.execute('UPDATE search_requests SET status = ? WHERE command_id = ?', (command['status'], command_id))
+        finally:
+            conn.close()
+
+    def _finish(self, command_id, command):
+        status = command.get('status', 'completed')
+        started, ended = command_time(command, 'started'), command_time(command, 'ended')
+        duration = ended - started if started and ended else None
+        conn = self.store.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                'UPDATE search_commands SET status = ?, started_at = ?, ended_at = ?, duration = ?, message = ? WHERE id = ?',
+                (status, started, ended, duration, command.get('message'), command_id))
+            conn.execute('DELETE FROM search_requests WHERE command_id = ?', (command_id,))
+            conn.execute('DELETE FROM search_commands WHERE id NOT IN (SELECT id FROM search_commands ORDER BY id DESC LIMIT ?)',
+                         (SEARCH_HISTORY_SIZE,))
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        metrics.inc('ocdarr_search_commands_total', status=status)
+        if duration is not None:
+            metrics.observe('ocdarr_search_command_duration_seconds', duration)
+        if status == 'completed':
+            logger.info(f"Search command {command_id} completed" + (f" in {duration:.1f}s" if duration is not None else ''))
+        else:
+            logger.warning(f"Search command {command_id} {status}: {command.get('message') or 'no message'}")
+
+    def run_once(self):
+        """One dispatcher tick: record finished commands, then send what is pending."""
+        with self._tick_lock:
+            try:
+                self.poll()
+                self.dispatch()
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Search dispatch deferred, Sonarr unreachable: {str(e)}")
+
+    def drain(self, timeout=60):
+        """Send everything pending now, for one-off runs without the background thread.
+
+        Leaves the work to the running app when one already holds the dispatcher.
+        """
+        if not self._elected():
+            return
+        deadline = time.monotonic() + timeout
+        while self.stats()['pending'] and time.monotonic() < deadline:
+            self.run_once()
+            time.sleep(1)
+
+    def stats(self):
+        conn = self.store.connect()
+        try:
+            counts = {row['status']: row['n'] for row in conn.execute(
+                'SELECT status, COUNT(*) AS n FROM search_requests GROUP BY status')}
+            commands = [dict(row) for row in conn.execute('SELECT * FROM search_commands ORDER BY id DESC LIMIT 20')]
+            failures = [dict(row) for row in conn.execute(
+                'SELECT episode_id, series_id, status, attempts, retry_at, last_error FROM search_requests '
+                'WHERE last_error IS NOT NULL ORDER BY requested_at DESC LIMIT 20')]
+        finally:
+            conn.close()
+        return {
+            'pending': counts.get('pending', 0),
+            'queued': counts.get('queued', 0),
+            'running': counts.get('started', 0),
+            'failed': counts.get('failed', 0),
+            'recent_commands': commands,
+            'recent_failures': failures
+        }
+
+    def _elected(self):
+        """Whether this process holds the dispatcher lock, taking it if it is free."""
+        if self._lock_file is not None:
+            return True
+        os.makedirs(os.path.dirname(SEARCH_LOCK_PATH) or '.', exist_ok=True)
+        lock_file = open(SEARCH_LOCK_PATH, 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        # Held for the life of the process; another worker takes over if this one exits
+        self._lock_file = lock_file
+        logger.info(f"Search dispatcher running in worker {os.getpid()}")
+        return True
+
+    def start(self):
+        """Start the dispatcher thread for this process (idempotent)."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='search-dispatcher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.window)
+            try:
+                if self._elected():
+                    self.run_once()
+            except Exception as e:
+                logger.error(f"Search dispatcher failed: {str(e)}")
+
+search_dispatcher = SearchDispatcher(sonarr)
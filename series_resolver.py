@@ -0,0 +1,203 @@
+import os
+import time
+import logging
+import threading
+from dotenv import load_dotenv
+from sonarr_client import sonarr
+from metrics import metrics
+
+load_dotenv()
+
+SERIES_INDEX_REFRESH = int(os.getenv('SERIES_INDEX_REFRESH', '900'))
+SERIES_INDEX_MISS_REFRESH = int(os.getenv('SERIES_INDEX_MISS_REFRESH', '60'))
+
+logger = logging.getLogger(__name__)
+
+PROVIDERS = ('tvdb', 'tmdb', 'imdb')
+
+def exact_key(title):
+    """Case-insensitive key for a title."""
+    return title.strip().lower()
+
+def flexible_key(title):
+    """Key that ignores 'the' and spaces, matching the legacy flexible lookup."""
+    return title.lower().replace('the ', '').replace(' ', '')
+
+def strip_year(title):
+    """Drop a trailing '(2019)' style qualifier from a title."""
+    return title.split('(')[0].strip()
+
+def series_key(title):
+    """Stable per-show key derived from a title, for shows not (yet) matched to a Sonarr ID."""
+    return flexible_key(strip_year(title))
+
+def job_key(series_id=None, title=''):
+    """Key that serializes jobs for one show: its Sonarr ID when known, else its title."""
+    return f"series:{series_id}" if series_id else series_key(title)
+
+def title_variants(series):
+    """All titles a series may be reported under by a media server."""
+    titles = [series.get('title') or '']
+    titles.extend(alt.get('title') for alt in series.get('alternateTitles') or [])
+    variants = set()
+    for title in titles:
+        if title:
+            variants.add(title)
+            variants.add(strip_year(title))
+    return variants
+
+def provider_keys(series):
+    """(provider, id) pairs for the external IDs Sonarr knows about a series."""
+    keys = []
+    for provider, field in (('tvdb', 'tvdbId'), ('tmdb', 'tmdbId'), ('imdb', 'imdbId')):
+        value = series.get(field)
+        if value:
+            keys.append((provider, str(value).lower()))
+    return keys
+
+class SeriesResolver:
+    """Maps media server titles and provider IDs to Sonarr series IDs.
+
+    The full series list is only downloaded to build the index; lookups are
+    dictionary hits. The index is refreshed in the background, on a lookup
+    miss (at most once per SERIES_INDEX_MISS_REFRESH seconds) and updated
+    in place from Sonarr series add/delete webhooks.
+    """
+
+    def __init__(self, client, refresh_interval=SERIES_INDEX_REFRESH):
+        self.client = client
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._series = {}
+        self._exact = {}
+        self._flexible = {}
+        self._providers = {}
+        self._loaded_at = 0
+        self._checked_at = 0
+        self._refresh_thread = None
+
+    def _fetch_series(self):
+        response = self.client.get('series')
+        if response.ok:
+            return response.json()
+        logger.error("Failed to fetch series from Sonarr.")
+        # A lookup against an index that was never loaded would report every show as missing
+        if not self._loaded_at:
+            response.raise_for_status()
+        return None
+
+    def _index(self, series):
+        series_id = series['id']
+        for title in title_variants(series):
+            self._exact.setdefault(exact_key(title), series_id)
+            self._flexible.setdefault(flexible_key(title), series_id)
+        for key in provider_keys(series):
+            self._providers[key] = series_id
+
+    def _rebuild(self):
+        self._exact = {}
+        self._flexible = {}
+        self._providers = {}
+        for series in self._series.values():
+            self._index(series)
+
+    def refresh(self):
+        """Re-download the series list and re-index anything that changed."""
+        with self._refresh_lock:
+            self._checked_at = time.monotonic()
+            series_list = self._fetch_series()
+            if series_list is None:
+                return False
+            with self._lock:
+                fresh = {series['id']: series for series in series_list}
+                removed = self._series.keys() - fresh.keys()
+                changed = [sid for sid, series in fresh.items()
+                           if self._signature(self._series.get(sid)) != self._signature(series)]
+                renamed = any(sid in self._series for sid in changed)
+                self._series = fresh
+                if removed or renamed:
+                    # Stale keys have to go, and dropping them may uncover titles shared with other series
+                    self._rebuild()
+                else:
+                    for sid in changed:
+                        self._index(fresh[sid])
+                self._loaded_at = time.monotonic()
+            logger.info(f"Series index refreshed: {len(fresh)} series, {len(changed)} changed, {len(removed)} removed")
+            return True
+
+    @staticmethod
+    def _signature(series):
+        if series is None:
+            return None
+        return (series.get('title'), tuple(sorted(title_variants(series))), tuple(provider_keys(series)))
+
+    def add_series(self, series):
+        """Index a single series, e.g. from a Sonarr SeriesAdd webhook."""
+        if not series or not series.get('id'):
+            return
+        with self._lock:
+            self._series[series['id']] = series
+            self._index(series)
+
+    def remove_series(self, series_id):
+        """Drop a series from the index, e.g. from a Sonarr SeriesDelete webhook."""
+        with self._lock:
+            if self._series.pop(series_id, None) is not None:
+                self._rebuild()
+
+    def _ensure_loaded(self):
+        if not self._loaded_at:
+            self.refresh()
+        self._start_background_refresh()
+
+    def _start_background_refresh(self):
+        if self.refresh_interval <= 0 or self._refresh_thread is not None:
+            return
+        with self._lock:
+            if self._refresh_thread is not None:
+                return
+            self._refresh_thread = threading.Thread(target=self._refresh_loop, name='series-index-refresh', daemon=True)
+            self._refresh_thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Series index refresh failed: {str(e)}")
+
+    def _lookup(self, series_name, provider_ids):
+        with self._lock:
+            for provider in PROVIDERS:
+                value = provider_ids.get(provider)
+                if value:
+                    series_id = self._providers.get((provider, str(value).lower()))
+                    if series_id:
+                        return series_id
+            if not series_name:
+                return None
+            # Exact (optionally year-stripped) titles win over the flexible match
+            series_id = self._exact.get(exact_key(series_name))
+            if series_id:
+                return series_id
+            return self._flexible.get(flexible_key(series_name))
+
+    def cached(self, series_name, provider_ids=None):
+        """The series ID the index already holds for a title or provider IDs, without asking Sonarr."""
+        return self._lookup(series_name, provider_ids or {})
+
+    def resolve(self, series_name, provider_ids=None):
+        """Return the Sonarr series ID for a title and/or provider IDs, or None."""
+        provider_ids = provider_ids or {}
+        self._ensure_loaded()
+        series_id = self._lookup(series_name, provider_ids)
+        metrics.cache('series_index', series_id is not None)
+        if series_id is None and time.monotonic() - self._checked_at > SERIES_INDEX_MISS_REFRESH:
+            # The show may have been added since the last refresh
+            self.refresh()
+            series_id = self._lookup(series_name, provider_ids)
+        return series_id
+
+resolver = SeriesResolver(sonarr)
@@ -1,44 +1,57 @@
 import os
+import time
 import requests
 import logging
 import json
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-
-# Load settings from a JSON configuration file
-def load_config():
-    config_path = os.getenv('CONFIG_PATH', '/app/config/config.json')
-    with open(config_path, 'r') as file:
-        config = json.load(file)
-    if 'rules' not in config:
-        config['rules'] = {}
-    return config
-
-config = load_config()
+from series_resolver import resolver
+from sonarr_client import sonarr
+from rule_planner import EpisodeIndex, build_plan, plan_new_series, parse_adaptive, adaptive_count
+from config_store import config_cache
+from tag_sync import tag_labels
+from missing_store import missing_store, payload_source
+from metrics import metrics
+from watch_history import watch_history
+from search_dispatcher import search_dispatcher
+from logging_config import configure_logging
+from sonarr_utils import parse_sonarr_date
 
 # Load environment variables
 load_dotenv()
 
 # Define global variables based on environment settings
-SONARR_URL = os.getenv('SONARR_URL')
-SONARR_API_KEY = os.getenv('SONARR_API_KEY')
-LOG_PATH = os.getenv('LOG_PATH', '/app/logs/app.log')
-MISSING_LOG_PATH = os.getenv('MISSING_LOG_PATH', '/app/logs/missing.log')
-
-# Setup logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-logger = logging.getLogger()
-handler = logging.FileHandler(LOG_PATH)
-logger.addHandler(handler)
+DELETE_WORKERS = int(os.getenv('DELETE_WORKERS', '4'))
+QUEUE_PAGE_SIZE = int(os.getenv('QUEUE_PAGE_SIZE', '200'))
+ADAPTIVE_MIN = int(os.getenv('ADAPTIVE_MIN', '1'))
+ADAPTIVE_MAX = int(os.getenv('ADAPTIVE_MAX', '10'))
+ADAPTIVE_HEADROOM = float(os.getenv('ADAPTIVE_HEADROOM', '1.5'))
+# Used until Sonarr's history has grab and import pairs to measure
+ADAPTIVE_LATENCY_HOURS = float(os.getenv('ADAPTIVE_LATENCY_HOURS', '6'))
+LATENCY_REFRESH_SECONDS = 3600
+LATENCY_HISTORY_SIZE = 250
+
+# Handlers come from logging_config.configure_logging(), called by the entry point
+logger = logging.getLogger(__name__)
+# Records from this logger are also written to missing.log
 missing_logger = logging.getLogger('missing')
-missing_handler = logging.FileHandler(MISSING_LOG_PATH)
-missing_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-missing_logger.addHandler(missing_handler)
-def get_server_activity():
-    """Read current viewing details from Server webhook stored data."""
+
+_latency_lock = threading.Lock()
+_latency = {'hours': None, 'measured_at': 0}
+
+def get_server_activity(data=None):
+    """Read current viewing details from a Server webhook payload.
+
+    When no payload is passed in, fall back to the data stored by older
+    versions of the webhook listener so the script can still be run by hand.
+    """
     try:
-        with open('/app/temp/data_from_server.json', 'r') as file:
-            data = json.load(file)
-            
+        if data is None:
+            with open('/app/temp/data_from_server.json', 'r') as file:
+                data = json.load(file)
+
         # Try Jellyfin format first
         series_title = data.get('server_title')
         season_number = data.get('server_season_num')
@@ -60,204 +73,218 @@ def get_server_activity():
         logger.error(f"Failed to read or parse data from Server webhook: {str(e)}")
     return None, None, None
 
-def get_series_id(series_name):
-    """Fetch series ID by name from Sonarr with flexible matching."""
+def get_provider_ids(data):
+    """Extract TVDB/TMDB/IMDb series IDs from a Server webhook payload, if present."""
+    provider_ids = {}
+    if not data:
+        return provider_ids
+    for provider in ('tvdb', 'tmdb', 'imdb'):
+        for prefix in ('server', 'plex'):
+            value = data.get(f"{prefix}_{provider}_id")
+            # Tautulli leaves unknown template fields empty
+            if value and str(value).strip():
+                provider_ids[provider] = str(value).strip()
+                break
+    return provider_ids
+
+def get_series_id(series_name, provider_ids=None, source=None, record_missing=True):
+    """Resolve a series ID from provider IDs or title using the cached series index.
+
+    Unless record_missing is False, an unknown title is recorded as missing.
+    """
     logger.info(f"Searching for series: {series_name}")
-    url = f"{SONARR_URL}/api/v3/series"
-    headers = {'X-Api-Key': SONARR_API_KEY}
-    response = requests.get(url, headers=headers)
-    if response.ok:
-        series_list = response.json()
-        
-        # Try exact match first
-        for series in series_list:
-            series_title_no_year = series['title'].split('(')[0].strip().lower()
-            if series_title_no_year == series_name.lower():
-                return series['id']
-            if series['title'].lower() == series_name.lower():
-                return series['id']
-        
-        # Try flexible matching
-        search_name = series_name.lower().replace('the ', '').replace(' ', '')
-        for series in series_list:
-            series_title = series['title'].lower()
-            clean_title = series_title.replace('the ', '').replace(' ', '')
-            if clean_title == search_name:
-                return series['id']
-            if '(' in series_title:
-                base_title = series_title.split('(')[0].strip()
-                clean_base = base_title.replace('the ', '').replace(' ', '')
-                if clean_base == search_name:
-                    return series['id']
-        
-        missing_logger.info(f"Series not found in Sonarr: {series_name}")
-    else:
-        logger.error("Failed to fetch series from Sonarr.")
-    return None
-def get_episode_details(series_id, season_number):
-    """Fetch details of episodes for a specific series and season from Sonarr."""
-    url = f"{SONARR_URL}/api/v3/episode?seriesId={series_id}&seasonNumber={season_number}"
-    headers = {'X-Api-Key': SONARR_API_KEY}
-    response = requests.get(url, headers=headers)
-    if response.ok:
-        return response.json()
-    logger.error("Failed to fetch episode details.")
-    return []
-
-def monitor_or_search_episodes(episode_ids, action_option):
-    """Either monitor or trigger a search for episodes in Sonarr based on the action_option."""
-    monitor_episodes(episode_ids, True)
-    if action_option == "search":
-        trigger_episode_search_in_sonarr(episode_ids)
+    series_id = resolver.resolve(series_name, provider_ids)
+    if series_id is None and record_missing:
+        try:
+            first_seen = missing_store.record(series_name, source)
+        except Exception as e:
+            logger.error(f"Failed to record missing series: {str(e)}")
+            first_seen = True
+        # The legacy log only gets one line per title rather than one per event
+        if first_seen:
+            missing_logger.info(f"Series not found in Sonarr: {series_name}")
+    return series_id
 
 def monitor_episodes(episode_ids, monitor=True):
     """Set episodes to monitored or unmonitored in Sonarr."""
-    url = f"{SONARR_URL}/api/v3/episode/monitor"
-    headers = {'X-Api-Key': SONARR_API_KEY, 'Content-Type': 'application/json'}
     data = {"episodeIds": episode_ids, "monitored": monitor}
-    response = requests.put(url, json=data, headers=headers)
+    response = sonarr.put('episode/monitor', json=data)
+    action = "monitored" if monitor else "unmonitored"
     if response.ok:
-        action = "monitored" if monitor else "unmonitored"
         logger.info(f"Episodes {episode_ids} successfully {action}.")
     else:
         logger.error(f"Failed to set episodes {action}. Response: {response.text}")
 
-def trigger_episode_search_in_sonarr(episode_ids):
-    """Trigger a search for specified episodes in Sonarr."""
-    url = f"{SONARR_URL}/api/v3/command"
-    headers = {'X-Api-Key': SONARR_API_KEY, 'Content-Type': 'application/json'}
-    data = {"name": "EpisodeSearch", "episodeIds": episode_ids}
-    response = requests.post(url, json=data, headers=headers)
-    if response.ok:
-        logger.info("Episode search command sent to Sonarr successfully.")
-    else:
-        logger.error(f"Failed to send episode search command. Response: {response.text}")
+def trigger_episode_search_in_sonarr(episode_ids, series_id=None):
+    """Queue a search for specified episodes; the dispatcher batches them into Sonarr commands."""
+    queued = search_dispatcher.request(episode_ids, series_id)
+    if queued:
+        logger.info(f"Queued search for {len(queued)} episode(s).")
 
 def unmonitor_episodes(episode_ids):
     """Unmonitor specified episodes in Sonarr."""
     monitor_episodes(episode_ids, False)
-def find_episodes_to_delete(all_episodes, keep_watched, last_watched_id):
-    """Find episodes to delete, ensuring they're not in the keep list and have files."""
-    episodes_to_delete = []
-    if keep_watched == "all":
-        return episodes_to_delete  # Skip deletion logic entirely if "all" is specified.
-    elif keep_watched == "season":
-        last_watched_season = next(ep['seasonNumber'] for ep in all_episodes if ep['id'] == last_watched_id)
-        episodes_to_delete = [ep for ep in all_episodes if ep['seasonNumber'] < last_watched_season and ep['hasFile']]
-    elif isinstance(keep_watched, int):
-        # Sort episodes by date, keeping only the specified count, including and prior to the last watched.
-        sorted_episodes = sorted(all_episodes, key=lambda ep: (ep['seasonNumber'], ep['episodeNumber']), reverse=True)
-        last_watched_index = next((i for i, ep in enumerate(sorted_episodes) if ep['id'] == last_watched_id), None)
-        keep_range = sorted_episodes[max(0, last_watched_index - keep_watched + 1):last_watched_index + 1]
-        keep_ids = {ep['id'] for ep in keep_range}
-        episodes_to_delete = [ep for ep in all_episodes if ep['id'] not in keep_ids and ep['hasFile']]
-
-    return [ep['episodeFileId'] for ep in episodes_to_delete if 'episodeFileId' in ep]
+def delete_episode_file(episode_file_id):
+    """Delete one episode file, returning 'deleted', 'missing' or 'failed'."""
+    try:
+        response = sonarr.delete(f"episodeFile/{episode_file_id}")
+        if response.status_code == 404:
+            return 'missing'
+        response.raise_for_status()  # Raise an HTTPError for bad responses
+        return 'deleted'
+    except requests.exceptions.HTTPError as http_err:
+        logger.error(f"HTTP error occurred: {http_err} - Response: {response.text}")
+    except Exception as err:
+        logger.error(f"Other error occurred: {err}")
+    return 'failed'
 
 def delete_episodes_in_sonarr(episode_file_ids):
-    """Delete specified episodes in Sonarr."""
+    """Delete episode files in Sonarr and return a {file_id: result} mapping.
+
+    Uses the bulk endpoint when Sonarr supports it and falls back to
+    bounded-parallel single deletes otherwise.
+    """
+    episode_file_ids = list(dict.fromkeys(episode_file_ids))
     if not episode_file_ids:
         logger.info("No episodes to delete.")
-        return
+        return {}
 
-    failed_deletes = []
-    for episode_file_id in episode_file_ids:
+    results = None
+    if len(episode_file_ids) > 1:
         try:
-            url = f"{SONARR_URL}/api/v3/episodeFile/{episode_file_id}"
-            headers = {'X-Api-Key': SONARR_API_KEY}
-            response = requests.delete(url, headers=headers)
-            response.raise_for_status()  # Raise an HTTPError for bad responses
-            logger.info(f"Successfully deleted episode file with ID: {episode_file_id}")
-        except requests.exceptions.HTTPError as http_err:
-            logger.error(f"HTTP error occurred: {http_err} - Response: {response.text}")
-            failed_deletes.append(episode_file_id)
-        except Exception as err:
-            logger.error(f"Other error occurred: {err}")
-            failed_deletes.append(episode_file_id)
-
+            response = sonarr.delete('episodeFile/bulk', json={"episodeFileIds": episode_file_ids})
+            if response.ok:
+                results = {file_id: 'deleted' for file_id in episode_file_ids}
+            else:
+                logger.warning(f"Bulk episode file delete failed ({response.status_code}), deleting individually")
+        except requests.exceptions.RequestException as err:
+            logger.warning(f"Bulk episode file delete failed ({err}), deleting individually")
+
+    if results is None:
+        with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as pool:
+            results = dict(zip(episode_file_ids, pool.map(delete_episode_file, episode_file_ids)))
+
+    for file_id, result in results.items():
+        if result == 'deleted':
+            logger.info(f"Successfully deleted episode file with ID: {file_id}")
+        elif result == 'missing':
+            logger.info(f"Episode file with ID {file_id} was already gone")
+    failed_deletes = [file_id for file_id, result in results.items() if result == 'failed']
     if failed_deletes:
         logger.error(f"Failed to delete the following episode files: {failed_deletes}")
+    return results
 
-def fetch_next_episodes(series_id, season_number, episode_number, get_option):
-    """Fetch the next num_episodes episodes starting from the given season and episode."""
-    next_episode_ids = []
-
-    try:
-        if get_option == "all":
-            # Fetch all episodes from Sonarr
-            all_episodes = fetch_all_episodes(series_id)
-            next_episode_ids.extend([ep['id'] for ep in all_episodes if ep['seasonNumber'] >= season_number])
-            return next_episode_ids
-        num_episodes = int(get_option)
-        # Get remaining episodes in the current season
-        current_season_episodes = get_episode_details(series_id, season_number)
-        next_episode_ids.extend([ep['id'] for ep in current_season_episodes if ep['episodeNumber'] > episode_number])
-
-        # Fetch episodes from the next season if needed
-        next_season_number = season_number + 1
-        while len(next_episode_ids) < num_episodes:
-            next_season_episodes = get_episode_details(series_id, next_season_number)
-            next_episode_ids.extend([ep['id'] for ep in next_season_episodes])
-            next_season_number += 1
-
-        return next_episode_ids[:num_episodes]
-    except ValueError:
-        if get_option == 'season':
-            # Fetch all remaining episodes in the current season
-            current_season_episodes = get_episode_details(series_id, season_number)
-            next_episode_ids.extend([ep['id'] for ep in current_season_episodes if ep['episodeNumber'] > episode_number])
-            return next_episode_ids
-        else:
-            raise ValueError(f"Invalid get_option value: {get_option}")
 def fetch_all_episodes(series_id):
-    """Fetch all episodes for a series from Sonarr."""
-    url = f"{SONARR_URL}/api/v3/episode?seriesId={series_id}"
-    headers = {'X-Api-Key': SONARR_API_KEY}
-    response = requests.get(url, headers=headers)
-    if response.ok:
-        return response.json()
-    logger.error("Failed to fetch all episodes.")
-    return []
-
-def delete_old_episodes(series_id, keep_episode_ids, rule):
-    """Delete old episodes that are not in the keep list."""
-    all_episodes = fetch_all_episodes(series_id)
-    episodes_with_files = [ep for ep in all_episodes if ep['hasFile']]
-
-    keep_watched = rule.get('keep_watched', 'all')
-
-    if keep_watched == "all":
-        logger.info("No episodes to delete as keep_watched is set to 'all'.")
-        return
-
-    if keep_watched == "season":
-        last_watched_season = max(ep['seasonNumber'] for ep in all_episodes if ep['id'] in keep_episode_ids)
-        episodes_to_delete = [ep['episodeFileId'] for ep in episodes_with_files if ep['seasonNumber'] < last_watched_season and ep['id'] not in keep_episode_ids]
-    else:
-        episodes_to_delete = [ep['episodeFileId'] for ep in episodes_with_files if ep['id'] not in keep_episode_ids]
-
-    delete_episodes_in_sonarr(episodes_to_delete)
-
-def process_episodes_based_on_rules(series_id, season_number, episode_number, rule):
-    """Fetch, monitor/search, and delete episodes based on defined rules."""
-    all_episodes = fetch_all_episodes(series_id)
-    last_watched_id = next(ep['id'] for ep in all_episodes if ep['seasonNumber'] == season_number and ep['episodeNumber'] == episode_number)
-
-    if not rule['monitor_watched']:
-        unmonitor_episodes([last_watched_id])
-
-    next_episode_ids = fetch_next_episodes(series_id, season_number, episode_number, rule['get_option'])
-    monitor_or_search_episodes(next_episode_ids, rule['action_option'])
-
-    episodes_to_delete = find_episodes_to_delete(all_episodes, rule['keep_watched'], last_watched_id)
-    delete_episodes_in_sonarr(episodes_to_delete)
+    """Fetch all episodes for a series from Sonarr.
+
+    A failed read raises rather than looking like a series without episodes,
+    so a job can be retried instead of dropping the event.
+    """
+    response = sonarr.get('episode', params={'seriesId': series_id})
+    if not response.ok:
+        logger.error(f"Failed to fetch all episodes. Response: {response.status_code}")
+        response.raise_for_status()
+    return response.json()
+
+def measure_download_latency():
+    """Median hours from grab to import over Sonarr's recent history, or None."""
+    response = sonarr.get('history', params={
+        'page': 1,
+        'pageSize': LATENCY_HISTORY_SIZE,
+        'sortKey': 'date',
+        'sortDirection': 'descending'
+    })
+    if not response.ok:
+        return None
+    grabbed, imported = {}, {}
+    for record in response.json().get('records', []):
+        download_id = record.get('downloadId')
+        if not download_id or not record.get('date'):
+            continue
+        if record.get('eventType') == 'grabbed':
+            grabbed[download_id] = record['date']
+        elif record.get('eventType') == 'downloadFolderImported':
+            imported.setdefault(download_id, record['date'])
+    delays = []
+    for download_id, imported_at in imported.items():
+        if download_id in grabbed:
+            delay = parse_sonarr_date(imported_at) - parse_sonarr_date(grabbed[download_id])
+            delays.append(delay.total_seconds() / 3600)
+    return statistics.median(delays) if delays else None
+
+def typical_download_latency():
+    """Hours a download usually takes, remeasured from Sonarr's history at most hourly."""
+    with _latency_lock:
+        if time.time() - _latency['measured_at'] > LATENCY_REFRESH_SECONDS:
+            _latency['measured_at'] = time.time()
+            try:
+                _latency['hours'] = measure_download_latency()
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Could not measure download latency: {str(e)}")
+        return _latency['hours'] or ADAPTIVE_LATENCY_HOURS
+
+def resolve_lookahead(series_id, rule, pending=None):
+    """The rule with an 'adaptive' get_option replaced by a count sized from viewing velocity.
+
+    Returns (rule, details); details is None for fixed get_options.
+    """
+    bounds = parse_adaptive(rule['get_option'], ADAPTIVE_MIN, ADAPTIVE_MAX)
+    if bounds is None:
+        return rule, None
+    episodes_per_day = watch_history.velocity(series_id, pending)
+    latency_hours = typical_download_latency()
+    count = adaptive_count(episodes_per_day, latency_hours / 24, bounds, ADAPTIVE_HEADROOM)
+    details = {
+        'episodes_per_day': round(episodes_per_day, 2),
+        'latency_hours': round(latency_hours, 1),
+        'bounds': list(bounds),
+        'count': count
+    }
+    logger.info(f"Adaptive lookahead for series {series_id}: {count} episodes at "
+                f"{details['episodes_per_day']} a day with {details['latency_hours']}h downloads")
+    return dict(rule, get_option=str(count)), details
+
+def execute_plan(plan):
+    """Apply a rule plan to Sonarr."""
+    if plan['unmonitor']:
+        with metrics.timer('ocdarr_stage_duration_seconds', stage='unmonitor'):
+            unmonitor_episodes(plan['unmonitor'])
+    if plan['monitor']:
+        with metrics.timer('ocdarr_stage_duration_seconds', stage='monitor'):
+            monitor_episodes(plan['monitor'], True)
+    if plan['search']:
+        with metrics.timer('ocdarr_stage_duration_seconds', stage='search'):
+            trigger_episode_search_in_sonarr(plan['search'], plan['series_id'])
+    with metrics.timer('ocdarr_stage_duration_seconds', stage='delete'):
+        return delete_episodes_in_sonarr(plan['delete'])
+
+def process_episodes_based_on_rules(series_id, season_number, episode_number, rule, dry_run=False, source=None):
+    """Plan and apply monitoring, searching and deletion for a watched episode.
+
+    Episodes are fetched once per event. With dry_run the plan is returned
+    without making any changes in Sonarr.
+    """
+    with metrics.timer('ocdarr_stage_duration_seconds', stage='fetch'):
+        index = EpisodeIndex(fetch_all_episodes(series_id))
+    with metrics.timer('ocdarr_stage_duration_seconds', stage='plan'):
+        rule, adaptive = resolve_lookahead(series_id, rule, (season_number, episode_number))
+        plan = build_plan(series_id, index, season_number, episode_number, rule)
+    if adaptive:
+        plan['adaptive'] = adaptive
+    logger.info(f"Plan for series {series_id} S{season_number}E{episode_number}: "
+                f"monitor {len(plan['monitor'])}, unmonitor {len(plan['unmonitor'])}, "
+                f"search {len(plan['search'])}, delete {len(plan['delete'])}")
+    if not dry_run:
+        plan['delete_results'] = execute_plan(plan)
+        try:
+            watch_history.record(series_id, season_number, episode_number, source)
+        except Exception as e:
+            logger.error(f"Failed to record watch position: {str(e)}")
+    return plan
 
-    if rule['keep_watched'] != "all":
-        keep_episode_ids = next_episode_ids + [last_watched_id]
-        delete_old_episodes(series_id, keep_episode_ids, rule)
 def apply_default_rule_to_new_series(series_id):
     """Apply default rule to a newly added series, handling monitored season(s)."""
-    config = load_config()
+    config = config_cache.get()
     default_rule = config.get('default_rule', '1n1')
     rule = config['rules'].get(default_rule)
     
@@ -266,153 +293,156 @@ def apply_default_rule_to_new_series(series_id):
         return
         
     apply_rule_to_series(series_id, rule)
-def cancel_downloads_after_episode(series_id, season_number, cutoff_episode):
-    """Cancel any active downloads for episodes after the specified episode."""
-    url = f"{SONARR_URL}/api/v3/queue"
-    headers = {'X-Api-Key': SONARR_API_KEY}
-    
-    try:
-        response = requests.get(url, headers=headers)
+def iter_queue(series_id=None, page_size=QUEUE_PAGE_SIZE):
+    """Yield Sonarr queue records page by page, filtered to one series on the server.
+
+    Records are checked against series_id again locally in case the Sonarr
+    version ignores the seriesIds filter.
+    """
+    params = {'pageSize': page_size, 'includeEpisode': 'true', 'includeUnknownSeriesItems': 'false'}
+    if series_id is not None:
+        params['seriesIds'] = series_id
+    page = 1
+    while True:
+        response = sonarr.get('queue', params=dict(params, page=page))
         if not response.ok:
-            logger.error(f"Failed to get queue: {response.text}")
+            logger.error(f"Failed to get queue page {page}: {response.text}")
             return
-            
         queue_data = response.json()
         if not isinstance(queue_data, dict) or 'records' not in queue_data:
             logger.error("Unexpected queue data format")
             return
-            
-        # Find matching downloads that are still in progress
-        for item in queue_data['records']:
-            try:
-                # Skip completed downloads
-                if item.get('status') == 'completed':
-                    continue
-                    
-                # Check if this is a download for our series and season
-                episode = item.get('episode', {})
-                if (item.get('seriesId') == series_id and 
-                    episode.get('seasonNumber') == season_number and 
-                    episode.get('episodeNumber', 0) > cutoff_episode):
-                    
-                    queue_item_id = item.get('id')
-                    if not queue_item_id:
-                        continue
-                        
-                    # Cancel the download
-                    cancel_url = f"{SONARR_URL}/api/v3/queue/{queue_item_id}"
-                    cancel_response = requests.delete(
-                        cancel_url, 
-                        headers=headers,
-                        params={'removeFromClient': 'true', 'blocklist': False}
-                    )
-                    
-                    ep_num = episode.get('episodeNumber')
-                    if cancel_response.ok:
-                        logger.info(f"Cancelled in-progress download for S{season_number}E{ep_num}")
-                    else:
-                        logger.error(f"Failed to cancel download for S{season_number}E{ep_num}: {cancel_response.text}")
-                        
-            except Exception as item_error:
-                logger.error(f"Error processing queue item: {str(item_error)}")
+        records = queue_data['records']
+        for item in records:
+            if series_id is None or item.get('seriesId') == series_id:
+                yield item
+        if not records or page * page_size >= queue_data.get('totalRecords', 0):
+            return
+        page += 1
+
+def remove_queue_items(queue_item_ids):
+    """Remove queue items and their downloads, in one bulk call when Sonarr supports it."""
+    queue_item_ids = list(dict.fromkeys(queue_item_ids))
+    if not queue_item_ids:
+        return []
+    params = {'removeFromClient': 'true', 'blocklist': 'false'}
+    try:
+        response = sonarr.delete('queue/bulk', params=params, json={"ids": queue_item_ids})
+        if response.ok:
+            return queue_item_ids
+        logger.warning(f"Bulk queue removal failed ({response.status_code}), removing individually")
+    except requests.exceptions.RequestException as err:
+        logger.warning(f"Bulk queue removal failed ({err}), removing individually")
+
+    removed = []
+    for queue_item_id in queue_item_ids:
+        try:
+            response = sonarr.delete(f"queue/{queue_item_id}", params=params)
+            if response.ok or response.status_code == 404:
+                removed.append(queue_item_id)
+            else:
+                logger.error(f"Failed to remove queue item {queue_item_id}: {response.text}")
+        except requests.exceptions.RequestException as err:
+            logger.error(f"Failed to remove queue item {queue_item_id}: {err}")
+    return removed
+
+def cancel_downloads(series_id, wanted):
+    """Cancel active downloads of a series whose episode matches `wanted(episode)`.
+
+    Returns the IDs of the episodes whose downloads were cancelled.
+    """
+    try:
+        matches = {}
+        for item in iter_queue(series_id):
+            if item.get('status') == 'completed':
                 continue
-                
+            episode = item.get('episode') or {'id': item.get('episodeId')}
+            if item.get('id') and wanted(episode):
+                matches[item['id']] = episode
+        if not matches:
+            return []
+        removed = remove_queue_items(list(matches))
+        for queue_item_id in removed:
+            episode = matches[queue_item_id]
+            logger.info(f"Cancelled in-progress download for series {series_id} "
+                        f"S{episode.get('seasonNumber')}E{episode.get('episodeNumber')}")
+        return list(dict.fromkeys(matches[queue_item_id].get('id') for queue_item_id in removed))
     except Exception as e:
         logger.error(f"Error cancelling downloads: {str(e)}")
-        return
+        return []
+
+def cancel_downloads_for_episodes(series_id, episode_ids):
+    """Cancel active downloads for the given episodes of a series."""
+    episode_ids = set(episode_ids)
+    if not episode_ids:
+        return []
+    return cancel_downloads(series_id, lambda episode: episode.get('id') in episode_ids)
+
 def apply_rule_to_series(series_id, rule):
-    """Apply specified rule to a series, handling monitored season(s)."""
-    url = f"{SONARR_URL}/api/v3/episode?seriesId={series_id}"
-    headers = {'X-Api-Key': SONARR_API_KEY}
-    
-    try:
-        response = requests.get(url, headers=headers)
-        if response.ok:
-            episodes = response.json()
-            
-            # Group monitored episodes by season
-            monitored_seasons = {}
-            for ep in episodes:
-                if ep['monitored']:
-                    season = ep['seasonNumber']
-                    if season not in monitored_seasons:
-                        monitored_seasons[season] = []
-                    monitored_seasons[season].append(ep)
-            
-            if not monitored_seasons:
-                logger.info(f"No monitored seasons found for series {series_id}")
-                return
-                
-            logger.info(f"Found monitored seasons: {list(monitored_seasons.keys())}")
-            
-            # Process each monitored season
-            for season_number, season_episodes in monitored_seasons.items():
-                if season_number == 0:  # Skip specials
-                    continue
-                    
-                # Sort episodes by number
-                season_episodes.sort(key=lambda x: x['episodeNumber'])
-                
-                logger.info(f"Processing season {season_number}")
-                
-                # Apply rule based on get_option
-                if rule['get_option'] == '1':  # Only monitor first episode
-                    for ep in season_episodes:
-                        should_monitor = ep['episodeNumber'] == 1
-                        monitor_episodes([ep['id']], should_monitor)
-                        logger.info(f"{'Monitoring' if should_monitor else 'Unmonitoring'} S{season_number}E{ep['episodeNumber']}")
-                        
-                elif rule['get_option'] == 'season':
-                    # Monitor all episodes in season
-                    episode_ids = [ep['id'] for ep in season_episodes]
-                    monitor_episodes(episode_ids, True)
-                    
-                elif rule['get_option'].isdigit():
-                    # Monitor specified number of episodes
-                    num_episodes = int(rule['get_option'])
-                    for i, ep in enumerate(season_episodes):
-                        should_monitor = i < num_episodes
-                        monitor_episodes([ep['id']], should_monitor)
-                
-    except Exception as e:
-        logger.error(f"Error applying rule to series: {str(e)}")
+    """Apply specified rule to a series, handling monitored season(s).
+
+    Sonarr errors propagate so the series_add job is retried.
+    """
+    episodes = fetch_all_episodes(series_id)
+    rule, _ = resolve_lookahead(series_id, rule)
+    plan = plan_new_series(series_id, episodes, rule)
+    if not plan['seasons']:
+        logger.info(f"No monitored seasons found for series {series_id}")
+        return
+
+    logger.info(f"Found monitored seasons: {plan['seasons']}")
+
+    # Only send episodes whose state actually changes, in at most two bulk calls
+    to_monitor, to_unmonitor = plan['monitor'], plan['unmonitor']
+    if to_monitor:
+        monitor_episodes(to_monitor, True)
+    if to_unmonitor:
+        monitor_episodes(to_unmonitor, False)
+        cancel_downloads_for_episodes(series_id, to_unmonitor)
+
+    calls = bool(to_monitor) + bool(to_unmonitor)
+    total = len(to_monitor) + len(to_unmonitor) + plan['unchanged']
+    logger.info(f"Applied rule to series {series_id}: {len(to_monitor)} monitored, "
+                f"{len(to_unmonitor)} unmonitored, {plan['unchanged']} unchanged "
+                f"in {calls} call(s), {max(total - calls, 0)} per-episode calls avoided")
 
 def get_rule_by_tags(series_tags):
-    """Get matching rule based on series tags."""
-    config = load_config()
-    
-    # Check if any tags match rule names
-    for tag in series_tags:
-        if tag in config['rules']:
-            return config['rules'][tag]
-    
-    # Return default rule if no match found
-    default_rule = config.get('default_rule', '1n1')
-    return config['rules'].get(default_rule)
+    """Get matching rule based on series tags, else the default rule."""
+    rule_name, rule = config_cache.rule_for_tags(tag_labels(series_tags))
+    return rule
+
+def main(data=None, dry_run=False):
+    """Apply the matching rule to the episode described by a Server webhook payload.
+
+    Returns the executed (or, with dry_run, proposed) plan, or None.
+    """
+    series_name, season_number, episode_number = get_server_activity(data)
 
-def main():
-    series_name, season_number, episode_number = get_server_activity()
-    
     if series_name:
-        series_id = get_series_id(series_name)
+        with metrics.timer('ocdarr_stage_duration_seconds', stage='resolve'):
+            # A dry run must not add the title to the missing series report
+            series_id = get_series_id(series_name, get_provider_ids(data), payload_source(data),
+                                      record_missing=not dry_run)
         if series_id:
             # Find the specific rule for the series, else apply the default rule
-            rule = next((details for key, details in config['rules'].items() 
-                        if str(series_id) in details.get('series', [])), None)
-            
-            if not rule:
-                rule = config['rules'].get(config.get('default_rule', '1n1'))
-                logger.info(f"No specific rule found for series ID {series_id}. Applying default rule: {rule}")
+            rule_name, rule = config_cache.rule_for_series(series_id)
+            if str(series_id) not in config_cache.series_rule_index():
+                logger.info(f"No specific rule found for series ID {series_id}. Applying default rule: {rule_name}")
             
             if rule:
-                process_episodes_based_on_rules(series_id, season_number, episode_number, rule)
+                return process_episodes_based_on_rules(series_id, season_number, episode_number, rule, dry_run,
+                                                       payload_source(data))
             else:
                 logger.warning(f"No rule found for series ID {series_id}. Skipping operations.")
         else:
             logger.error(f"Series ID not found for series: {series_name}")
     else:
         logger.error("No server activity found.")
+    return None
 
 if __name__ == "__main__":
+    configure_logging()
     main()
+    # No background dispatcher when run by hand
+    search_dispatcher.drain()
 
@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import logging
+import db
+
+SESSION_TTL = int(os.getenv('SESSION_TTL', '21600'))
+SESSION_COALESCE_SECONDS = float(os.getenv('SESSION_COALESCE_SECONDS', '15'))
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS playback_seen (
+    activity_key TEXT PRIMARY KEY,
+    seen_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS playback_seen_seen_at ON playback_seen (seen_at);
+CREATE TABLE IF NOT EXISTS playback_outcomes (
+    outcome TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+'''
+
+def activity_key(data):
+    """(user, series, season, episode) for a normalized Server webhook payload."""
+    title = data.get('server_title') or data.get('plex_title') or ''
+    season = data.get('server_season_num') or data.get('plex_season_num')
+    episode = data.get('server_ep_num') or data.get('plex_ep_num')
+    user = data.get('server_user') or data.get('plex_user') or ''
+    return (str(user).lower(), title.strip().lower(), str(season), str(episode))
+
+def episode_order(key):
+    """Sort key for the (season, episode) part of an activity key."""
+    try:
+        return (int(key[2]), int(key[3]))
+    except ValueError:
+        return (-1, -1)
+
+class PlaybackSessionTracker:
+    """Turns a stream of playback events into one rule trigger per episode.
+
+    An episode fires the first time it is seen for a user; repeats within
+    `ttl` seconds are suppressed. Triggers are queued `coalesce_window`
+    seconds ahead, and a later episode of the same show for the same user
+    arriving in that time replaces the queued trigger, so when several
+    episodes arrive back to back only the latest is processed. Both the
+    sightings and the queued triggers live in SQLite, so this holds across
+    gunicorn workers and restarts.
+
+    `submit(data, delay, merge)` queues the trigger; `merge` is handed
+    to JobQueue.enqueue to fold it into one already waiting.
+    """
+
+    def __init__(self, submit, ttl=SESSION_TTL, coalesce_window=SESSION_COALESCE_SECONDS, db_path=None):
+        self.submit = submit
+        self.ttl = ttl
+        self.coalesce_window = coalesce_window
+        self.store = db.Store(SCHEMA, db_path)
+        self._last_prune = 0
+
+    def _first_sighting(self, key, now):
+        """Record a sighting; True unless the episode was already seen within `ttl`."""
+        with self.store.transaction() as conn:
+            cursor = conn.execute(
+                'INSERT INTO playback_seen (activity_key, seen_at) VALUES (?, ?) '
+                'ON CONFLICT (activity_key) DO UPDATE SET seen_at = excluded.seen_at WHERE seen_at < ?',
+                (json.dumps(key), now, now - self.ttl))
+            if now - self._last_prune >= 60:
+                self._last_prune = now
+                conn.execute('DELETE FROM playback_seen WHERE seen_at < ?', (now - self.ttl,))
+            return cursor.rowcount == 1
+
+    def _count(self, outcome):
+        conn = self.store.connect()
+        try:
+            conn.execute('INSERT INTO playback_outcomes (outcome, count) VALUES (?, 1) '
+                         'ON CONFLICT (outcome) DO UPDATE SET count = count + 1', (outcome,))
+        finally:
+            conn.close()
+
+    def observe(self, data):
+        """Record a playback event and return 'scheduled', 'duplicate' or 'superseded'."""
+        key = activity_key(data)
+        if not self._first_sighting(key, time.time()):
+            self._count('duplicate')
+            return 'duplicate'
+
+        outcome = 'scheduled'
+
+        def merge(queued, new):
+            nonlocal outcome
+            queued_key = activity_key(queued)
+            if queued_key[:2] != key[:2]:
+                return None
+            if episode_order(key) < episode_order(queued_key):
+                # An older episode arrived late; the queued trigger already covers it
+                outcome = 'superseded'
+                return queued
+            outcome = 'coalesced'
+            logger.info(f"Coalescing trigger for {queued_key[1]} S{queued_key[2]}E{queued_key[3]} into S{key[2]}E{key[3]}")
+            return new
+
+        self.submit(data, self.coalesce_window, merge)
+        self._count(outcome)
+        return 'superseded' if outcome == 'superseded' else 'scheduled'
+
+    def stats(self):
+        conn = self.store.connect()
+        try:
+            counts = {row['outcome']: row['count'] for row in conn.execute('SELECT outcome, count FROM playback_outcomes')}
+            tracked = conn.execute('SELECT COUNT(*) AS n FROM playback_seen WHERE seen_at >= ?',
+                                   (time.time() - self.ttl,)).fetchone()['n']
+        finally:
+            conn.close()
+        return {
+            'fired': counts.get('scheduled', 0),
+            'duplicates_suppressed': counts.get('duplicate', 0),
+            'superseded': counts.get('superseded', 0) + counts.get('coalesced', 0),
+            'tracked_episodes': tracked
+        }
@@ -0,0 +1,232 @@
+import os
+import time
+import random
+import logging
+import threading
+import requests
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+from metrics import metrics, sonarr_endpoint
+
+load_dotenv()
+
+SONARR_URL = os.getenv('SONARR_URL')
+SONARR_API_KEY = os.getenv('SONARR_API_KEY')
+SONARR_POOL_SIZE = int(os.getenv('SONARR_POOL_SIZE', '10'))
+SONARR_MAX_RETRIES = int(os.getenv('SONARR_MAX_RETRIES', '3'))
+SONARR_CONNECT_TIMEOUT = float(os.getenv('SONARR_CONNECT_TIMEOUT', '3.05'))
+SONARR_READ_TIMEOUT = float(os.getenv('SONARR_READ_TIMEOUT', '15'))
+SONARR_BREAKER_THRESHOLD = int(os.getenv('SONARR_BREAKER_THRESHOLD', '5'))
+SONARR_BREAKER_RESET = float(os.getenv('SONARR_BREAKER_RESET', '30'))
+
+logger = logging.getLogger(__name__)
+
+# Read timeouts for endpoints that are slower than the default on large libraries
+ENDPOINT_READ_TIMEOUTS = {
+    'series': 60,
+    'episode': 30,
+    'episodefile': 30,
+    'history': 30,
+    'queue': 30,
+}
+
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'DELETE'}
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+class SonarrUnavailableError(requests.exceptions.ConnectionError):
+    """Raised without touching the network while the circuit breaker is open."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Sonarr unavailable, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """Opens after consecutive failures and lets a single probe through after a cooldown."""
+
+    def __init__(self, failure_threshold=SONARR_BREAKER_THRESHOLD, reset_timeout=SONARR_BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+    def retry_after(self):
+        """Seconds until the breaker lets a probe request through."""
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("Sonarr reachable again, closing circuit breaker")
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.error(f"Sonarr failed {self._failures} times in a row, opening circuit breaker")
+                self._opened_at = time.monotonic()
+
+class RateLimiter:
+    """Token bucket allowing `per_minute` requests a minute, in bursts of up to `burst`."""
+
+    def __init__(self, per_minute, burst=None):
+        self.rate = per_minute / 60.0
+        self.capacity = burst or max(1, per_minute // 10)
+        self._lock = threading.Lock()
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self.acquired = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """Take one token, sleeping until one is available."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.acquired += 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def try_acquire(self, tokens=1):
+        """Take `tokens` at once if they are available now; never waits."""
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                self.acquired += tokens
+                return True
+            return False
+
+class SonarrClient:
+    """Pooled keep-alive client for the Sonarr v3 API.
+
+    Paths are relative to /api/v3. Responses are returned as-is so callers can
+    keep checking ``response.ok``; connection errors and timeouts still raise.
+    Idempotent requests are retried with jittered exponential backoff, and a
+    circuit breaker fails fast with SonarrUnavailableError while Sonarr is down.
+    """
+
+    def __init__(self, base_url, api_key, pool_size=SONARR_POOL_SIZE, max_retries=SONARR_MAX_RETRIES,
+                 backoff=0.5, breaker=None):
+        self.base_url = (base_url or '').rstrip('/')
+        self.api_key = api_key
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self._local = threading.local()
+        self.session = requests.Session()
+        self.session.headers.update({'X-Api-Key': api_key or ''})
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def url(self, path):
+        return f"{self.base_url}/api/v3/{path.lstrip('/')}"
+
+    def timeout_for(self, path):
+        endpoint = path.lstrip('/').split('/')[0].split('?')[0].lower()
+        return (SONARR_CONNECT_TIMEOUT, ENDPOINT_READ_TIMEOUTS.get(endpoint, SONARR_READ_TIMEOUT))
+
+    def _sleep_before_retry(self, attempt):
+        # Full jitter keeps several workers from hammering Sonarr in lockstep
+        time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+    def request(self, method, path, **kwargs):
+        method = method.upper()
+        kwargs.setdefault('timeout', self.timeout_for(path))
+        attempts = self.max_retries + 1 if method in IDEMPOTENT_METHODS else 1
+        url = self.url(path)
+        endpoint = sonarr_endpoint(path)
+
+        limiter = getattr(self._local, 'limiter', None)
+        for attempt in range(attempts):
+            if limiter is not None:
+                limiter.acquire()
+            if not self.breaker.allow():
+                raise SonarrUnavailableError(self.breaker.retry_after())
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                metrics.sonarr_call(endpoint, method, 'error', time.perf_counter() - started)
+                self.breaker.record_failure()
+                if attempt + 1 >= attempts:
+                    raise
+                logger.warning(f"Sonarr {method} {path} failed ({str(e)}), retrying")
+                self._sleep_before_retry(attempt)
+                continue
+            except Exception:
+                # Any other failure still settles a half-open probe, or the breaker would never close
+                metrics.sonarr_call(endpoint, method, 'error', time.perf_counter() - started)
+                self.breaker.record_failure()
+                raise
+
+            metrics.sonarr_call(endpoint, method, response.status_code, time.perf_counter() - started)
+            if response.status_code >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            if response.status_code in RETRY_STATUS_CODES and attempt + 1 < attempts:
+                logger.warning(f"Sonarr {method} {path} returned {response.status_code}, retrying")
+                self._sleep_before_retry(attempt)
+                continue
+            return response
+
+    @contextmanager
+    def throttled(self, limiter):
+        """Make every request this thread sends in the block, retries included, wait on `limiter`."""
+        previous = getattr(self._local, 'limiter', None)
+        self._local.limiter = limiter
+        try:
+            yield
+        finally:
+            self._local.limiter = previous
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+sonarr = SonarrClient(SONARR_URL, SONARR_API_KEY)
@@ -1,7 +1,13 @@
 import os
-import requests
-from datetime import datetime
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse, parse_qs
 from dotenv import load_dotenv
+from sonarr_client import sonarr
+from metrics import metrics
 
 # Load environment variables from .env file
 load_dotenv()
@@ -9,6 +15,14 @@ load_dotenv()
 # Configuration settings from environment variables
 SONARR_URL = os.getenv('SONARR_URL')
 SONARR_API_KEY = os.getenv('SONARR_API_KEY')
+DASHBOARD_FETCH_WORKERS = int(os.getenv('DASHBOARD_FETCH_WORKERS', '8'))
+CURRENT_SERIES_LIMIT = 12
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGES = 10
+UPCOMING_DAYS = int(os.getenv('UPCOMING_DAYS', '90'))
+UPCOMING_FULL_REFRESH = int(os.getenv('UPCOMING_FULL_REFRESH', '3600'))
+
+logger = logging.getLogger(__name__)
 
 def load_preferences():
     """
@@ -17,85 +31,234 @@ def load_preferences():
     """
     return {'SONARR_URL': SONARR_URL, 'SONARR_API_KEY': SONARR_API_KEY}
 
-def get_series_list(preferences):
-    url = f"{preferences['SONARR_URL']}/api/v3/series"
-    headers = {'X-Api-Key': preferences['SONARR_API_KEY']}
-    response = requests.get(url, headers=headers)
-    if response.ok:
-        series_list = response.json()
-        # Sort the series list alphabetically by title
-        sorted_series_list = sorted(series_list, key=lambda x: x['title'].lower())
-        return sorted_series_list
-    else:
-        return []
-
-
-def fetch_episode_file_details(episode_file_id):
-    episode_file_url = f"{SONARR_URL}/api/v3/episodefile/{episode_file_id}"
-    headers = {'X-Api-Key': SONARR_API_KEY}
-    response = requests.get(episode_file_url, headers=headers)
-    return response.json() if response.ok else None
-
-def fetch_series_and_episodes(preferences):
-    SONARR_URL = preferences['SONARR_URL']
-    SONARR_API_KEY = preferences['SONARR_API_KEY']
+class SeriesListFetch:
+    """The full /series list, read from Sonarr at most once.
+
+    Create one per dashboard build and hand it to every consumer, so a
+    render never reads the whole catalog more than once.
+    """
+
+    def __init__(self):
+        self._series = None
+
+    def __call__(self):
+        if self._series is None:
+            response = sonarr.get('series')
+            self._series = response.json() if response.ok else []
+        return self._series
+
+def get_series_list(preferences, fetch_series=None):
+    series_list = (fetch_series or SeriesListFetch())()
+    # Sort the series list alphabetically by title
+    return sorted(series_list, key=lambda x: x['title'].lower())
+
+
+def parse_sonarr_date(value):
+    """Parse a Sonarr ISO timestamp into an offset-aware datetime."""
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+def artwork_url(series, kind):
+    """URL of a series image on OCDarr's artwork proxy.
+
+    Sonarr stamps image URLs with ?lastWrite=..., which is passed along as the
+    version so the cached copy is refetched (and browsers get a new URL) when
+    the artwork changes.
+    """
+    version = None
+    for image in series.get('images', []):
+        if image.get('coverType') == kind:
+            version = parse_qs(urlparse(image.get('url') or '').query).get('lastWrite', [None])[0]
+            break
+    return f"/artwork/{series['id']}/{kind}" + (f"?v={version}" if version else '')
+
+def current_series_entry(preferences, series, episode, date_added):
     USE_POSTERS = os.getenv('USE_POSTERS', 'false').lower() == 'true'
-    series_url = f"{SONARR_URL}/api/v3/series"
-    headers = {'X-Api-Key': SONARR_API_KEY}
+    return {
+        'name': series['title'],
+        'latest_monitored_episode': f"S{episode['seasonNumber']}E{episode['episodeNumber']} - {episode['title']}",
+        'artwork_url': artwork_url(series, 'poster' if USE_POSTERS else 'banner'),
+        'sonarr_series_url': f"{preferences['SONARR_URL']}/series/{series['titleSlug']}",
+        'dateAdded': date_added
+    }
+
+def fetch_recent_imports_from_history(preferences, limit):
+    """Walk import history newest-first and stop once `limit` distinct series are found.
+
+    Returns None when history is unavailable or runs out before the limit, since
+    files imported without a history record would otherwise be missed.
+    """
     active_series = []
+    seen_series = set()
+    for page in range(1, HISTORY_MAX_PAGES + 1):
+        response = sonarr.get('history', params={
+            'page': page,
+            'pageSize': HISTORY_PAGE_SIZE,
+            'sortKey': 'date',
+            'sortDirection': 'descending',
+            'eventType': 3,  # downloadFolderImported
+            'includeSeries': 'true',
+            'includeEpisode': 'true'
+        })
+        if not response.ok:
+            return None
+        records = response.json().get('records', [])
+        for record in records:
+            series = record.get('series')
+            episode = record.get('episode')
+            if not series or not episode or series['id'] in seen_series:
+                continue
+            # The imported file may since have been deleted or unmonitored
+            if not (episode.get('monitored') and episode.get('hasFile')):
+                continue
+            seen_series.add(series['id'])
+            active_series.append(current_series_entry(preferences, series, episode, parse_sonarr_date(record['date'])))
+            if len(active_series) >= limit:
+                return active_series
+        if len(records) < HISTORY_PAGE_SIZE:
+            break
+    return None
+
+def fetch_episode_file_dates(series):
+    """Map episode file ID to dateAdded for a series in a single bulk call."""
+    response = sonarr.get('episodefile', params={'seriesId': series['id']})
+    files = response.json() if response.ok else []
+    return {f['id']: parse_sonarr_date(f['dateAdded']) for f in files if f.get('dateAdded')}
+
+def fetch_latest_monitored_episode(series, file_dates):
+    """Return (episode, dateAdded) for the newest file attached to a monitored episode."""
+    episodes_response = sonarr.get('episode', params={'seriesId': series['id']})
+    if not episodes_response.ok:
+        return None, None
+    candidates = [(file_dates[ep['episodeFileId']], ep) for ep in episodes_response.json()
+                  if ep.get('monitored') and ep.get('hasFile') and ep.get('episodeFileId') in file_dates]
+    if not candidates:
+        return None, None
+    date_added, episode = max(candidates, key=lambda c: c[0])
+    return episode, date_added
+
+def fetch_recent_imports_from_files(preferences, series_list, limit):
+    """Rank series by their newest episode file using one bulk call per series."""
+    candidates = [s for s in series_list if s.get('statistics', {}).get('episodeFileCount', 1) > 0]
+    with ThreadPoolExecutor(max_workers=DASHBOARD_FETCH_WORKERS) as pool:
+        all_file_dates = list(pool.map(fetch_episode_file_dates, candidates))
+
+    ranked = sorted(
+        ((max(file_dates.values()), series, file_dates)
+         for series, file_dates in zip(candidates, all_file_dates) if file_dates),
+        key=lambda item: item[0], reverse=True
+    )
+
+    # Only the leading series need their episode list, to find the monitored episode to show
+    active_series = []
+    start = 0
+    with ThreadPoolExecutor(max_workers=DASHBOARD_FETCH_WORKERS) as pool:
+        while len(active_series) < limit and start < len(ranked):
+            batch = ranked[start:start + limit - len(active_series)]
+            start += len(batch)
+            series_batch = [series for _, series, _ in batch]
+            file_dates_batch = [file_dates for _, _, file_dates in batch]
+            results = pool.map(fetch_latest_monitored_episode, series_batch, file_dates_batch)
+            for series, (episode, date_added) in zip(series_batch, results):
+                if episode:
+                    active_series.append(current_series_entry(preferences, series, episode, date_added))
 
-    series_response = requests.get(series_url, headers=headers)
-    series_list = series_response.json() if series_response.ok else []
-
-    for series in series_list:
-        episodes_url = f"{SONARR_URL}/api/v3/episode"
-        params = {'seriesId': series['id']}
-        episodes_response = requests.get(episodes_url, headers=headers, params=params)
-        episodes = episodes_response.json() if episodes_response.ok else []
-
-        for episode in episodes:
-            if episode.get('monitored') and episode.get('hasFile'):
-                episode_file_details = fetch_episode_file_details(episode['episodeFileId'])
-                if episode_file_details and 'dateAdded' in episode_file_details:
-                    # Parse and make dateAdded offset-aware
-                    date_added = datetime.fromisoformat(episode_file_details['dateAdded'].replace('Z', '+00:00'))
-                    active_series.append({
-                        'name': series['title'],
-                        'latest_monitored_episode': f"S{episode['seasonNumber']}E{episode['episodeNumber']} - {episode['title']}",
-                        'artwork_url': f"{SONARR_URL}/api/v3/mediacover/{series['id']}/{'poster' if USE_POSTERS else 'banner'}.jpg?apikey={SONARR_API_KEY}",
-                        'sonarr_series_url': f"{SONARR_URL}/series/{series['titleSlug']}",
-                        'dateAdded': date_added
-                    })
-                    break  # Since we're only interested in the latest episode per series that meets the criteria
-
-    # Sort series and return only the top 
     active_series.sort(key=lambda series: series['dateAdded'], reverse=True)
-    return active_series[:12]
+    return active_series[:limit]
 
+def fetch_series_and_episodes(preferences, limit=CURRENT_SERIES_LIMIT, fetch_series=None):
+    """Return the `limit` series with the most recently added monitored episode files."""
+    try:
+        active_series = fetch_recent_imports_from_history(preferences, limit)
+        if active_series is not None:
+            return active_series
+    except Exception as e:
+        logger.warning(f"Falling back to per-series file scan, history lookup failed: {str(e)}")
 
-def fetch_upcoming_premieres(preferences):
-    SONARR_URL = preferences['SONARR_URL']
-    SONARR_API_KEY = preferences['SONARR_API_KEY']
-    USE_POSTERS = os.getenv('USE_POSTERS', 'false').lower() == 'true' 
-    series_url = f"{SONARR_URL}/api/v3/series"
-    headers = {'X-Api-Key': SONARR_API_KEY}
-    upcoming_premieres = []
-
-    series_response = requests.get(series_url, headers=headers)
-    if series_response.ok:
-        series_list = series_response.json()
-        for series in series_list:
-            if 'nextAiring' in series:
-                next_airing_dt = datetime.fromisoformat(series['nextAiring'].replace('Z', '+00:00'))
-                formatted_date = next_airing_dt.strftime('%Y-%m-%d at %H:%M')
-                upcoming_premieres.append({
-                    'name': series['title'],
-                    'nextAiring': formatted_date,
-                    'artwork_url': f"{SONARR_URL}/api/v3/mediacover/{series['id']}/{'poster' if USE_POSTERS else 'banner'}.jpg?apikey={SONARR_API_KEY}",  # Update this line
-                    'sonarr_series_url': f"{SONARR_URL}/series/{series['titleSlug']}"
-                })
-
-    upcoming_premieres.sort(key=lambda x: x['nextAiring'])
-    return upcoming_premieres
+    series_list = (fetch_series or SeriesListFetch())()
+    return fetch_recent_imports_from_files(preferences, series_list, limit)
+
+
+def format_sonarr_date(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+class UpcomingCalendar:
+    """Episodes airing in the next `days` days, kept current with small /calendar reads.
+
+    The first refresh reads the whole window. Later ones drop episodes that
+    have aired and only read the days that scrolled into the window since
+    the last read. The whole window is reread every `full_refresh` seconds,
+    and after invalidate(), to pick up rescheduled and newly added episodes.
+    Unmonitored episodes are included so rule processing, which monitors and
+    unmonitors episodes all the time, never makes the cache stale.
+    """
 
+    def __init__(self, client, days=UPCOMING_DAYS, full_refresh=UPCOMING_FULL_REFRESH):
+        self.client = client
+        self.days = days
+        self.full_refresh = full_refresh
+        self._lock = threading.Lock()
+        self._episodes = {}
+        self._covered_until = None
+        self._full_read_at = None
+
+    def invalidate(self):
+        with self._lock:
+            self._covered_until = None
+
+    def _read(self, start, end):
+        response = self.client.get('calendar', params={
+            'start': format_sonarr_date(start),
+            'end': format_sonarr_date(end),
+            'unmonitored': 'true',
+            'includeSeries': 'true'
+        })
+        if not response.ok:
+            logger.warning(f"Sonarr returned {response.status_code} for the calendar")
+            return None
+        return {episode['id']: episode for episode in response.json()
+                if episode.get('airDateUtc') and episode.get('series')}
+
+    def episodes(self, now=None):
+        """Return the episodes airing between now and the end of the window."""
+        now = now or datetime.now(timezone.utc)
+        end = now + timedelta(days=self.days)
+        with self._lock:
+            full = (self._covered_until is None or self._full_read_at is None
+                    or time.monotonic() - self._full_read_at > self.full_refresh)
+            metrics.cache('upcoming_calendar', not full)
+            if full:
+                episodes = self._read(now, end)
+                if episodes is not None:
+                    self._episodes = episodes
+                    self._covered_until = end
+                    self._full_read_at = time.monotonic()
+            elif end > self._covered_until:
+                episodes = self._read(self._covered_until, end)
+                if episodes is not None:
+                    self._episodes.update(episodes)
+                    self._covered_until = end
+
+            self._episodes = {episode_id: episode for episode_id, episode in self._episodes.items()
+                              if parse_sonarr_date(episode['airDateUtc']) >= now}
+            return list(self._episodes.values())
+
+upcoming_calendar = UpcomingCalendar(sonarr)
+
+def fetch_upcoming_premieres(preferences):
+    """The next airing of each monitored series within the calendar window, soonest first."""
+    USE_POSTERS = os.getenv('USE_POSTERS', 'false').lower() == 'true'
+    next_airing = {}
+    for episode in upcoming_calendar.episodes():
+        series = episode['series']
+        if not series.get('monitored', True):
+            continue
+        air_date = parse_sonarr_date(episode['airDateUtc'])
+        if series['id'] not in next_airing or air_date < next_airing[series['id']][0]:
+            next_airing[series['id']] = (air_date, series)
 
+    return [{
+        'name': series['title'],
+        'nextAiring': air_date.strftime('%Y-%m-%d at %H:%M'),
+        'artwork_url': artwork_url(series, 'poster' if USE_POSTERS else 'banner'),
+        'sonarr_series_url': f"{preferences['SONARR_URL']}/series/{series['titleSlug']}"
+    } for air_date, series in sorted(next_airing.values(), key=lambda item: item[0])]
@@ -1,3 +1,140 @@
+// Panels are fetched after the page shell renders, so a slow Sonarr never delays the first paint
+var PANEL_RETRY_MS = 3000;
+var MISSING_PREVIEW_SIZE = 20;
+
+document.addEventListener('DOMContentLoaded', function() {
+    loadPanel('/api/current', renderCurrent);
+    loadPanel('/api/upcoming', renderUpcoming);
+    if (document.getElementById('series_list')) {
+        loadPanel('/api/series', renderSeriesList);
+    }
+    if (document.getElementById('missing_log')) {
+        loadMissingLog();
+    }
+});
+
+function loadPanel(url, render) {
+    fetch(url, {credentials: 'same-origin'})
+        .then(function(response) { return response.json(); })
+        .then(function(data) {
+            if (!data.ready) {
+                // The first snapshot is still being built
+                setTimeout(function() { loadPanel(url, render); }, PANEL_RETRY_MS);
+                return;
+            }
+            render(data.items);
+            var status = document.getElementById('snapshot-status');
+            if (status && status.dataset.ready !== 'true') {
+                status.dataset.ready = 'true';
+                status.textContent = 'Updated just now';
+            }
+        })
+        .catch(function(error) {
+            console.error('Failed to load ' + url, error);
+        });
+}
+
+function seriesCard(posters, url, artworkUrl, name, lines) {
+    var mode = posters ? 'poster-mode' : 'banner-mode';
+    var col = document.createElement('div');
+    col.className = 'col-12 ' + (posters ? 'col-md-6 col-lg-4 col-xl-3 ' : '') + 'series-item ' + mode;
+
+    var wrapper = document.createElement('div');
+    wrapper.className = 'banner-wrapper ' + mode;
+    var link = document.createElement('a');
+    link.href = url;
+    var img = document.createElement('img');
+    img.src = artworkUrl;
+    img.alt = 'Artwork for ' + name;
+    img.className = 'img-fluid';
+    img.loading = 'lazy';
+    link.appendChild(img);
+    wrapper.appendChild(link);
+    col.appendChild(wrapper);
+
+    var info = document.createElement('div');
+    info.className = 'series-info text-center mt-1';
+    lines.forEach(function(line) {
+        var p = document.createElement('p');
+        p.className = line[0];
+        p.textContent = line[1];
+        info.appendChild(p);
+    });
+    col.appendChild(info);
+    return col;
+}
+
+function renderPanel(name, items, card) {
+    var container = document.querySelector('[data-panel="' + name + '"]');
+    if (!container) {
+        return;
+    }
+    var posters = container.dataset.posters === 'true';
+    var fragment = document.createDocumentFragment();
+    items.forEach(function(item) {
+        fragment.appendChild(card(posters, item));
+    });
+    container.replaceChildren(fragment);
+}
+
+function renderCurrent(items) {
+    renderPanel('current', items, function(posters, series) {
+        return seriesCard(posters, series.sonarr_series_url, series.artwork_url, series.name,
+                          [['episode-info', series.latest_monitored_episode]]);
+    });
+}
+
+function renderUpcoming(items) {
+    renderPanel('upcoming', items, function(posters, premiere) {
+        return seriesCard(posters, premiere.sonarr_series_url, premiere.artwork_url, premiere.name,
+                          [['series-title', premiere.name], ['episode-info', premiere.nextAiring.split('at')[0]]]);
+    });
+}
+
+function renderSeriesList(items) {
+    var seriesList = document.getElementById('series_list');
+    var fragment = document.createDocumentFragment();
+    items.forEach(function(series) {
+        var item = document.createElement('div');
+        item.className = 'checkbox-item';
+        var checkbox = document.createElement('input');
+        checkbox.type = 'checkbox';
+        checkbox.className = 'series-checkbox';
+        checkbox.id = 'series_' + series.id;
+        checkbox.name = 'series_ids';
+        checkbox.value = series.id;
+        checkbox.setAttribute('data-rule', series.assigned_rule);
+        var label = document.createElement('label');
+        label.htmlFor = checkbox.id;
+        label.textContent = series.title + ' (' + (series.assigned_rule || 'None') + ')';
+        item.appendChild(checkbox);
+        item.appendChild(label);
+        fragment.appendChild(item);
+    });
+    seriesList.replaceChildren(fragment);
+    if (document.getElementById('assign_rules').style.display === 'block') {
+        updateCheckboxes();
+    }
+}
+
+function loadMissingLog() {
+    fetch('/api/missing?page_size=' + MISSING_PREVIEW_SIZE, {credentials: 'same-origin'})
+        .then(function(response) { return response.json(); })
+        .then(function(data) {
+            var lines = data.records.map(function(record) {
+                var lastSeen = new Date(record.last_seen * 1000).toLocaleString();
+                return record.title + ' - seen ' + record.count + 'x, last ' + lastSeen +
+                       (record.source ? ' (' + record.source + ')' : '');
+            });
+            document.getElementById('missing_log').value =
+                lines.join('\n') || data.legacyLog || 'No missing entries logged.';
+        })
+        .catch(function(error) {
+            document.getElementById('missing_log').value = 'Failed to read log.';
+            console.error('Failed to load missing series', error);
+        });
+}
+
 document.addEventListener('DOMContentLoaded', function() {
     var urlParams = new URLSearchParams(window.location.search);
     var section = urlParams.get('section');
@@ -180,7 +317,9 @@ function updateCheckboxes() {
 
     // Ensure the selected rule is carried over to the unassign form
     var unassignForm = document.getElementById('unassign-rules-form');
-    unassignForm.querySelector('input[name="assign_rule_name"]').value = selectedRule;
+    if (unassignForm) {
+        unassignForm.querySelector('input[name="assign_rule_name"]').value = selectedRule;
+    }
 }
 
 function confirmDeleteRule() {
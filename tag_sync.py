@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import logging
+import threading
+from sonarr_client import sonarr
+from config_store import config_cache
+from metrics import metrics
+
+CONFIG_DIR = os.path.dirname(os.getenv('CONFIG_PATH', '/app/config/config.json'))
+TAG_CACHE_PATH = os.getenv('TAG_CACHE_PATH', os.path.join(CONFIG_DIR, 'tag_cache.json'))
+TAG_SYNC_LOCK_PATH = os.path.join(os.path.dirname(TAG_CACHE_PATH), '.tag_sync.lock')
+TAG_SYNC_MAX_AGE = int(os.getenv('TAG_SYNC_MAX_AGE', '86400'))
+
+logger = logging.getLogger(__name__)
+
+_cache_lock = threading.Lock()
+_cache_stamp = None
+_cache = {}
+
+def rules_hash(config):
+    """Fingerprint of the rule names that need a matching Sonarr tag."""
+    return hashlib.sha1('\n'.join(sorted(name.lower() for name in config['rules'])).encode()).hexdigest()
+
+def read_tag_cache():
+    """Return the shared tag cache written by the last sync, re-reading it only when it changes."""
+    global _cache_stamp, _cache
+    try:
+        st = os.stat(TAG_CACHE_PATH)
+    except FileNotFoundError:
+        return {}
+    stamp = (st.st_mtime_ns, st.st_size)
+    if stamp != _cache_stamp:
+        with _cache_lock:
+            try:
+                with open(TAG_CACHE_PATH, 'r') as file:
+                    _cache = json.load(file)
+                _cache_stamp = stamp
+            except (OSError, ValueError) as e:
+                logger.error(f"Failed to read tag cache: {str(e)}")
+    return _cache
+
+def write_tag_cache(tags, config):
+    tmp_path = f"{TAG_CACHE_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump({
+            'synced_at': time.time(),
+            'rules_hash': rules_hash(config),
+            'tags': {str(tag_id): label for tag_id, label in tags.items()}
+        }, file)
+    os.replace(tmp_path, TAG_CACHE_PATH)
+
+def get_tag_mapping(refresh=False):
+    """Tag ID to label mapping, from the shared cache unless refresh is requested."""
+    if not refresh:
+        cached = read_tag_cache().get('tags')
+        metrics.cache('tags', bool(cached))
+        if cached:
+            return {int(tag_id): label for tag_id, label in cached.items()}
+    try:
+        response = sonarr.get('tag')
+        if response.ok:
+            return {tag['id']: tag['label'] for tag in response.json()}
+        else:
+            logger.error("Failed to retrieve Sonarr tags")
+    except Exception as e:
+        logger.error(f"Error retrieving Sonarr tags: {str(e)}")
+    return {}
+
+def tag_labels(tags):
+    """Translate Sonarr tag IDs to labels; labels are passed through unchanged."""
+    mapping = None
+    labels = []
+    for tag in tags:
+        if isinstance(tag, int) or (isinstance(tag, str) and tag.isdigit()):
+            if mapping is None:
+                mapping = get_tag_mapping()
+            labels.append(mapping.get(int(tag), str(tag)))
+        else:
+            labels.append(tag)
+    return labels
+
+def create_tag_in_sonarr(tag_name):
+    """Create a new tag in Sonarr."""
+    try:
+        response = sonarr.post('tag', json={"label": tag_name})
+        if response.ok:
+            logger.info(f"Created Sonarr tag: {tag_name}")
+            return response.json().get('id')
+        else:
+            logger.error("Failed to create Sonarr tag")
+    except Exception as e:
+        logger.error(f"Error creating Sonarr tag: {str(e)}")
+    return None
+
+def sync_rules_to_sonarr_tags():
+    """Ensure all rules have corresponding tags in Sonarr and refresh the shared cache."""
+    config = config_cache.get()
+    existing_tags = get_tag_mapping(refresh=True)
+    existing_tag_names = {tag_name.lower() for tag_name in existing_tags.values()}
+
+    for rule_name in config['rules'].keys():
+        if rule_name.lower() not in existing_tag_names:
+            logger.info(f"Creating missing tag for rule: {rule_name}")
+            tag_id = create_tag_in_sonarr(rule_name)
+            if tag_id is not None:
+                existing_tags[tag_id] = rule_name
+    write_tag_cache(existing_tags, config)
+
+def sync_is_current():
+    cache = read_tag_cache()
+    return (cache.get('rules_hash') == rules_hash(config_cache.get())
+            and time.time() - cache.get('synced_at', 0) < TAG_SYNC_MAX_AGE)
+
+def elected_sync(wait=False):
+    """Run the tag sync in at most one worker at a time, skipping it when the cache is current.
+
+    Without `wait`, a worker that finds another one syncing simply leaves it
+    to that worker; with `wait` it queues behind it and re-checks the cache.
+    """
+    os.makedirs(os.path.dirname(TAG_SYNC_LOCK_PATH) or '.', exist_ok=True)
+    with open(TAG_SYNC_LOCK_PATH, 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.debug("Tag sync already running in another worker")
+            return False
+        try:
+            if sync_is_current():
+                logger.debug("Sonarr tags already synced for the current rules")
+                return False
+            started = time.monotonic()
+            sync_rules_to_sonarr_tags()
+            logger.info(f"Synced rule tags to Sonarr in {time.monotonic() - started:.2f}s (pid {os.getpid()})")
+            return True
+        except Exception as e:
+            logger.error(f"Tag sync failed: {str(e)}")
+            return False
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def sync_async(wait=False):
+    """Start an elected tag sync in the background."""
+    thread = threading.Thread(target=elected_sync, args=(wait,), name='tag-sync', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,110 @@
+import os
+import time
+import logging
+import db
+
+WATCH_VELOCITY_DAYS = int(os.getenv('WATCH_VELOCITY_DAYS', '14'))
+WATCH_HISTORY_DAYS = int(os.getenv('WATCH_HISTORY_DAYS', '90'))
+DAY = 86400
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS watch_positions (
+    series_id INTEGER PRIMARY KEY,
+    season_number INTEGER NOT NULL,
+    episode_number INTEGER NOT NULL,
+    watched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS watch_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    series_id INTEGER NOT NULL,
+    season_number INTEGER NOT NULL,
+    episode_number INTEGER NOT NULL,
+    watched_at REAL NOT NULL,
+    source TEXT
+);
+CREATE INDEX IF NOT EXISTS watch_events_series ON watch_events (series_id, watched_at);
+'''
+
+class WatchHistoryStore:
+    """Episodes watched per series, as applied by rule processing.
+
+    Keeps the last episode watched in each series, which lets library
+    reconciliation work out what a rule wants without waiting for the next
+    watch event, and a log of watch events kept for `retention_days` from
+    which each series' viewing velocity is measured.
+    """
+
+    def __init__(self, db_path=None, velocity_days=WATCH_VELOCITY_DAYS, retention_days=WATCH_HISTORY_DAYS):
+        self.store = db.Store(SCHEMA, db_path)
+        self.velocity_days = velocity_days
+        self.retention_days = retention_days
+
+    def record(self, series_id, season_number, episode_number, source=None):
+        """Log a watch and remember (season, episode) as the latest watched in a series."""
+        now = time.time()
+        with self.store.transaction() as conn:
+            conn.execute(
+                'INSERT INTO watch_positions (series_id, season_number, episode_number, watched_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (series_id) DO UPDATE SET season_number = excluded.season_number, '
+                'episode_number = excluded.episode_number, watched_at = excluded.watched_at',
+                (series_id, season_number, episode_number, now)
+            )
+            conn.execute(
+                'INSERT INTO watch_events (series_id, season_number, episode_number, watched_at, source) VALUES (?, ?, ?, ?, ?)',
+                (series_id, season_number, episode_number, now, source)
+            )
+            conn.execute('DELETE FROM watch_events WHERE series_id = ? AND watched_at < ?',
+                         (series_id, now - self.retention_days * DAY))
+
+    def velocity(self, series_id, pending=None, now=None):
+        """Distinct episodes watched per day over the last `velocity_days`.
+
+        `pending` is a (season, episode) being watched right now that may not
+        be recorded yet. Rewatches count once, and the rate is taken over at
+        least a day, so a single evening's binge reads as that many a day.
+        """
+        now = now or time.time()
+        conn = self.store.connect()
+        try:
+            rows = conn.execute(
+                'SELECT season_number, episode_number, MIN(watched_at) AS first_watched FROM watch_events '
+                'WHERE series_id = ? AND watched_at >= ? GROUP BY season_number, episode_number',
+                (series_id, now - self.velocity_days * DAY)).fetchall()
+        finally:
+            conn.close()
+        watched = {(row['season_number'], row['episode_number']): row['first_watched'] for row in rows}
+        if pending is not None:
+            watched.setdefault(tuple(pending), now)
+        if not watched:
+            return 0.0
+        span_days = max(1.0, (now - min(watched.values())) / DAY)
+        return len(watched) / span_days
+
+    def positions(self):
+        """Mapping of series ID to its last watched (season, episode)."""
+        conn = self.store.connect()
+        try:
+            return {row['series_id']: (row['season_number'], row['episode_number'])
+                    for row in conn.execute('SELECT series_id, season_number, episode_number FROM watch_positions')}
+        finally:
+            conn.close()
+
+    def position(self, series_id):
+        """Last watched (season, episode) of one series, or None."""
+        conn = self.store.connect()
+        try:
+            row = conn.execute('SELECT season_number, episode_number FROM watch_positions WHERE series_id = ?',
+                               (series_id,)).fetchone()
+        finally:
+            conn.close()
+        return (row['season_number'], row['episode_number']) if row else None
+
+    def remove(self, series_id):
+        """Forget a series, e.g. once it has been deleted from Sonarr."""
+        with self.store.transaction() as conn:
+            conn.execute('DELETE FROM watch_positions WHERE series_id = ?', (series_id,))
+            conn.execute('DELETE FROM watch_events WHERE series_id = ?', (series_id,))
+
+watch_history = WatchHistoryStore()
@@ -1,31 +1,34 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify
-import subprocess
+import time
+IMPORT_STARTED = time.perf_counter()
+
+from flask import Flask, render_template, request, redirect, url_for, jsonify, g, Response, send_file
 import os
 import logging
-import json
+import requests
 import sonarr_utils
-from datetime import datetime
+from series_resolver import resolver, job_key
+from job_queue import JobQueue, RetryLater, PRIORITY_BACKGROUND
+import config_store
+from config_store import config_cache, load_config, ConfigConflict
+from dashboard_snapshot import SnapshotStore
+from session_tracker import PlaybackSessionTracker
 from dotenv import load_dotenv
-import requests
+from sonarr_client import SonarrUnavailableError
+import tag_sync
+from missing_store import missing_store, tail_log
+from metrics import metrics
+from reconcile import reconciler
+from search_dispatcher import search_dispatcher
+from watch_history import watch_history
+from artwork_cache import artwork_cache, ARTWORK_WIDTHS, ARTWORK_REVALIDATE_SECONDS
+from logging_config import configure_logging, correlation_id, new_correlation_id
 
 app = Flask(__name__)
 
-# Setup logging before other operations
-logging.basicConfig(
-    filename=os.getenv('LOG_PATH', '/app/logs/app.log'), 
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# One queued, rotating handler setup shared by every module
+configure_logging()
 logger = logging.getLogger(__name__)
 
-# Using only one handler to avoid duplicate logs
-if not logger.handlers:
-    stream_handler = logging.StreamHandler()
-    stream_handler.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    stream_handler.setFormatter(formatter)
-    logger.addHandler(stream_handler)
-
 # Load environment variables from .env file
 load_dotenv()
 
@@ -34,87 +37,148 @@ SONARR_URL = os.getenv('SONARR_URL')
 SONARR_API_KEY = os.getenv('SONARR_API_KEY')
 MISSING_LOG_PATH = os.getenv('MISSING_LOG_PATH', '/app/logs/missing.log')
 CLIENT_ONLY = os.getenv('CLIENT_ONLY', 'false').lower() == 'true'
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '2'))
+PANEL_MAX_AGE = int(os.getenv('PANEL_MAX_AGE', '15'))
 
-def get_tag_mapping():
-    """Retrieve existing tags from Sonarr."""
-    try:
-        response = requests.get(f"{SONARR_URL}/api/v3/tag", headers={'X-Api-Key': SONARR_API_KEY})
-        if response.ok:
-            return {tag['id']: tag['label'] for tag in response.json()}
-        else:
-            logger.error("Failed to retrieve Sonarr tags")
-    except Exception as e:
-        logger.error(f"Error retrieving Sonarr tags: {str(e)}")
-    return {}
+def process_server_activity(data):
+    """Job handler: run servertosonarr rule processing for a watch event payload.
 
-def create_tag_in_sonarr(tag_name):
-    """Create a new tag in Sonarr."""
+    The dashboard is not rebuilt: a watch event changes neither the series
+    list nor upcoming premieres, and the current panel catches up once the
+    snapshot is older than DASHBOARD_MAX_AGE.
+    """
+    import servertosonarr
     try:
-        response = requests.post(
-            f"{SONARR_URL}/api/v3/tag",
-            headers={'X-Api-Key': SONARR_API_KEY, 'Content-Type': 'application/json'},
-            json={"label": tag_name}
-        )
-        if response.ok:
-            logger.info(f"Created Sonarr tag: {tag_name}")
-            return response.json().get('id')
-        else:
-            logger.error("Failed to create Sonarr tag")
-    except Exception as e:
-        logger.error(f"Error creating Sonarr tag: {str(e)}")
-    return None
+        servertosonarr.main(data)
+    except SonarrUnavailableError as e:
+        # Keep the job until the circuit breaker lets requests through again
+        raise RetryLater(str(e), e.retry_after + 1)
+    except requests.exceptions.RequestException:
+        # Sonarr failed to answer (some of these are also ValueErrors); the job is retried with backoff
+        raise
+    except (ValueError, StopIteration) as e:
+        # The payload can never be processed (e.g. the episode does not exist); retrying won't help
+        logger.error(f"Servertosonarr processing error: {str(e)}")
+
+def process_series_add(data):
+    """Job handler: apply the tag-matched or default rule to a newly added series."""
+    from servertosonarr import get_rule_by_tags, apply_rule_to_series
+    rule = get_rule_by_tags(data.get('tags', []))
+    try:
+        apply_rule_to_series(data['series_id'], rule)
+    except SonarrUnavailableError as e:
+        raise RetryLater(str(e), e.retry_after + 1)
 
-def load_config():
-    config_path = os.getenv('CONFIG_PATH', '/app/config/config.json')
+def build_dashboard_snapshot():
+    """Collect everything the home page shows from Sonarr."""
+    preferences = sonarr_utils.load_preferences()
+    # Shared so the build reads the full series list from Sonarr at most once
+    fetch_series = sonarr_utils.SeriesListFetch()
+    with metrics.timer('ocdarr_stage_duration_seconds', stage='dashboard_current'):
+        current_series = sonarr_utils.fetch_series_and_episodes(preferences, fetch_series=fetch_series)
+    with metrics.timer('ocdarr_stage_duration_seconds', stage='dashboard_upcoming'):
+        upcoming_premieres = sonarr_utils.fetch_upcoming_premieres(preferences)
+    with metrics.timer('ocdarr_stage_duration_seconds', stage='dashboard_series'):
+        all_series = [] if CLIENT_ONLY else sonarr_utils.get_series_list(preferences, fetch_series)
+    return {
+        'current_series': current_series,
+        'upcoming_premieres': upcoming_premieres,
+        'all_series': all_series
+    }
+
+# Sonarr webhook events that change what the dashboard shows
+DASHBOARD_EVENTS = {'Download', 'SeriesAdd', 'SeriesDelete', 'EpisodeFileDelete', 'Rename'}
+
+dashboard = SnapshotStore(build_dashboard_snapshot)
+
+def dry_run_requested():
+    return request.args.get('dry_run', 'false').lower() == 'true'
+
+def plan_response(data):
+    """Compute the rule plan for a payload without changing anything in Sonarr."""
+    import servertosonarr
     try:
-        with open(config_path, 'r') as file:
-            config = json.load(file)
-        if 'rules' not in config:
-            config['rules'] = {}
-        if 'default_rule' not in config:
-            config['default_rule'] = '1n1'
-        return config
-    except FileNotFoundError:
-        return {
-            'rules': {
-                '1n1': {
-                    'get_option': '1',
-                    'action_option': 'search',
-                    'keep_watched': '1',
-                    'monitor_watched': False,
-                    'series': []
-                }
-            },
-            'default_rule': '1n1'
-        }
+        plan = servertosonarr.main(data, dry_run=True)
+    except ValueError as e:
+        # The watched episode is not in Sonarr, or the rule's get_option is invalid
+        return jsonify({'status': 'error', 'message': str(e)}), 404
+    if plan is None:
+        return jsonify({'status': 'error', 'message': 'No plan could be built for this payload'}), 404
+    return jsonify({'status': 'dry_run', 'plan': plan}), 200
+
+def process_reconcile_series(data):
+    """Job handler: apply the changes a reconciliation pass found a series needs."""
+    try:
+        reconciler.apply(data['series_id'])
+    except SonarrUnavailableError as e:
+        raise RetryLater(str(e), e.retry_after + 1)
 
-def sync_rules_to_sonarr_tags():
-    """Ensure all rules have corresponding tags in Sonarr."""
-    config = load_config()
-    existing_tags = get_tag_mapping()
-    existing_tag_names = {tag_name.lower() for tag_name in existing_tags.values()}
-    
-    for rule_name in config['rules'].keys():
-        if rule_name.lower() not in existing_tag_names:
-            logger.info(f"Creating missing tag for rule: {rule_name}")
-            create_tag_in_sonarr(rule_name)
-
-def save_config(config):
-    config_path = os.getenv('CONFIG_PATH', '/app/config/config.json')
-    with open(config_path, 'w') as file:
-        json.dump(config, file, indent=4)
-    if not CLIENT_ONLY:
-        sync_rules_to_sonarr_tags()
+jobs = JobQueue({
+    'server_activity': process_server_activity,
+    'series_add': process_series_add,
+    'reconcile_series': process_reconcile_series
+}, workers=WEBHOOK_WORKERS)
 
-def get_missing_log_content():
-    try:
-        with open(MISSING_LOG_PATH, 'r') as file:
-            return file.read()
-    except FileNotFoundError:
-        return "No missing entries logged."
-    except Exception as e:
-        logger.error(f"Failed to read missing log: {str(e)}")
-        return "Failed to read log."
+def submit_server_activity(data, delay=0, merge=None):
+    """Journal a watch event for rule processing by the job workers.
+
+    Keyed by the Sonarr series ID when the series index already knows the
+    show, so events reported under any of its titles queue behind each
+    other and behind the show's other jobs.
+    """
+    from servertosonarr import get_provider_ids
+    title = data.get('server_title') or data.get('plex_title') or ''
+    jobs.enqueue('server_activity', data, job_key(resolver.cached(title, get_provider_ids(data)), title), delay, merge)
+
+def submit_reconcile_series(series):
+    """Journal reconciliation changes so they run after any queued watch event for the show.
+
+    They are claimed after webhook jobs, so a large pass never holds up watch events.
+    """
+    jobs.enqueue('reconcile_series', {'series_id': series['id']}, job_key(series['id']),
+                 priority=PRIORITY_BACKGROUND)
+
+# Reconciliation only plans; its changes go through the journal like every other write
+reconciler.submit = submit_reconcile_series
+
+# Collapses repeated progress events and back-to-back episodes into one trigger
+sessions = PlaybackSessionTracker(submit_server_activity)
+
+CONFLICT_MESSAGE = "Settings were changed elsewhere, review them and try again"
+
+def save_config(config, delete_rules=()):
+    config_store.save_config(config, delete_rules)
+    if not CLIENT_ONLY:
+        # New rules need tags; done in the background so the form post never waits on Sonarr
+        tag_sync.sync_async(wait=True)
+
+def cached_json(payload, max_age=0):
+    """JSON response with an ETag, answering 304 when the client's copy is current.
+
+    With max_age 0 browsers revalidate on every load, which costs a 304 and
+    no body when nothing changed.
+    """
+    response = jsonify(payload)
+    response.add_etag()
+    response.cache_control.private = True
+    if max_age:
+        response.cache_control.max_age = max_age
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def not_ready_response():
+    """Returned by panels until the first dashboard snapshot exists; the page polls again."""
+    response = jsonify({'ready': False, 'items': []})
+    response.cache_control.no_store = True
+    return response
+
+def snapshot_panel(key):
+    """One dashboard panel from the shared snapshot."""
+    snapshot = dashboard.get()
+    if snapshot is None:
+        return not_ready_response()
+    return cached_json({'ready': True, 'items': snapshot[key]}, PANEL_MAX_AGE)
 
 # Route handlers
 @app.route('/webhook', methods=['POST'])
@@ -124,15 +188,10 @@ def handle_server_webhook():
     data = request.json
     if data:
         try:
-            temp_dir = '/app/temp'
-            os.makedirs(temp_dir, exist_ok=True)
-            with open(os.path.join(temp_dir, 'data_from_server.json'), 'w') as f:
-                json.dump(data, f)
-            
-            result = subprocess.run(["python3", "/app/servertosonarr.py"], capture_output=True, text=True)
-            if result.stderr:
-                logger.error(f"Servertosonarr.py error: {result.stderr}")
-            return jsonify({'status': 'success'}), 200
+            if dry_run_requested():
+                return plan_response(data)
+            result = sessions.observe(data)
+            return jsonify({'status': 'accepted', 'trigger': result}), 202
         except Exception as e:
             logger.error(f"Failed to process Tautulli webhook: {str(e)}")
             return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -161,23 +220,22 @@ def handle_jellyfin_webhook():
                     episode_data = {
                         "server_title": series_name,
                         "server_season_num": str(season),
-                        "server_ep_num": str(episode)
+                        "server_ep_num": str(episode),
+                        "server_user": data.get('NotificationUsername') or data.get('UserId') or '',
+                        "server_source": 'jellyfin'
                     }
+                    # Series provider IDs let the resolver skip title matching
+                    for provider in ('tvdb', 'tmdb', 'imdb'):
+                        if data.get(f"server_{provider}_id"):
+                            episode_data[f"server_{provider}_id"] = str(data[f"server_{provider}_id"])
                     
-                    temp_dir = '/app/temp'
-                    os.makedirs(temp_dir, exist_ok=True)
-                    with open(os.path.join(temp_dir, 'data_from_server.json'), 'w') as f:
-                        json.dump(episode_data, f)
-                    
-                    result = subprocess.run(["python3", "/app/servertosonarr.py"],
-                                       capture_output=True,
-                                       text=True)
-                    
-                    if result.stderr:
-                        logger.error(f"Servertosonarr.py error: {result.stderr}")
-            
-            return jsonify({'status': 'success'}), 200
-            
+                    if dry_run_requested():
+                        return plan_response(episode_data)
+                    result = sessions.observe(episode_data)
+                    return jsonify({'status': 'accepted', 'trigger': result}), 202
+
+        return jsonify({'status': 'success'}), 200
+
     except Exception as e:
         logger.error(f"Failed to process Jellyfin webhook: {str(e)}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -191,22 +249,32 @@ def handle_sonarr_webhook():
         return jsonify({'status': 'error', 'message': 'No data received'}), 400
 
     try:
+        if data.get('eventType') in ('SeriesAdd', 'SeriesDelete'):
+            sonarr_utils.upcoming_calendar.invalidate()
+        if data.get('eventType') in DASHBOARD_EVENTS:
+            dashboard.refresh_async(data.get('eventType'))
+
+        if data.get('eventType') == 'SeriesDelete':
+            resolver.remove_series(data.get('series', {}).get('id'))
+            watch_history.remove(data.get('series', {}).get('id'))
+
         if data.get('eventType') == 'SeriesAdd':
             series_id = data.get('series', {}).get('id')
             title = data.get('series', {}).get('title')
             tags = data.get('series', {}).get('tags', [])
             
             if series_id:
+                resolver.add_series(data['series'])
+                if title:
+                    missing_store.remove(title)
                 logger.info(f"Processing new series: {title} (ID: {series_id}) with tags: {tags}")
                 
-                from servertosonarr import get_rule_by_tags, apply_rule_to_series
-                rule = get_rule_by_tags(tags)
-                apply_rule_to_series(series_id, rule)
+                jobs.enqueue('series_add', {'series_id': series_id, 'tags': tags}, job_key(series_id))
                 
                 return jsonify({
-                    'status': 'success', 
-                    'message': 'Applied rule to new series'
-                }), 200
+                    'status': 'accepted', 
+                    'message': 'Queued rule for new series'
+                }), 202
                
         return jsonify({'status': 'success', 'message': 'Webhook processed'}), 200
        
@@ -216,42 +284,155 @@ def handle_sonarr_webhook():
 
 @app.route('/')
 def home():
-    preferences = sonarr_utils.load_preferences()
-    current_series = sonarr_utils.fetch_series_and_episodes(preferences)
-    upcoming_premieres = sonarr_utils.fetch_upcoming_premieres(preferences)
+    """Render the page shell; script.js fills in the panels from the /api endpoints."""
+    # Starts the first snapshot build so the panels have data by the time they ask
+    dashboard.get()
+    snapshot_status = dashboard.status()
     use_posters = os.getenv('USE_POSTERS', 'false').lower() == 'true'
 
     if CLIENT_ONLY:
         return render_template('index.html',
-                             current_series=current_series,
-                             upcoming_premieres=upcoming_premieres,
                              use_posters=use_posters,
                              sonarr_url=SONARR_URL,
+                             snapshot_status=snapshot_status,
                              config={'CLIENT_ONLY': CLIENT_ONLY})
 
-    # Full functionality for non-client mode
-    config = load_config()
-    all_series = sonarr_utils.get_series_list(preferences)
-    rules_mapping = {str(series_id): rule_name for rule_name, details in config['rules'].items() 
-                    for series_id in details.get('series', [])}
-    
-    default_rule = config.get('default_rule', '1n1')
-    for series in all_series:
-        series['assigned_rule'] = rules_mapping.get(str(series['id']), default_rule)
-
-    missing_log_content = get_missing_log_content()
     rule = request.args.get('rule', '1n1')
 
     return render_template('index.html',
-                         config=config,
-                         current_series=current_series,
-                         upcoming_premieres=upcoming_premieres,
-                         all_series=all_series,
+                         config=config_cache.get(),
                          sonarr_url=SONARR_URL,
-                         missing_log=missing_log_content,
                          rule=rule,
+                         snapshot_status=snapshot_status,
                          use_posters=use_posters)
 
+@app.route('/artwork/<int:series_id>/<kind>')
+def artwork(series_id, kind):
+    """Series artwork from the local thumbnail cache, so browsers never talk to Sonarr."""
+    if kind not in ARTWORK_WIDTHS:
+        return jsonify({'status': 'error', 'message': 'Unknown artwork kind'}), 404
+    version = request.args.get('v')
+    cached = artwork_cache.get(series_id, kind, version)
+    if cached is None:
+        return jsonify({'status': 'error', 'message': 'Artwork not available'}), 404
+    path, etag = cached
+    response = send_file(path, mimetype='image/jpeg', etag=etag, conditional=True, max_age=None)
+    response.cache_control.public = True
+    if version:
+        # A new version gets a new URL, so this one never changes
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = ARTWORK_REVALIDATE_SECONDS
+    return response
+
+@app.route('/api/current')
+def current_panel():
+    """Series with the most recently added monitored episodes."""
+    return snapshot_panel('current_series')
+
+@app.route('/api/upcoming')
+def upcoming_panel():
+    """Upcoming season premieres."""
+    return snapshot_panel('upcoming_premieres')
+
+@app.route('/api/series')
+def series_panel():
+    """All series with their assigned rule, for the rule assignment form."""
+    if CLIENT_ONLY:
+        return jsonify({'status': 'error', 'message': 'Series list disabled in client mode'}), 400
+    snapshot = dashboard.get()
+    if snapshot is None:
+        return not_ready_response()
+    rules_mapping = config_cache.series_rule_index()
+    default_rule = config_cache.get().get('default_rule', '1n1')
+    items = [{'id': series['id'], 'title': series['title'],
+              'assigned_rule': rules_mapping.get(str(series['id']), default_rule)}
+             for series in snapshot['all_series']]
+    return cached_json({'ready': True, 'items': items})
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.correlation_token = correlation_id.set(request.headers.get('X-Request-ID') or new_correlation_id())
+
+@app.teardown_request
+def clear_correlation_id(exc=None):
+    if 'correlation_token' in g:
+        correlation_id.reset(g.correlation_token)
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.inc('ocdarr_http_requests_total', route=route, method=request.method, status=response.status_code)
+    if 'request_started' in g:
+        metrics.observe('ocdarr_http_request_duration_seconds', time.perf_counter() - g.request_started, route=route)
+    if correlation_id.get():
+        response.headers['X-Request-ID'] = correlation_id.get()
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text exposition, merged across all gunicorn workers."""
+    queue = jobs.stats()
+    searches = search_dispatcher.stats()
+    gauges = [
+        ('ocdarr_job_queue_jobs', 'Jobs in the webhook job journal by status.',
+         [({'status': status}, queue[status]) for status in ('pending', 'running', 'failed')]),
+        ('ocdarr_job_queue_lag_seconds', 'Age of the oldest unfinished job.', [({}, queue['lag_seconds'])]),
+        ('ocdarr_missing_series', 'Distinct webhook titles not found in Sonarr.',
+         [({}, missing_store.page(1, 1)['totalRecords'])]),
+        ('ocdarr_search_episodes', 'Episode searches by state: pending in OCDarr, queued or running in Sonarr.',
+         [({'status': status}, searches[status]) for status in ('pending', 'queued', 'running')]),
+    ]
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/queue')
+def queue_status():
+    """Report job queue depth, lag and recent failures."""
+    return jsonify(jobs.stats())
+
+@app.route('/admin/reconcile', methods=['GET', 'POST'])
+def reconcile_status():
+    """Recent library reconciliation runs; POST starts one now (?full=true, ?dry_run=true)."""
+    if CLIENT_ONLY:
+        return jsonify({'status': 'error', 'message': 'Reconciliation disabled in client mode'}), 400
+    if request.method == 'POST':
+        if reconciler.is_running():
+            return jsonify({'status': 'running', 'runs': reconciler.runs()}), 409
+        full = request.args.get('full', 'false').lower() == 'true'
+        reconciler.run_async(full=full, dry_run=dry_run_requested())
+        return jsonify({'status': 'started', 'full': full, 'dry_run': dry_run_requested()}), 202
+    return jsonify({'running': reconciler.is_running(), 'runs': reconciler.runs()})
+
+@app.route('/admin/searches')
+def search_status():
+    """Episode searches waiting or running, and the latest search commands."""
+    return jsonify(search_dispatcher.stats())
+
+@app.route('/session-stats')
+def session_stats():
+    """Report how many playback events were coalesced into rule triggers."""
+    return jsonify(sessions.stats())
+
+@app.route('/api/missing')
+def missing_series():
+    """Paginated list of webhook titles that did not match a Sonarr series."""
+    if CLIENT_ONLY:
+        return jsonify({'status': 'error', 'message': 'Missing series disabled in client mode'}), 400
+    page = request.args.get('page', 1, type=int)
+    page_size = request.args.get('page_size', 50, type=int)
+    result = missing_store.page(page, page_size)
+    if result['totalRecords'] == 0 and page == 1:
+        # Nothing recorded yet, e.g. right after an upgrade: offer the end of the old log
+        result['legacyLog'] = tail_log(MISSING_LOG_PATH)
+    return cached_json(result)
+
+@app.route('/dashboard-status')
+def dashboard_status():
+    """Report how old the dashboard snapshot is and how long it took to build."""
+    return jsonify(dashboard.status())
+
 @app.route('/update-settings', methods=['POST'])
 def update_settings():
     if CLIENT_ONLY:
@@ -259,6 +440,8 @@ def update_settings():
         
     try:
         config = load_config()
+        # The version the form was rendered from, so a concurrent edit is not silently overwritten
+        config['version'] = request.form.get('config_version', config['version'], type=int)
         rule_name = request.form.get('rule_name')
         if rule_name == 'add_new':
             rule_name = request.form.get('new_rule_name')
@@ -279,6 +462,9 @@ def update_settings():
 
         save_config(config)
         return redirect(url_for('home', section='settings', message="Settings updated"))
+    except ConfigConflict as e:
+        logger.warning(f"Not saving settings: {str(e)}")
+        return redirect(url_for('home', section='settings', message=CONFLICT_MESSAGE))
     except Exception as e:
         logger.error(f"Failed to update settings: {str(e)}")
         return redirect(url_for('home', section='settings', message="Error updating settings"))
@@ -289,11 +475,16 @@ def delete_rule():
         return jsonify({'status': 'error', 'message': 'Rule deletion disabled in client mode'}), 400
         
     config = load_config()
+    config['version'] = request.form.get('config_version', config['version'], type=int)
     rule_name = request.form.get('rule_name')
     if rule_name and rule_name in config['rules']:
         logger.info(f"Deleting rule: {rule_name}")
         del config['rules'][rule_name]
-        save_config(config)
+        try:
+            save_config(config, delete_rules=[rule_name])
+        except ConfigConflict as e:
+            logger.warning(f"Not deleting rule: {str(e)}")
+            return redirect(url_for('home', section='settings', message=CONFLICT_MESSAGE))
         return redirect(url_for('home', section='settings', message=f"Rule '{rule_name}' deleted"))
     return redirect(url_for('home', section='settings', message=f"Rule not found"))
 
@@ -302,30 +493,30 @@ def assign_rules():
     if CLIENT_ONLY:
         return jsonify({'status': 'error', 'message': 'Rule assignment disabled in client mode'}), 400
         
-    config = load_config()
     rule_name = request.form.get('assign_rule_name')
     submitted_series_ids = set(request.form.getlist('series_ids'))
 
     logger.info(f"Assigning rule '{rule_name}' to series IDs: {submitted_series_ids}")
 
-    if not rule_name or rule_name == 'remove':
-        for key, details in config['rules'].items():
-            details['series'] = [sid for sid in details.get('series', []) if sid not in submitted_series_ids]
+    if not rule_name or rule_name in ('remove', 'None'):
+        config_store.assign_series(submitted_series_ids, None)
+    elif rule_name in config_cache.get()['rules']:
+        # Only the submitted series' rows change; an assignment moves them off any other rule
+        config_store.assign_series(submitted_series_ids, rule_name)
     else:
-        if rule_name in config['rules']:
-            current_series = set(config['rules'][rule_name]['series'])
-            updated_series = current_series.union(submitted_series_ids)
-            config['rules'][rule_name]['series'] = list(updated_series)
-
-        for key, details in config['rules'].items():
-            if key != rule_name:
-                details['series'] = [sid for sid in details.get('series', []) if sid not in submitted_series_ids]
-
-    save_config(config)
+        return redirect(url_for('home', section='settings', message="Rule not found"))
     return redirect(url_for('home', section='settings', message="Rules updated"))
 
-if not CLIENT_ONLY:
-    sync_rules_to_sonarr_tags()
+def start_background_services():
+    """Start per-worker background work. Nothing here blocks on Sonarr."""
+    jobs.start()
+    search_dispatcher.start()
+    if not CLIENT_ONLY:
+        tag_sync.sync_async()
+        reconciler.start()
+
+start_background_services()
+logger.info(f"Worker {os.getpid()} ready in {(time.perf_counter() - IMPORT_STARTED) * 1000:.0f}ms")
 
 if __name__ == '__main__':
     logger.info("Starting OCDarr webhook listener")